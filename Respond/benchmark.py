@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import utils, data_load, clustering, mutation_index, gsea, render
+
+# benchmark of every pipeline stage on synthetic inputs shaped like the real ones (RESPOND_247_coding_final.maf,
+# Expression_remove_BE.txt), which can not be shipped. Each stage is timed and its peak traced memory recorded,
+# the results are checked against the original implementations, and the run fails (exit code 1) on a parity
+# failure or on a stage that got slower than a saved baseline
+#
+#   python benchmark.py --genes 20000 --samples 250 --output bench.json
+#   python benchmark.py --baseline bench.json
+
+
+def generate_counts(n_genes, n_samples, seed=0):
+    ''' negative binomial gene x sample RNA-seq counts, with per gene expression levels and per sample sequencing depths '''
+    rng = np.random.default_rng(seed)
+    gene_means = rng.lognormal(mean=4, sigma=2, size=n_genes)
+    depths = rng.lognormal(mean=0, sigma=0.3, size=n_samples)
+    dispersion = 0.2
+    means = gene_means[:, None] * depths[None, :]
+    counts = rng.negative_binomial(1 / dispersion, 1 / (1 + dispersion * means))
+
+    genes = [f'GENE{i}' for i in range(n_genes)]
+    samples = [f'RESPOND_{j:04d}' for j in range(n_samples)]
+    return pd.DataFrame(counts, index=genes, columns=samples)
+
+
+def write_expression_file(counts, file_path):
+    # same layout as the real expression file: the header only has the sample names
+    with open(file_path, 'w') as file:
+        file.write('\t'.join(counts.columns) + '\n')
+    counts.to_csv(file_path, sep='\t', header=False, mode='a')
+
+
+def generate_maf(genes, samples, mutation_rate=0.01, sequenced_fraction=0.9, seed=0):
+    ''' one row per mutation. Each gene's rate is drawn around mutation_rate (a few genes mutate often),
+     only sequenced_fraction of the samples are sequenced, plus a few sequenced samples without expression data
+     '''
+    rng = np.random.default_rng(seed)
+    gene_rates = np.minimum(rng.gamma(shape=0.5, scale=mutation_rate / 0.5, size=len(genes)), 0.5)
+    sequenced = list(rng.choice(samples, max(2, int(len(samples) * sequenced_fraction)), replace=False))
+    sequenced += [f'RESPOND_NOEXPR_{j}' for j in range(3)]
+
+    rows = []
+    for sample in sequenced:
+        mutated_genes = np.flatnonzero(rng.random(len(genes)) < gene_rates)
+        # every sequenced sample has at least one mutation, otherwise it is not in the maf
+        if len(mutated_genes) == 0:
+            mutated_genes = rng.integers(0, len(genes), 1)
+        for code in mutated_genes:
+            for _ in range(rng.integers(1, 3)):
+                rows.append((genes[code], sample))
+
+    maf_df = pd.DataFrame(rows, columns=['Hugo_Symbol', 'Tumor_Sample_Barcode'])
+    maf_df.insert(1, 'Entrez_Gene_Id', 0)
+    maf_df.insert(2, 'Variant_Classification', rng.choice(['Missense_Mutation', 'Silent', 'Nonsense_Mutation'], len(maf_df)))
+    return maf_df
+
+
+def write_maf_file(maf_df, file_path):
+    with open(file_path, 'w') as file:
+        file.write('#version 2.4\n')
+    maf_df.to_csv(file_path, sep='\t', index=False, mode='a')
+
+
+def pick_targets(maf_df, expression_samples, n_targets):
+    # the most often mutated genes that still leave non-mutated samples
+    sequenced = maf_df['Tumor_Sample_Barcode'].isin(expression_samples)
+    mutated_counts = maf_df[sequenced].drop_duplicates().groupby('Hugo_Symbol').size()
+    n_sequenced = maf_df.loc[sequenced, 'Tumor_Sample_Barcode'].nunique()
+    return mutated_counts[mutated_counts < n_sequenced - 1].sort_values(ascending=False).index[:n_targets].tolist()
+
+
+class Benchmark:
+    ''' runs stages, recording their wall time and peak traced memory (numpy and pandas allocations included) '''
+
+    def __init__(self, trace_memory=True):
+        self.results = {}
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+
+    def run(self, stage, function, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+        peak_mb = (tracemalloc.get_traced_memory()[1] - start_memory) / 2**20 if self.trace_memory else None
+        self.results[stage] = {'seconds': seconds, 'peak_mb': peak_mb}
+        print(f"{stage:<24} {seconds:9.3f}s" + (f"  {peak_mb:9.1f} MB peak" if peak_mb is not None else ''))
+        return result
+
+
+def legacy_load(file_path):
+    # the original loader: pydeseq2 normalization and an element-wise log2
+    from pydeseq2 import preprocessing
+    df = pd.read_csv(file_path, sep='\t')
+    df = preprocessing.deseq2_norm(df.T)[0].T
+    return df.map(utils.log2)
+
+
+def max_difference(df, reference_df):
+    return float(np.nanmax(np.abs(df.to_numpy(dtype=np.float64) - reference_df.to_numpy(dtype=np.float64)))) if df.size else 0.0
+
+
+def run_benchmark(n_genes, n_samples, mutation_rate, n_targets, n_parity_targets, work_folder, seed=0, legacy=True, trace_memory=True):
+    benchmark = Benchmark(trace_memory=trace_memory)
+    parity = {}
+    expression_file_path = os.path.join(work_folder, 'expression.txt')
+    maf_file_path = os.path.join(work_folder, 'mutations.maf')
+    output_folder = os.path.join(work_folder, 'output')
+    cache_folder = os.path.join(work_folder, 'cache')
+
+    print(f"generating {n_genes} genes x {n_samples} samples, mutation rate {mutation_rate}")
+    counts = generate_counts(n_genes, n_samples, seed=seed)
+    maf_df = generate_maf(counts.index, counts.columns, mutation_rate=mutation_rate, seed=seed)
+    write_expression_file(counts, expression_file_path)
+    write_maf_file(maf_df, maf_file_path)
+    targets = pick_targets(maf_df, counts.columns, n_targets)
+    del counts
+    print(f"{len(maf_df)} mutations, targets {targets}")
+
+    expression_df = benchmark.run('load_normalize', data_load.load_txt_file_into_dataframe, expression_file_path)
+    data_load.load_txt_file_into_dataframe(expression_file_path, cache_folder=cache_folder)
+    cached_df = benchmark.run('load_cached', data_load.load_txt_file_into_dataframe, expression_file_path, cache_folder=cache_folder)
+    parity['cached_load'] = max_difference(cached_df, expression_df) == 0
+    del cached_df
+
+    def merge():
+        index = mutation_index.build_mutation_index(maf_file_path)
+        exon_seq_samples = expression_df.columns[expression_df.columns.isin(index.samples)]
+        return index.mutation_matrix(targets, samples=exon_seq_samples)
+    mutation_matrix = benchmark.run('merge', merge)
+
+    stats_per_target = benchmark.run('stats', utils.generate_stats_for_targets, expression_df, mutation_matrix)
+
+    heatmaps = benchmark.run('heatmap_selection', lambda: {
+        target_gene: data_load.generate_expression_heatmap(expression_df=expression_df, volcano_plot_df=stats_df, n=100, top=True)
+        for target_gene, stats_df in stats_per_target.items()})
+
+    def cluster():
+        linkages = {}
+        for target_gene, heatmap_data in heatmaps.items():
+            os.makedirs(f'{output_folder}/{target_gene}', exist_ok=True)
+            mutated_samples = list(mutation_matrix.index[mutation_matrix[target_gene]])
+            linkages[target_gene] = clustering.hierarchical_clustering(heatmap_data, output_folder, row_threshold=7, col_threshold=2,
+                                                                       mutated_samples=mutated_samples, target_gene=target_gene)[:2]
+        return linkages
+    linkages = benchmark.run('clustering', cluster)
+
+    def plot(target_gene):
+        mutated_samples = mutation_matrix.index[mutation_matrix[target_gene]]
+        mutated_status_df = pd.DataFrame({'Sample': heatmaps[target_gene].columns,
+                                          'Mutation Status': heatmaps[target_gene].columns.isin(mutated_samples).astype(int)})
+        with render.PlotRenderer(n_workers=0) as renderer:
+            render.submit_stats_plots(renderer, expression_df, stats_per_target[target_gene], None, mutated_samples, output_folder, target_gene)
+            render.submit_cluster_plots(renderer, heatmaps[target_gene], *linkages[target_gene], mutated_status_df, output_folder, target_gene)
+    if stats_per_target:
+        benchmark.run('plotting', plot, next(iter(stats_per_target)))
+
+    benchmark.run('gsea_export', gsea.export_gsea_inputs, expression_df, mutation_matrix, os.path.join(work_folder, 'GSEA'), stats_per_target)
+
+    # the original long format implementation on the same inputs
+    if legacy:
+        parity_targets = list(stats_per_target)[:n_parity_targets]
+        maf_legacy_df = data_load.load_maf_data(maf_file_path)
+        parity['mutation_matrix'] = mutation_matrix.equals(
+            data_load.build_mutation_matrix(maf_legacy_df, targets, samples=mutation_matrix.index))
+
+        try:
+            legacy_expression_df = benchmark.run('legacy_load_normalize', legacy_load, expression_file_path)
+            parity['normalization'] = max_difference(expression_df, legacy_expression_df.loc[expression_df.index, expression_df.columns]) < 1e-9
+        except ImportError:
+            print("pydeseq2 is not installed, normalization parity is not checked")
+            legacy_expression_df = expression_df
+
+        # the long format merge repeats a sample's expression for every maf row of the same gene and sample, 
+        # so it is compared on one row per mutated gene and sample (what the wide stats count)
+        melted_df = benchmark.run('legacy_merge', lambda: data_load.preprocess_and_combine_mutation_expression(
+            maf_df=maf_legacy_df.drop_duplicates(), expression_df=data_load.reformat_expression_data(legacy_expression_df)))
+        legacy_stats = benchmark.run('legacy_stats', lambda: {
+            target_gene: utils.generate_stats_per_gene(melted_df, target_gene, os.path.join(work_folder, 'legacy'))[0]
+            for target_gene in parity_targets})
+
+        for target_gene in parity_targets:
+            legacy_df = legacy_stats[target_gene].set_index('gene')
+            stats_df = stats_per_target[target_gene].set_index('gene').loc[legacy_df.index, legacy_df.columns]
+            parity[f'stats_{target_gene}'] = bool(np.allclose(stats_df.to_numpy(), legacy_df.to_numpy(), rtol=1e-7, atol=1e-12, equal_nan=True))
+
+    return benchmark.results, parity
+
+
+def compare_to_baseline(results, baseline, tolerance=1.5, min_seconds=0.05):
+    ''' stages more than tolerance times slower than in the baseline (ignoring stages under min_seconds) '''
+    regressions = {}
+    for stage, result in results.items():
+        if stage in baseline and max(result['seconds'], baseline[stage]['seconds']) >= min_seconds:
+            if result['seconds'] > tolerance * baseline[stage]['seconds']:
+                regressions[stage] = result['seconds'] / baseline[stage]['seconds']
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='time and memory-profile every pipeline stage on synthetic inputs')
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=250)
+    parser.add_argument('--mutation-rate', type=float, default=0.01, help='mean share of samples with a mutation per gene')
+    parser.add_argument('--targets', type=int, default=10)
+    parser.add_argument('--parity-targets', type=int, default=2, help='targets also run through the original stats code')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-legacy', action='store_true', help='skip the original implementations and the parity checks')
+    parser.add_argument('--no-memory', action='store_true', help='only time the stages, tracing memory slows them down')
+    parser.add_argument('--output', help='save the results as json, e.g. to use as a baseline later')
+    parser.add_argument('--baseline', help='json of an earlier run, stages slower than --tolerance times it fail')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--work-folder', help='keep the generated inputs and outputs here instead of a temporary folder')
+    args = parser.parse_args(argv)
+
+    # import the heavy libraries up front so the stage times do not include them
+    import matplotlib
+    matplotlib.use('Agg')
+    import scipy.stats, scipy.sparse, sklearn.metrics, seaborn
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix='respond_benchmark_')
+    os.makedirs(work_folder, exist_ok=True)
+    try:
+        results, parity = run_benchmark(args.genes, args.samples, args.mutation_rate, args.targets, args.parity_targets, work_folder,
+                                        seed=args.seed, legacy=not args.no_legacy, trace_memory=not args.no_memory)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    failures = [f"parity {check} failed" for check, passed in parity.items() if not passed]
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        for stage, slowdown in compare_to_baseline(results, baseline, tolerance=args.tolerance).items():
+            failures.append(f"{stage} is {slowdown:.2f}x slower than the baseline")
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({'settings': vars(args), 'results': results, 'parity': parity}, file, indent=1)
+
+    print('parity:', parity)
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import shutil
+import secrets
+import numpy as np
+import pandas as pd
+
+
+def read_file_hashes(index_path):
+    # an index that is missing or unreadable is treated as empty, its digests are recomputed
+    try:
+        with open(index_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def file_hash(file_path, cache_folder, block_size=1 << 24):
+    ''' sha256 of the file contents. The digest is remembered in the cache folder per
+     (path, size, mtime) so unchanged files are only read once
+     '''
+    stat = os.stat(file_path)
+    file_id = f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    index_path = os.path.join(cache_folder, 'file_hashes.json')
+    known_hashes = read_file_hashes(index_path)
+    if file_id in known_hashes:
+        return known_hashes[file_id]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+
+    # other jobs sharing the cache folder may have added digests meanwhile. The index is written to a
+    # temporary file and swapped in, so readers never see a half written one
+    known_hashes = read_file_hashes(index_path)
+    known_hashes[file_id] = digest.hexdigest()
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_path = f'{index_path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as file:
+        json.dump(known_hashes, file, indent=1)
+    os.replace(tmp_path, index_path)
+
+    return known_hashes[file_id]
+
+
+def cache_key(file_path, settings, cache_folder):
+    # key on the source file contents and the settings used to process it
+    settings_str = json.dumps(settings, sort_keys=True)
+    return hashlib.sha256(f"{file_hash(file_path, cache_folder)}:{settings_str}".encode()).hexdigest()[:32]
+
+
+def temporary_folder(folder):
+    ''' a new empty folder next to folder to write its next version into, see replace_folder.
+     Made with mkdir instead of tempfile.mkdtemp, so it gets the umask's mode like any other folder
+     rather than 0700, and other users of a shared cache can still read it once it is swapped in
+     '''
+    os.makedirs(os.path.dirname(os.path.abspath(folder)), exist_ok=True)
+    while True:
+        tmp_folder = f'{folder}.{secrets.token_hex(4)}'
+        try:
+            os.mkdir(tmp_folder)
+            return tmp_folder
+        except FileExistsError:
+            continue
+
+
+def replace_folder(tmp_folder, folder):
+    ''' make the finished tmp_folder (from temporary_folder) the new version of folder. Folders are written 
+     in full before they are swapped in, so a crash never leaves a half written one. folder is a symlink to 
+     its current version: the link is replaced in one atomic os.replace and only then is the old version 
+     removed, so concurrent readers never find folder missing or incomplete
+     '''
+    link = f'{folder}.link{os.getpid()}'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(tmp_folder), link)
+
+    previous = os.path.realpath(folder) if os.path.islink(folder) else None
+    if previous is None and os.path.isdir(folder):
+        # a plain folder written before folders were versioned cannot be swapped atomically, it is moved aside once
+        previous = f'{folder}.old{os.getpid()}'
+        os.replace(folder, previous)
+    os.replace(link, folder)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def save_matrix(df, key, cache_folder):
+    # store a numeric DataFrame as a raw .npy array plus its row and column labels
+    tmp_folder = temporary_folder(os.path.join(cache_folder, key))
+
+    np.save(os.path.join(tmp_folder, 'values.npy'), np.ascontiguousarray(df.to_numpy()))
+    finish_matrix(tmp_folder, df.index, df.columns, key, cache_folder)
+
+
+def create_matrix(key, cache_folder, shape, dtype):
+    ''' an empty writable memory-mapped matrix to fill in place, for matrices larger than memory.
+     Returns the temporary folder it lives in and the array; finish_matrix makes it the cached entry
+     '''
+    tmp_folder = temporary_folder(os.path.join(cache_folder, key))
+    values = np.lib.format.open_memmap(os.path.join(tmp_folder, 'values.npy'), mode='w+', dtype=dtype, shape=shape)
+    return tmp_folder, values
+
+
+def finish_matrix(tmp_folder, index, columns, key, cache_folder):
+    # the labels are written last, then the entry is swapped in
+    with open(os.path.join(tmp_folder, 'labels.json'), 'w') as file:
+        json.dump({'index': pd.Index(index).tolist(), 'columns': pd.Index(columns).tolist()}, file)
+    replace_folder(tmp_folder, os.path.join(cache_folder, key))
+
+
+def load_matrix(key, cache_folder):
+    ''' memory-map a cached matrix (read only, zero-copy). Returns None if it is not cached '''
+    entry_folder = os.path.join(cache_folder, key)
+    if not os.path.exists(os.path.join(entry_folder, 'labels.json')):
+        return None
+
+    values = np.load(os.path.join(entry_folder, 'values.npy'), mmap_mode='r')
+    with open(os.path.join(entry_folder, 'labels.json')) as file:
+        labels = json.load(file)
+
+    return pd.DataFrame(values, index=labels['index'], columns=labels['columns'], copy=False)
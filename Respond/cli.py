@@ -0,0 +1,226 @@
+import sys
+import time
+import atexit
+import argparse
+import builtins
+import constants
+
+# heavy libraries (scipy, sklearn, matplotlib, seaborn, statsmodels) are imported inside the functions
+# that use them, so a subcommand only pays for what it runs. `python cli.py --import-times stats`
+# shows where startup time goes
+
+import_times = {}
+
+
+def install_import_timer():
+    ''' time the first import of every module. Nested imports are counted in the time of
+     the outermost one, so the report adds up to the total import time
+     '''
+    original_import = builtins.__import__
+    depth = [0]
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level or depth[0] or name in sys.modules:
+            return original_import(name, globals, locals, fromlist, level)
+        depth[0] += 1
+        start = time.perf_counter()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            depth[0] -= 1
+            import_times[name] = import_times.get(name, 0) + time.perf_counter() - start
+
+    builtins.__import__ = timed_import
+    atexit.register(print_import_times)
+
+
+def print_import_times(top=20):
+    total = sum(import_times.values())
+    print(f"imports took {total:.3f}s in total")
+    for name, seconds in sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"{seconds:8.3f}s  {name}")
+
+
+def load_inputs(args):
+    import data_load
+    return data_load.load_wide_inputs(maf_file_path=constants.maf_file_path,
+                                      expression_file_path=constants.expression_file_path,
+                                      targets=args.genes,
+                                      cache_folder=constants.cache_folder,
+                                      dtype=constants.expression_dtype,
+                                      reference_folder=args.normalization_reference,
+                                      refresh_reference=args.refresh_normalization)
+
+
+def compute_stats(args):
+    import utils, results_store
+    expression_df, mutation_matrix = load_inputs(args)
+    store = results_store.ResultsStore(args.results_store) if args.results_store is not None else None
+    stats_per_target = utils.generate_stats_for_targets(expression_df=expression_df,
+                                                        mutation_matrix=mutation_matrix,
+                                                        output_folder=constants.output_folder if store is None else None,
+                                                        n_permutations=args.n_permutations,
+                                                        results_store=store)
+    return expression_df, mutation_matrix, stats_per_target
+
+
+def run_stats(args):
+    _, _, stats_per_target = compute_stats(args)
+    for target_gene, stats_df in stats_per_target.items():
+        print(f"{target_gene}: {stats_df.attrs.get('output_filename', args.results_store)}")
+
+
+def run_cluster(args):
+    import parallel
+    expression_df, mutation_matrix, stats_per_target = compute_stats(args)
+    results, _, _ = parallel.run_targets(expression_df=expression_df,
+                                      stats_per_target=stats_per_target,
+                                      mutation_matrix=mutation_matrix,
+                                      output_folder=constants.output_folder,
+                                      n_workers=args.n_workers,
+                                      backend=args.backend,
+                                      approx_threshold=constants.clustering_approx_threshold,
+                                      sweep_k_values=constants.threshold_sweep_k)
+    print({target_gene: result['gene_sil_score'] for target_gene, result in results.items()})
+
+
+def run_plot(args):
+    import parallel, render
+    expression_df, mutation_matrix, stats_per_target = compute_stats(args)
+    with render.PlotRenderer(n_workers=args.n_workers) as renderer:
+        for target_gene, stats_df in stats_per_target.items():
+            mutated_samples = mutation_matrix.index[mutation_matrix[target_gene]]
+            render.submit_stats_plots(renderer, expression_df, stats_df, stats_df.attrs.get('output_filename'), mutated_samples,
+                                      constants.output_folder, target_gene, volcano_mode=args.volcano_mode)
+
+        # clustering runs here serially, its heatmaps and dendrograms render alongside
+        def submit_cluster_plots(target_gene, result):
+            render.submit_cluster_plots(renderer, **result.pop('plot_inputs'), output_folder=constants.output_folder, target_gene=target_gene)
+
+        parallel.run_targets(expression_df=expression_df,
+                             stats_per_target=stats_per_target,
+                             mutation_matrix=mutation_matrix,
+                             output_folder=constants.output_folder,
+                             on_result=submit_cluster_plots,
+                             backend=constants.clustering_backend,
+                             approx_threshold=constants.clustering_approx_threshold,
+                             return_plot_inputs=True)
+
+
+def run_gsea_export(args):
+    import os
+    import gsea
+    # expression and mutations are loaded once, then the GCT, CLS and RNK files of every target are written in one pass
+    expression_df, mutation_matrix = load_inputs(args)
+    gsea_folder = os.path.join(constants.output_folder, 'GSEA')
+    gct_path, target_paths = gsea.export_gsea_inputs(expression_df, mutation_matrix, gsea_folder)
+    print(f"expression: {gct_path}")
+    for target_gene, (cls_path, rnk_path) in target_paths.items():
+        print(f"{target_gene}: {cls_path} {rnk_path}")
+
+
+def run_gsea(args):
+    import enrichment
+    _, _, stats_per_target = compute_stats(args)
+    results = enrichment.prerank_targets(stats_per_target=stats_per_target,
+                                         gene_sets=enrichment.read_gmt(args.gmt),
+                                         n_permutations=args.gsea_permutations,
+                                         n_workers=args.n_workers,
+                                         min_size=args.min_size,
+                                         max_size=args.max_size,
+                                         seed=args.seed,
+                                         output_folder=constants.output_folder)
+    for target_gene, result_df in results.items():
+        print(f"{target_gene}: {(result_df['fdr'] < 0.25).sum()} of {len(result_df)} gene sets with fdr < 0.25")
+
+
+def run_serve(args):
+    import service
+    # the expression matrix and mutation index stay loaded, answers are computed per request (see service.py)
+    service.serve(maf_file_path=args.maf, expression_file_path=args.expression, host=args.host, port=args.port,
+                  cache_folder=constants.cache_folder, dtype=constants.expression_dtype, cache_mb=args.cache_mb,
+                  reference_folder=args.normalization_reference, refresh_reference=args.refresh_normalization)
+
+
+def run_import_times(args):
+    # import every pipeline module the way the subcommands do, the report is printed at exit
+    import utils, data_load, mutation_index, parallel, render, gsea, enrichment, service
+
+
+commands = {'stats': run_stats,
+            'cluster': run_cluster,
+            'plot': run_plot,
+            'gsea-export': run_gsea_export,
+            'gsea': run_gsea,
+            'serve': run_serve,
+            'import-times': run_import_times}
+
+
+def parse_args(argv=None):
+    # options every subcommand shares, given after the subcommand name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--maf', default=constants.maf_file_path)
+    common.add_argument('--expression', default=constants.expression_file_path)
+    common.add_argument('--output-folder', default=constants.output_folder)
+    common.add_argument('--cache-folder', default=constants.cache_folder)
+    common.add_argument('--genes', nargs='+', default=constants.genes, help='target genes')
+    common.add_argument('--results-store', default=constants.results_store_path, help='sqlite file to store the stats in instead of csvs')
+    common.add_argument('--normalization-reference', default=constants.normalization_reference_folder,
+                        help='folder of the stored size factor reference new samples are normalized against')
+    common.add_argument('--refresh-normalization', action='store_true', default=constants.refresh_normalization_reference,
+                        help='refit the size factor reference on every sample')
+
+    parser = argparse.ArgumentParser(description='mutation vs expression analysis of target genes')
+    parser.add_argument('--import-times', action='store_true', help='print how long every module took to import')
+    parser.add_argument('--trace', default=constants.trace_file_path, help='json lines file to record the time and memory of every stage in')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    stats_parser = subparsers.add_parser('stats', parents=[common], help='logFC and p-values of every gene for every target')
+    cluster_parser = subparsers.add_parser('cluster', parents=[common], help='stats, then clustering of the top genes (no plots)')
+    plot_parser = subparsers.add_parser('plot', parents=[common], help='stats and clustering with every plot')
+    subparsers.add_parser('gsea-export', parents=[common], help='GCT expression, CLS label and preranked RNK files for GSEA')
+    gsea_parser = subparsers.add_parser('gsea', parents=[common], help='preranked GSEA of every target against a gmt of gene sets')
+    serve_parser = subparsers.add_parser('serve', parents=[common], help='local http service answering stats, heatmap and cluster queries per target')
+    subparsers.add_parser('import-times', parents=[common], help='only import the pipeline modules')
+
+    for subparser in (stats_parser, cluster_parser, plot_parser, gsea_parser):
+        subparser.add_argument('--n-permutations', type=int, default=constants.n_permutations)
+    cluster_parser.add_argument('--n-workers', type=int, default=constants.n_workers)
+    cluster_parser.add_argument('--backend', default=constants.clustering_backend, choices=['scipy', 'nn_chain'])
+    plot_parser.add_argument('--n-workers', type=int, default=constants.n_plot_workers)
+    gsea_parser.add_argument('--gmt', default=constants.gene_sets_file_path, required=constants.gene_sets_file_path is None)
+    gsea_parser.add_argument('--gsea-permutations', type=int, default=constants.gsea_permutations)
+    gsea_parser.add_argument('--n-workers', type=int, default=constants.n_workers)
+    gsea_parser.add_argument('--min-size', type=int, default=15)
+    gsea_parser.add_argument('--max-size', type=int, default=500)
+    gsea_parser.add_argument('--seed', type=int, default=None)
+    serve_parser.add_argument('--host', default=constants.service_host)
+    serve_parser.add_argument('--port', type=int, default=constants.service_port)
+    serve_parser.add_argument('--cache-mb', type=float, default=constants.service_cache_mb, help='memory the cached answers may take')
+    plot_parser.add_argument('--volcano-mode', default=constants.volcano_mode, choices=['scatter', 'density'])
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.import_times or args.command == 'import-times':
+        install_import_timer()
+
+    # the pipeline modules read their paths from constants
+    constants.maf_file_path = args.maf
+    constants.expression_file_path = args.expression
+    constants.output_folder = args.output_folder
+    constants.cache_folder = args.cache_folder
+
+    if args.trace is not None:
+        import instrument
+        instrument.enable(args.trace)
+        commands[args.command](args)
+        instrument.print_summary()
+    else:
+        commands[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,34 @@
-
 import os
-from scipy.cluster.hierarchy import fcluster, linkage, dendrogram
-import matplotlib.pyplot as plt
-from sklearn.metrics import silhouette_score, silhouette_samples
+import instrument
 import numpy as np
+import pandas as pd
 
-def evaluate_cluster_sil_score(df, row_clusters, col_clusters):
-    # Calculate silhouette scores
-    row_silhouette_score = silhouette_score(df, row_clusters)
-    col_silhouette_score = silhouette_score(df.T, col_clusters)
+@instrument.stage
+def evaluate_cluster_sil_score(df, row_clusters, col_clusters, row_distances=None, col_distances=None):
+    from scipy.spatial.distance import pdist, squareform
+    from sklearn.metrics import silhouette_score
+    # Calculate silhouette scores, reusing condensed euclidean distances when they are passed in
+    if row_distances is None:
+        row_distances = pdist(df)
+    if col_distances is None:
+        col_distances = pdist(df.T)
 
-    return row_silhouette_score, col_silhouette_score
+    row_silhouette_score = silhouette_score(squareform(row_distances), row_clusters, metric='precomputed')
+    col_silhouette_score = silhouette_score(squareform(col_distances), col_clusters, metric='precomputed')
 
+    return row_silhouette_score, col_silhouette_score
 
-def evaluate_cluster_sil_score_mutated_samples(df, col_clusters, mutated_samples):
-    # Calculate silhouette scores
-    col_silhouette_scores = silhouette_samples(df.T, col_clusters)
 
+@instrument.stage
+def evaluate_cluster_sil_score_mutated_samples(df, col_clusters, mutated_samples, col_silhouette_scores=None, col_distances=None):
     # Filter the data to keep only mutated samples
-    mutated_samples_set = set(mutated_samples)
-    mutated_indices = [i for i, sample_id in enumerate(df.columns) if sample_id in mutated_samples_set]
+    mutated_indices = np.flatnonzero(df.columns.isin(mutated_samples))
 
-    # Filter col_silhouette_scores for mutated samples
-    mutated_silhouette_scores = [col_silhouette_scores[i] for i in mutated_indices]
+    # reuse the per-sample scores if they were already computed, otherwise only score the mutated samples
+    if col_silhouette_scores is not None:
+        mutated_silhouette_scores = np.asarray(col_silhouette_scores)[mutated_indices]
+    else:
+        mutated_silhouette_scores = silhouette_subset(col_clusters, mutated_indices, distances=col_distances, data=df.T)
 
     # Calculate the average silhouette score for mutated samples
     avg_mutated_silhouette_score = np.mean(mutated_silhouette_scores)
@@ -30,19 +36,265 @@ def evaluate_cluster_sil_score_mutated_samples(df, col_clusters, mutated_samples
     return avg_mutated_silhouette_score
 
 
-# TODO: modify this function so that it is for one feature at a time (row or col)
-# and call it twice from the main file. 
-def hierarchical_clustering(expression_df_heatmap, output_folder, row_threshold, col_threshold, mutated_samples, target_gene):
+def condensed_distances(data, dtype=np.float32, block_size=1024):
+    # condensed euclidean distances (same layout as pdist) built block by block in dtype,
+    # so the float64 n x n intermediate is never materialized
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)
+    distances = np.empty(n * (n - 1) // 2, dtype=dtype)
+    squared_norms = (data ** 2).sum(axis=1)
+
+    position = 0
+    for start in range(0, n, block_size):
+        block = data[start:start + block_size]
+        block_distances = squared_norms[start:start + block_size, None] + squared_norms[None, :] - 2 * block @ data.T
+        np.sqrt(np.maximum(block_distances, 0, out=block_distances), out=block_distances)
+        for i, row in enumerate(block_distances, start=start):
+            distances[position:position + n - i - 1] = row[i + 1:]
+            position += n - i - 1
+
+    return distances
+
+
+def condensed_row_indices(n, x):
+    # positions in a condensed distance matrix of the distances between x and every point (x itself -> 0)
+    k = np.arange(n)
+    i, j = np.minimum(k, x), np.maximum(k, x)
+    indices = n * i - i * (i + 1) // 2 + j - i - 1
+    indices[x] = 0
+    return indices
+
+
+def silhouette_subset(labels, indices, distances=None, data=None):
+    ''' silhouette values (same as sklearn's silhouette_samples) of the points in indices only.
+     Distances from those points to every point come from the condensed distances when given, 
+     otherwise from the data, so the cost scales with len(indices) rather than with all points '''
+    from scipy.spatial.distance import cdist
+    labels = np.asarray(labels)
+    indices = np.asarray(indices, dtype=np.int64)
+    if distances is not None:
+        n = len(labels)
+        subset_distances = np.stack([distances[condensed_row_indices(n, i)] for i in indices]) if len(indices) else np.empty((0, n))
+        subset_distances[np.arange(len(indices)), indices] = 0
+    else:
+        data = np.asarray(data)
+        subset_distances = cdist(data[indices], data)
+
+    # summed distance from every subset point to each cluster
+    cluster_codes, cluster_sizes = np.unique(labels, return_inverse=True, return_counts=True)[1:]
+    cluster_sums = np.zeros((len(indices), len(cluster_sizes)))
+    for code in range(len(cluster_sizes)):
+        cluster_sums[:, code] = subset_distances[:, cluster_codes == code].sum(axis=1)
+
+    own = cluster_codes[indices]
+    own_sizes = cluster_sizes[own]
+    rows = np.arange(len(indices))
+
+    # mean distance to the rest of the own cluster, and to the nearest other cluster
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intra = cluster_sums[rows, own] / (own_sizes - 1)
+        inter_means = cluster_sums / cluster_sizes
+    inter_means[rows, own] = np.inf
+    inter = inter_means.min(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (inter - intra) / np.maximum(intra, inter)
+    # points alone in their cluster score 0, as in sklearn
+    return np.where(own_sizes > 1, np.nan_to_num(scores), 0.0)
+
+
+def nn_chain_ward(squared_distances, n, sizes=None):
+    ''' ward clustering with the nearest-neighbour-chain algorithm, updating the condensed squared 
+     distances in place (Lance-Williams). Returns the merges (a, b, height) in the order they were found, 
+     a and b are the points whose slot held the merged clusters
+     '''
+    sizes = np.ones(n, dtype=np.float64) if sizes is None else np.asarray(sizes, dtype=np.float64).copy()
+    active = np.ones(n, dtype=bool)
+    merges = []
+    chain = []
+
+    while len(merges) < n - 1:
+        if not chain:
+            chain.append(int(np.flatnonzero(active)[0]))
+
+        # grow the chain until two clusters are each other's nearest neighbour
+        while True:
+            x = chain[-1]
+            row = np.where(active, squared_distances[condensed_row_indices(n, x)], np.inf)
+            row[x] = np.inf
+            y = int(np.argmin(row))
+            if len(chain) > 1 and row[chain[-2]] <= row[y]:
+                y = chain[-2]
+                break
+            chain.append(y)
+
+        chain = chain[:-2]
+        x_indices = condensed_row_indices(n, x)
+        y_indices = condensed_row_indices(n, y)
+        d_xy = squared_distances[x_indices[y]]
+        merges.append((x, y, np.sqrt(max(float(d_xy), 0.0))))
+
+        # the merged cluster takes over slot x
+        others = active.copy()
+        others[[x, y]] = False
+        size_xy = sizes[x] + sizes[y]
+        squared_distances[x_indices[others]] = (
+            (sizes[x] + sizes[others]) * squared_distances[x_indices[others]]
+            + (sizes[y] + sizes[others]) * squared_distances[y_indices[others]]
+            - sizes[others] * d_xy) / (size_xy + sizes[others])
+        sizes[x] = size_xy
+        active[y] = False
+
+    return merges
+
+
+def merges_to_linkage(merges, n, leaf_counts=None):
+    ''' scipy style linkage matrix from (a, b, height) merges given in a valid order, where a and b 
+     are any point of the two merged clusters '''
+    parent = np.arange(2 * n - 1)
+    counts = np.concatenate([np.ones(n) if leaf_counts is None else leaf_counts, np.zeros(n - 1)])
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    linkage_matrix = np.empty((n - 1, 4))
+    for step, (a, b, height) in enumerate(merges):
+        root_a, root_b = find(a), find(b)
+        parent[root_a] = parent[root_b] = n + step
+        counts[n + step] = counts[root_a] + counts[root_b]
+        linkage_matrix[step] = [min(root_a, root_b), max(root_a, root_b), height, counts[n + step]]
+
+    return linkage_matrix
+
+
+def ward_linkage_nn_chain(data, dtype=np.float32):
+    # memory-bounded ward linkage on float32 condensed distances. Returns the linkage and the distances
+    distances = condensed_distances(data, dtype=dtype)
+    squared_distances = distances.astype(dtype) ** 2
+    merges = nn_chain_ward(squared_distances, len(data))
+    del squared_distances
+
+    # ward is reducible, so merges sorted by height form a valid tree (stable sort keeps ties in order)
+    merges = [merges[i] for i in np.argsort([height for _, _, height in merges], kind='stable')]
+    return merges_to_linkage(merges, len(data)), distances
+
+
+def ward_linkage_approximate(data, n_micro_clusters=2000, random_state=0):
+    ''' approximate ward linkage for very large inputs: points are first grouped into micro clusters 
+     with mini-batch k-means, each micro cluster is linked exactly, and the micro clusters are then 
+     linked by ward on their centroids weighted by their sizes. Heights are kept monotonic '''
+    from sklearn.cluster import MiniBatchKMeans
+
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)
+    # no more points than micro clusters: k-means would only put every point in its own cluster
+    if n <= n_micro_clusters:
+        return ward_linkage_nn_chain(data)[0]
+    micro_labels = MiniBatchKMeans(n_clusters=n_micro_clusters, random_state=random_state, n_init=3).fit_predict(data)
+    micro_clusters = [np.flatnonzero(micro_labels == label) for label in np.unique(micro_labels)]
+
+    merges = []
+    cluster_heights = []
+    for members in micro_clusters:
+        if len(members) == 1:
+            cluster_heights.append(0.0)
+            continue
+        member_linkage, _ = ward_linkage_nn_chain(data[members])
+        # rewrite the within cluster linkage as merges between original points
+        representative = list(members) + [None] * (len(members) - 1)
+        for step, (a, b, height, _) in enumerate(member_linkage):
+            representative[len(members) + step] = representative[int(a)]
+            merges.append((representative[int(a)], representative[int(b)], height))
+        cluster_heights.append(member_linkage[-1, 2])
+
+    # ward distance between clusters: 2 * n_a * n_b / (n_a + n_b) * |c_a - c_b|^2
+    sizes = np.array([len(members) for members in micro_clusters], dtype=np.float64)
+    centroids = np.array([data[members].mean(axis=0) for members in micro_clusters])
+    squared_distances = condensed_distances(centroids, dtype=np.float64) ** 2
+    i, j = np.triu_indices(len(sizes), k=1)
+    squared_distances *= 2 * sizes[i] * sizes[j] / (sizes[i] + sizes[j])
+    top_merges = nn_chain_ward(squared_distances, len(sizes), sizes=sizes)
+    top_merges = [top_merges[k] for k in np.argsort([height for _, _, height in top_merges], kind='stable')]
+
+    # a top level merge is never lower than the clusters it joins
+    floor = 0.0
+    for a, b, height in top_merges:
+        floor = max(floor, height, cluster_heights[a], cluster_heights[b])
+        merges.append((micro_clusters[a][0], micro_clusters[b][0], floor))
+
+    # every merge is now at least as high as the merges below it, so sorting keeps a valid tree
+    merges = [merges[k] for k in np.argsort([height for _, _, height in merges], kind='stable')]
+    return merges_to_linkage(merges, n)
+
+
+@instrument.stage
+def ward_linkage(data, backend='scipy', approx_threshold=20000):
+    ''' ward linkage of the rows of data and the condensed distances it was built from 
+     (None for the approximate path, whose distances are never materialized).
+     backend 'scipy' uses scipy's linkage, 'nn_chain' the float32 nearest-neighbour-chain above, 
+     which switches to ward_linkage_approximate for more than approx_threshold rows '''
+    from scipy.cluster.hierarchy import linkage
+    from scipy.spatial.distance import pdist
+    data = np.asarray(data)
+    if backend == 'scipy':
+        distances = pdist(data)
+        return linkage(distances, method='ward'), distances
+    if backend != 'nn_chain':
+        raise ValueError(f"unknown clustering backend {backend}")
+    if approx_threshold is not None and len(data) > approx_threshold:
+        return ward_linkage_approximate(data), None
+    return ward_linkage_nn_chain(data)
+
+
+def cluster_labels(expression_df_heatmap, row_threshold, col_threshold, mutated_samples, backend='scipy', approx_threshold=20000,
+                   return_distances=False):
+    ''' linkages, cluster labels and silhouette scores of the rows and columns, without writing anything.
+     returns row_linkage, col_linkage, row_clusters, col_clusters, row_score, col_score, mutated_col_score,
+     followed by the condensed row and column distances (None on the approximate path) with return_distances
+     '''
+    from scipy.cluster.hierarchy import fcluster
+    from scipy.spatial.distance import squareform
+    from sklearn.metrics import silhouette_score, silhouette_samples
+    # pairwise euclidean distances are computed once per axis and shared by the linkage and silhouette scores
     # Cluster the rows and columns using hierarchical clustering
-    row_linkage = linkage(expression_df_heatmap, method='ward')
-    col_linkage = linkage(expression_df_heatmap.T, method='ward')
+    row_linkage, row_distances = ward_linkage(expression_df_heatmap, backend=backend, approx_threshold=approx_threshold)
+    col_linkage, col_distances = ward_linkage(expression_df_heatmap.T, backend=backend, approx_threshold=approx_threshold)
 
     # Assign cluster labels using cluster
     row_clusters = fcluster(row_linkage, t=row_threshold, criterion='maxclust')
     col_clusters = fcluster(col_linkage, t=col_threshold, criterion='maxclust')
 
-    row_score, col_score = evaluate_cluster_sil_score(expression_df_heatmap, row_clusters, col_clusters)
-    mutated_col_score = evaluate_cluster_sil_score_mutated_samples(expression_df_heatmap, col_clusters, mutated_samples)
+    # the column score is the mean of the per-sample scores, which the mutated sample score reuses.
+    # without shared distances sklearn computes them from the data in bounded memory chunks
+    if row_distances is not None:
+        row_score = silhouette_score(squareform(row_distances), row_clusters, metric='precomputed')
+    else:
+        row_score = silhouette_score(expression_df_heatmap, row_clusters)
+    if col_distances is not None:
+        col_silhouette_scores = silhouette_samples(squareform(col_distances), col_clusters, metric='precomputed')
+        col_score = np.mean(col_silhouette_scores)
+    else:
+        col_silhouette_scores = None
+        col_score = silhouette_score(expression_df_heatmap.T, col_clusters)
+    mutated_col_score = evaluate_cluster_sil_score_mutated_samples(expression_df_heatmap, col_clusters, mutated_samples, 
+                                                                   col_silhouette_scores=col_silhouette_scores)
+
+    if return_distances:
+        return row_linkage, col_linkage, row_clusters, col_clusters, row_score, col_score, mutated_col_score, row_distances, col_distances
+    return row_linkage, col_linkage, row_clusters, col_clusters, row_score, col_score, mutated_col_score
+
+
+# TODO: modify this function so that it is for one feature at a time (row or col)
+# and call it twice from the main file. 
+@instrument.stage
+def hierarchical_clustering(expression_df_heatmap, output_folder, row_threshold, col_threshold, mutated_samples, target_gene,
+                            backend='scipy', approx_threshold=20000, return_distances=False):
+    row_linkage, col_linkage, row_clusters, col_clusters, row_score, col_score, mutated_col_score, row_distances, col_distances = cluster_labels(
+        expression_df_heatmap, row_threshold, col_threshold, mutated_samples, backend=backend, approx_threshold=approx_threshold,
+        return_distances=True)
 
     # Create dictionaries to store cluster information
     row_cluster_info = {f"Cluster {cluster}": expression_df_heatmap.index[row_clusters == cluster] for cluster in np.unique(row_clusters)}
@@ -70,34 +322,78 @@ def hierarchical_clustering(expression_df_heatmap, output_folder, row_threshold,
             file.write(f"{cluster}:\n")
             file.write(f"{', '.join(items)}\n\n")
     
+    if return_distances:
+        return row_linkage, col_linkage, row_cluster_info, col_cluster_info, row_score, col_score, mutated_col_score, row_distances, col_distances
     return row_linkage, col_linkage, row_cluster_info, col_cluster_info, row_score, col_score, mutated_col_score
 
 
+@instrument.stage
+def sweep_cluster_thresholds(expression_df_heatmap, mutated_samples, k_values=range(2, 11), axis='columns',
+                             backend='scipy', approx_threshold=20000, linkage_matrix=None, distances=None):
+    ''' build the ward linkage of one axis once, cut it at every number of clusters in k_values 
+     with a single cut_tree call and score each cut from the shared distances.
+     linkage_matrix and distances of the axis can be passed in when the clustering already built them.
+     returns a table with the silhouette score per k (and the mutated sample silhouette for columns)
+     '''
+    from scipy.cluster.hierarchy import cut_tree
+    from scipy.spatial.distance import squareform
+    from sklearn.metrics import silhouette_samples
+    data = expression_df_heatmap.T if axis == 'columns' else expression_df_heatmap
+    if linkage_matrix is None:
+        linkage_matrix, distances = ward_linkage(data, backend=backend, approx_threshold=approx_threshold)
+
+    # silhouette is only defined for 2 .. n-1 clusters
+    k_values = [k for k in k_values if 2 <= k < len(data)]
+    labels_per_k = cut_tree(linkage_matrix, n_clusters=k_values)
+    square_distances = squareform(distances) if distances is not None else None
+
+    rows = []
+    for i, k in enumerate(k_values):
+        labels = labels_per_k[:, i]
+        if square_distances is not None:
+            silhouette_scores = silhouette_samples(square_distances, labels, metric='precomputed')
+        else:
+            silhouette_scores = silhouette_samples(data, labels)
+
+        row = {'k': k, 'silhouette_score': np.mean(silhouette_scores)}
+        if axis == 'columns':
+            row['mutated_sample_silhouette_score'] = evaluate_cluster_sil_score_mutated_samples(
+                expression_df_heatmap, labels, mutated_samples, col_silhouette_scores=silhouette_scores)
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+@instrument.stage
 def plot_and_save_dendrograms(row_linkage, col_linkage, expression_df_heatmap, output_folder, target_gene):
-    # Plot the row dendrogram
-    plt.figure(figsize=(12, 10))
+    from scipy.cluster.hierarchy import dendrogram
+    from matplotlib.figure import Figure
+    # Plot the row dendrogram on its own figure, no pyplot global state so it can render in any worker
+    fig = Figure(figsize=(12, 10))
+    ax = fig.add_subplot()
     # play around with fig sizes 
     gene_plot = dendrogram(row_linkage, 
                            labels=expression_df_heatmap.index, 
                            truncate_mode='lastp', 
-                           p=int(0.75 * len(row_linkage)), show_leaf_counts=True)
-    plt.title('Row Dendrogram')
+                           p=int(0.75 * len(row_linkage)), show_leaf_counts=True,
+                           ax=ax)
+    ax.set_title('Row Dendrogram')
     
     # Save the row dendrogram plot to a file
     row_dendrogram_filename = f'{output_folder}/{target_gene}/row_dendrogram.png'
-    plt.savefig(row_dendrogram_filename)
-    plt.close()
+    fig.savefig(row_dendrogram_filename)
 
     # Plot the column dendrogram
     # play around with fig sizes 
-    plt.figure(figsize=(12, 10))
+    fig = Figure(figsize=(12, 10))
+    ax = fig.add_subplot()
     sample_plot = dendrogram(col_linkage, labels=expression_df_heatmap.columns, orientation='top', 
-                             truncate_mode='lastp', p=int(0.75 * len(row_linkage)), show_leaf_counts=True)
-    plt.title('Column Dendrogram')
+                             truncate_mode='lastp', p=int(0.75 * len(row_linkage)), show_leaf_counts=True,
+                             ax=ax)
+    ax.set_title('Column Dendrogram')
     
     # Save the column dendrogram plot to a file
     col_dendrogram_filename = f'{output_folder}/{target_gene}/col_dendrogram.png'
-    plt.savefig(col_dendrogram_filename)
-    plt.close()
+    fig.savefig(col_dendrogram_filename)
 
     return gene_plot, sample_plot
@@ -2,6 +2,45 @@
 maf_file_path = 'input_data/RESPOND_247_coding_final.maf'
 expression_file_path = 'input_data/Expression_remove_BE.txt'
 output_folder='output_data_v9'
+# 'wide' keeps expression as a dense gene x sample matrix, 'long' uses the original melt/merge route,
+# 'out_of_core' memory-maps the normalized matrix in the cache folder for cohorts larger than memory
+pipeline_mode = 'wide'
+# genes per block read, normalized and tested at a time in 'out_of_core' mode, bounds the peak memory
+out_of_core_block_size = 5000
+# normalized expression matrices are cached here between runs, set to None to disable
+cache_folder = 'cache'
+# 'float32' halves the memory of the expression matrix for large cohorts
+expression_dtype = 'float64'
+# number of worker processes for the per-target analyses, 1 runs them serially
+n_workers = 4
+# empirical permutation p-values per gene, useful for targets with few mutated samples. 0 disables
+n_permutations = 0
+# 'scipy' or 'nn_chain' (memory-bounded float32 ward, approximate above clustering_approx_threshold rows)
+clustering_backend = 'scipy'
+clustering_approx_threshold = 20000
+# numbers of clusters to score in a threshold sweep per target, e.g. list(range(2, 16)). None skips the sweep
+threshold_sweep_k = None
+# render volcano, histogram, boxplot, heatmap and dendrogram pngs per target in n_plot_workers processes (0 renders inline)
+make_plots = True
+n_plot_workers = 2
+# 'density' draws non-significant genes of the volcano plot as a hexbin raster, for genome-wide result sets
+volcano_mode = 'scatter'
+# gmt file of gene sets for the in-process preranked GSEA of every target (see enrichment.py). None skips it
+gene_sets_file_path = None
+gsea_permutations = 1000
+# json lines trace of the wall/cpu time, peak memory and rows of every stage (see instrument.py). None disables it
+trace_file_path = None
+# sqlite file (see results_store.py) that the stats of every target are stored in instead of a csv per target. None writes csvs
+results_store_path = None
+# folder the deseq2 size factor reference is kept in (see normalization.py): samples added to the expression file
+# are normalized against it without changing the size factors of earlier samples. None refits on every sample each run
+normalization_reference_folder = None
+# refit the reference on every sample once, e.g. after many samples were added
+refresh_normalization_reference = False
+# address of the local query service (see service.py) and the memory its cache of answers may take
+service_host = '127.0.0.1'
+service_port = 8765
+service_cache_mb = 256
 # genes = ['FOXA1',
 #         'GYPB', 
 #         'ID1', 
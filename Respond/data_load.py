@@ -1,28 +1,260 @@
-import utils
+import os
+import time
+import shutil
+import cache
+import instrument
+import mutation_index
+import normalization
+import selection
+import numpy as np
 import pandas as pd
-from pydeseq2 import preprocessing
-from scipy.stats import zscore
 
+@instrument.stage
 def load_maf_data(file_path, columns = ["Hugo_Symbol", "Tumor_Sample_Barcode"]):
     df = pd.read_csv(file_path, sep='\t', comment="#", usecols=columns)
     df.rename(columns={'Hugo_Symbol': 'gene', 'Tumor_Sample_Barcode': 'sample'}, inplace=True)
     df['mutation'] = 1
     return df
 
-def load_txt_file_into_dataframe(file_path):
-    # Read the .txt file into a pandas DataFrame
-    df = pd.read_csv(file_path, sep='\t')  # Adjust the separator if needed
+def build_mutation_matrix(maf_df, targets, samples=None):
+    ''' boolean sample x target matrix: True where the sample carries a mutation in the target gene.
+     samples defaults to every sample with sequencing data (appears in the maf)
+     '''
+    if samples is None:
+        samples = maf_df['sample'].unique()
+
+    target_mutations = maf_df[maf_df['gene'].isin(targets)].drop_duplicates(subset=['gene', 'sample'])
+    mutation_matrix = pd.crosstab(target_mutations['sample'], target_mutations['gene']).astype(bool)
+
+    return mutation_matrix.reindex(index=samples, columns=targets, fill_value=False)
+
+
+# bump when the normalization below changes so old cache entries are not reused
+normalization_settings = {'normalization': 'deseq2_norm', 'transform': 'log2(x + 1)'}
+
+
+def count_data_rows(file_path):
+    # number of lines after the header, used to preallocate the expression matrix
+    n_lines = 0
+    last_block = b'\n'
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 24), b''):
+            n_lines += block.count(b'\n')
+            last_block = block
+    # count a last line without a trailing newline
+    return n_lines + (not last_block.endswith(b'\n')) - 1
+
+
+def deseq2_logmeans(counts):
+    # per gene log geometric means, -inf for genes with a zero count
+    with np.errstate(divide='ignore'):
+        return np.log(counts).mean(axis=1)
+
+
+def deseq2_size_factors(counts, logmeans=None):
+    ''' median-of-ratios size factors per sample (column) of a gene x sample count matrix,
+     same as pydeseq2's deseq2_norm_fit/deseq2_norm_transform but without transposing.
+     logmeans of a stored reference (see normalization.py) normalizes the samples against it instead
+     '''
+    with np.errstate(divide='ignore'):
+        log_counts = np.log(counts)
+    if logmeans is None:
+        logmeans = log_counts.mean(axis=1)
+    filtered_genes = ~np.isinf(logmeans)
+
+    log_ratios = log_counts[filtered_genes]
+    log_ratios -= logmeans[filtered_genes, None]
+    return np.exp(np.median(log_ratios, axis=0))
+
+
+def deseq2_logmeans_blockwise(counts, block_size=5000):
+    logmeans = np.empty(counts.shape[0], dtype=counts.dtype)
+    for start in range(0, counts.shape[0], block_size):
+        logmeans[start:start + block_size] = deseq2_logmeans(counts[start:start + block_size])
+    return logmeans
+
+
+def deseq2_size_factors_blockwise(counts, block_size=5000, logmeans=None):
+    ''' deseq2_size_factors of a (memory-mapped) count matrix reading block_size genes at a time.
+     The median of a sample needs the log ratios of every gene, so they are gathered for as many 
+     samples at a time as fit in block_size x samples values. Same result as deseq2_size_factors
+     '''
+    n_genes, n_samples = counts.shape
+    if logmeans is None:
+        logmeans = deseq2_logmeans_blockwise(counts, block_size=block_size)
+    filtered_genes = np.flatnonzero(~np.isinf(logmeans))
+
+    size_factors = np.empty(n_samples, dtype=counts.dtype)
+    samples_per_block = max(1, block_size * n_samples // max(len(filtered_genes), 1))
+    for sample_start in range(0, n_samples, samples_per_block):
+        samples = slice(sample_start, min(sample_start + samples_per_block, n_samples))
+        log_ratios = np.empty((len(filtered_genes), samples.stop - samples.start), dtype=counts.dtype)
+        for start in range(0, len(filtered_genes), block_size):
+            genes = filtered_genes[start:start + block_size]
+            with np.errstate(divide='ignore'):
+                log_ratios[start:start + block_size] = np.log(counts[genes, samples])
+            log_ratios[start:start + block_size] -= logmeans[genes, None]
+        size_factors[samples] = np.exp(np.median(log_ratios, axis=0))
+    return size_factors
+
+
+def matrix_cache_key(file_path, dtype, reference, cache_folder):
+    # a matrix normalized against a size factor reference is only reused with the same reference
+    settings = {**normalization_settings, 'dtype': np.dtype(dtype).name}
+    if reference is not None:
+        settings['size_factor_reference'] = reference.digest()
+    return cache.cache_key(file_path, settings, cache_folder)
+
+
+def sample_size_factors(values, genes, samples, reference_folder=None, reference=None, block_size=None):
+    ''' deseq2 size factors of the samples (columns of values). With reference_folder they come from the
+     stored reference (see normalization.py), which is extended with new samples (or fitted) and saved.
+     block_size reads a memory-mapped matrix that many genes at a time. Returns the factors and the reference
+     '''
+    if reference_folder is None:
+        if block_size is None:
+            return deseq2_size_factors(values), None
+        return deseq2_size_factors_blockwise(values, block_size=block_size), None
+
+    reference = normalization.update_reference(reference, values, genes, samples, block_size=block_size)
+    reference.save(reference_folder)
+    return reference.factors(samples), reference
+
+
+@instrument.stage
+def load_txt_file_into_dataframe(file_path, cache_folder=None, dtype=np.float64, chunksize=5000, out_of_core=False,
+                                 reference_folder=None, refresh_reference=False):
+    ''' normalized, log2 transformed gene x sample matrix. With out_of_core the matrix is built in place in
+     a memory-mapped cache file chunksize genes at a time, so it never has to fit in memory.
+     reference_folder keeps the deseq2 size factors (see normalization.py): samples seen before keep theirs
+     and new samples are normalized against the stored reference. refresh_reference refits it on every sample
+     '''
+    if out_of_core and cache_folder is None:
+        raise ValueError("out of core loading needs a cache folder to keep the memory-mapped matrix in")
+
+    reference = None
+    if reference_folder is not None and not refresh_reference:
+        reference = normalization.SizeFactorReference.load(reference_folder)
+
+    # reuse the normalized, log2 transformed matrix from an earlier run if it is cached.
+    # a reference that is (re)fitted below is not known yet, so nothing cached can match it
+    key = None
+    if cache_folder is not None and (reference_folder is None or reference is not None):
+        key = matrix_cache_key(file_path, dtype, reference, cache_folder)
+        df = cache.load_matrix(key, cache_folder)
+        if df is not None:
+            return df
+
+    if out_of_core:
+        return load_txt_file_out_of_core(file_path, cache_folder, dtype=dtype, chunksize=chunksize,
+                                         reference_folder=reference_folder, reference=reference)
+
+    start = time.perf_counter()
+
+    # Read the .txt file in chunks of genes (rows) straight into a preallocated matrix
+    samples = pd.read_csv(file_path, sep='\t', nrows=0).columns  # Adjust the separator if needed
+    values = np.empty((count_data_rows(file_path), len(samples)), dtype=dtype)
+    genes = []
+    for chunk in pd.read_csv(file_path, sep='\t', chunksize=chunksize, dtype=dict.fromkeys(samples, dtype)):
+        values[len(genes):len(genes) + len(chunk)] = chunk.to_numpy()
+        genes.extend(chunk.index)
+    values = values[:len(genes)]
     
     # normalize to account for RNA sequencing depth (samples having different totals of RNA expression)
     # this allows us to make comparisons for the same gene across samples
-    df = preprocessing.deseq2_norm(df.T)[0].T
+    size_factors, reference = sample_size_factors(values, genes, samples, reference_folder=reference_folder, reference=reference)
+    values /= size_factors.astype(dtype)
     
     # take log2 of expression data to scale expression data. Reduces the effect of outliers
-    df = df.map(utils.log2)
+    values += 1
+    np.log2(values, out=values)
+
+    elapsed = time.perf_counter() - start
+    megabytes = os.path.getsize(file_path) / 1e6
+    print(f"loaded {len(genes)} genes x {len(samples)} samples ({megabytes:.1f} MB, {np.dtype(dtype).name}) in {elapsed:.2f}s: "
+          f"{len(genes) / elapsed:.0f} genes/s, {megabytes / elapsed:.1f} MB/s, {values.nbytes / 1e6:.1f} MB resident")
+
+    df = pd.DataFrame(values, index=genes, columns=samples, copy=False)
+
+    if cache_folder is not None:
+        key = matrix_cache_key(file_path, dtype, reference, cache_folder)
+        cache.save_matrix(df, key, cache_folder)
+        df = cache.load_matrix(key, cache_folder)
+
+    return df
+
+
+def load_txt_file_out_of_core(file_path, cache_folder, dtype=np.float64, chunksize=5000, reference_folder=None, reference=None):
+    ''' same matrix as load_txt_file_into_dataframe, streamed chunksize genes at a time into a memory-mapped
+     cache entry and normalized there in place. Returns the read only memory-mapped cache entry
+     '''
+    start = time.perf_counter()
+
+    samples = pd.read_csv(file_path, sep='\t', nrows=0).columns
+    n_rows = count_data_rows(file_path)
+    # the cache key can depend on a reference fitted below, the matrix is built under the file's hash until then
+    build_name = cache.file_hash(file_path, cache_folder)[:32]
+    tmp_folder, values = cache.create_matrix(build_name, cache_folder, (n_rows, len(samples)), dtype)
+    genes = []
+    for chunk in pd.read_csv(file_path, sep='\t', chunksize=chunksize, dtype=dict.fromkeys(samples, dtype)):
+        values[len(genes):len(genes) + len(chunk)] = chunk.to_numpy()
+        genes.extend(chunk.index)
+
+    if len(genes) < n_rows:
+        # blank lines were counted but not read, the genes are moved to a matrix of the right size
+        short_folder, short_values = cache.create_matrix(f'{build_name}.short', cache_folder, (len(genes), len(samples)), dtype)
+        for block_start in range(0, len(genes), chunksize):
+            short_values[block_start:block_start + chunksize] = values[block_start:block_start + chunksize]
+        del values
+        shutil.rmtree(tmp_folder)
+        tmp_folder, values = short_folder, short_values
 
+    # the same normalization and log2 transform as in memory, one block of genes at a time
+    size_factors, reference = sample_size_factors(values, genes, samples, reference_folder=reference_folder, reference=reference,
+                                                  block_size=chunksize)
+    size_factors = size_factors.astype(dtype)
+    for block_start in range(0, len(genes), chunksize):
+        block = values[block_start:block_start + chunksize]
+        block /= size_factors
+        block += 1
+        np.log2(block, out=block)
+    values.flush()
+    del values
+
+    key = matrix_cache_key(file_path, dtype, reference, cache_folder)
+    cache.finish_matrix(tmp_folder, genes, samples, key, cache_folder)
+    df = cache.load_matrix(key, cache_folder)
+
+    elapsed = time.perf_counter() - start
+    megabytes = os.path.getsize(file_path) / 1e6
+    print(f"loaded {len(genes)} genes x {len(samples)} samples ({megabytes:.1f} MB, {np.dtype(dtype).name}) out of core in {elapsed:.2f}s: "
+          f"{len(genes) / elapsed:.0f} genes/s, {megabytes / elapsed:.1f} MB/s, blocks of {chunksize} genes")
     return df
 
 
+@instrument.stage
+def load_wide_inputs(maf_file_path, expression_file_path, targets, cache_folder=None, dtype=np.float64, out_of_core=False, block_size=5000,
+                     reference_folder=None, refresh_reference=False):
+    ''' wide-format alternative to reformat_expression_data + preprocess_and_combine_mutation_expression.
+     returns the dense gene x sample expression matrix and a sample x target mutation matrix 
+     restricted to the samples with sequencing data that also have expression data.
+     out_of_core builds the expression matrix memory-mapped, block_size genes at a time.
+     reference_folder and refresh_reference as in load_txt_file_into_dataframe
+     '''
+    mutations = mutation_index.load_mutation_index(file_path=maf_file_path, cache_folder=cache_folder)
+    expression_df = load_txt_file_into_dataframe(file_path=expression_file_path, cache_folder=cache_folder, dtype=dtype,
+                                                 chunksize=block_size, out_of_core=out_of_core,
+                                                 reference_folder=reference_folder, refresh_reference=refresh_reference)
+
+    exon_seq_samples = expression_df.columns[expression_df.columns.isin(mutations.samples)]
+    print('fraction of samples filtered is', 1 - len(exon_seq_samples) / expression_df.shape[1])
+
+    mutation_matrix = mutations.mutation_matrix(targets, samples=exon_seq_samples)
+
+    return expression_df, mutation_matrix
+
+
+@instrument.stage
 def reformat_expression_data(df):
     # Combine column names and index names into rows for every element
     melted_df = pd.melt(df.reset_index(), id_vars=['index'], var_name='column', col_level=0)
@@ -33,6 +265,7 @@ def reformat_expression_data(df):
     return melted_df
 
 
+@instrument.stage
 def preprocess_and_combine_mutation_expression(maf_df, expression_df):
     ''' filter the expression data to those that have whole genome sequencing 
      i.e. appear in the mutation data frame (maf)
@@ -55,39 +288,26 @@ def preprocess_and_combine_mutation_expression(maf_df, expression_df):
 
     return express_mut_genes_df
 
+@instrument.stage
 def generate_expression_heatmap(expression_df, volcano_plot_df, n, top):
-    # Get the indices of the top n rows based on having smallest pvalues
-
-    if top == True: 
-        indices = volcano_plot_df['pvalue'].nsmallest(n).index
-    else:
-        indices = (-volcano_plot_df['pvalue']).nsmallest(n).index
-    
-    top_n_rows = volcano_plot_df.loc[indices].set_index('gene')
+    # Get the top n genes with the smallest (top) or largest pvalues, by partial selection instead of sorting
+    positions = selection.top_k_positions(volcano_plot_df['pvalue'].to_numpy(), n, largest=not top)
 
     # go back to the expression df and make a heatmap of the top n genes
-    expression_df_heatmap = expression_df.loc[top_n_rows.index]
-    
-    return expression_df_heatmap
+    return selection.gather_rows(expression_df, volcano_plot_df['gene'].to_numpy()[positions])
 
 
+@instrument.stage
 def generate_expression_heatmap_positive_negative_same(expression_df, volcano_plot_df, n, significance_threshold):
-    # small p value, positive fold change
-    positive_sig = volcano_plot_df[(volcano_plot_df['pvalue'] < significance_threshold)].sort_values('logFC', ascending=False).head(n)
-    positive_sig_expression = expression_df.loc[positive_sig['gene']]
-
-    # small p value, negative fold change
-    negative_sig = volcano_plot_df[(volcano_plot_df['pvalue'] < significance_threshold)].sort_values('logFC', ascending=True).head(n)
-    negative_sig_expression = expression_df.loc[negative_sig['gene']]
-
-    # non significant. highest p valyes 
-    non_sig= volcano_plot_df.sort_values(by=['pvalue'], ascending=[False]).head(n)
-    non_sig_expression = expression_df.loc[non_sig['gene']]
-
-    positive_negative_same_expression_df = pd.concat([positive_sig_expression, negative_sig_expression, non_sig_expression])
+    # small p value positive fold change, small p value negative fold change and the highest p values, in one selection
+    views = selection.select_top_genes(volcano_plot_df, n, significance_threshold=significance_threshold)
+    positive_sig = volcano_plot_df.iloc[views['positive']]
+    negative_sig = volcano_plot_df.iloc[views['negative']]
+    non_sig = volcano_plot_df.iloc[views['highest_pvalue']]
 
-    # Calculate z-score by row (gene)
-    positive_negative_same_expression_df = positive_negative_same_expression_df.apply(zscore, axis=1)
+    # z-score by row (gene), all rows at once
+    genes = np.concatenate([positive_sig['gene'].to_numpy(), negative_sig['gene'].to_numpy(), non_sig['gene'].to_numpy()])
+    positive_negative_same_expression_df = selection.gather_rows(expression_df, genes, zscore=True)
 
     return positive_negative_same_expression_df,  positive_sig, negative_sig, non_sig
 
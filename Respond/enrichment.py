@@ -0,0 +1,200 @@
+import os
+import instrument
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# preranked gene set enrichment (GSEA, Subramanian et al. 2005) in process, instead of writing .rnk files
+# for the external GSEA tool. A set's running sum only changes at its hits, so the enrichment score
+# is taken from the hit positions alone and all sets are scored at once as a padded sets x max size array
+
+# gene sets indexed against the ranked genes, set once per worker process
+shared_members = None
+shared_sizes = None
+
+
+def read_gmt(file_path):
+    ''' gene set name -> list of genes. every line of a gmt is name, description, then the genes, tab separated '''
+    gene_sets = {}
+    with open(file_path) as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > 2:
+                gene_sets[fields[0]] = [gene for gene in fields[2:] if gene]
+    return gene_sets
+
+
+def ranking_metric(stats_df):
+    # signed significance, the same metric the .rnk files use
+    pvalues = np.clip(stats_df['pvalue'].to_numpy(dtype=np.float64), np.finfo(np.float64).tiny, 1)
+    return np.sign(stats_df['logFC'].to_numpy(dtype=np.float64)) * -np.log10(pvalues)
+
+
+def index_gene_sets(gene_sets, genes, min_size=15, max_size=500):
+    ''' keep the sets with min_size to max_size of their genes in genes. Returns the set names,
+     their sizes and a sets x max size array of gene positions in genes, padded with len(genes)
+     '''
+    gene_codes = pd.Index(genes)
+    names, members = [], []
+    for name, set_genes in gene_sets.items():
+        codes = np.unique(gene_codes.get_indexer(list(set_genes)))
+        codes = codes[codes >= 0]
+        if min_size <= len(codes) <= max_size:
+            names.append(name)
+            members.append(codes)
+
+    sizes = np.array([len(codes) for codes in members], dtype=np.int64)
+    padded = np.full((len(members), sizes.max() if len(members) else 0), len(genes), dtype=np.int64)
+    for i, codes in enumerate(members):
+        padded[i, :len(codes)] = codes
+    return names, sizes, padded
+
+
+def enrichment_scores(member_ranks, sizes, weights):
+    ''' enrichment score of every set from the ranked positions of its genes (padded with len(weights)),
+     any leading batch dimensions are kept. weights are the |metric|^p of the ranked list
+     '''
+    n_genes = len(weights)
+    positions = np.sort(member_ranks, axis=-1)
+
+    # share of the set's weight seen right after each hit (padding adds no weight)
+    hit_steps = np.append(weights, 0)[positions]
+    hit_fraction = np.cumsum(hit_steps, axis=-1)
+    totals = np.maximum(hit_fraction[..., -1:], np.finfo(np.float64).tiny)
+    hit_fraction /= totals
+    hit_steps /= totals
+
+    # share of the misses ranked above each hit. padding counts every miss, so its running sum is 0
+    misses = positions - np.minimum(np.arange(positions.shape[-1]), sizes[..., None])
+    running = hit_fraction - misses / np.maximum(n_genes - sizes, 1)[..., None]
+
+    # the running sum peaks right after a hit and dips right before one
+    peaks = running.max(axis=-1, initial=0)
+    dips = (running - hit_steps).min(axis=-1, initial=0)
+    return np.where(peaks >= -dips, peaks, dips)
+
+
+def ranked_order(metric, weight=1):
+    ''' rank of every gene (0 is the highest metric) and the weights in ranked order '''
+    order = np.argsort(-metric, kind='stable')
+    ranks = np.empty(len(metric), dtype=np.int64)
+    ranks[order] = np.arange(len(metric))
+    return ranks, np.abs(metric[order]) ** weight
+
+
+def init_worker(members, sizes):
+    global shared_members, shared_sizes
+    shared_members, shared_sizes = members, sizes
+
+
+def null_enrichment_scores(weights, n_permutations, seed, members=None, sizes=None, block_size=1_000_000):
+    ''' enrichment scores of every set for n_permutations random gene rankings (gene label permutation).
+     permutations are scored a block at a time, so that a block has about block_size set members in total.
+     Returns a n_permutations x sets array
+     '''
+    if members is None:
+        members, sizes = shared_members, shared_sizes
+    rng = np.random.default_rng(seed)
+    n_genes = len(weights)
+    permutations_per_block = max(1, block_size // max(members.size, 1))
+
+    null_scores = []
+    for start in range(0, n_permutations, permutations_per_block):
+        n = min(permutations_per_block, n_permutations - start)
+        ranks = np.empty((n, n_genes + 1), dtype=np.int32)
+        for i in range(n):
+            ranks[i, :n_genes] = rng.permutation(n_genes)
+        # padding stays past the end of the ranked list
+        ranks[:, n_genes] = n_genes
+        null_scores.append(enrichment_scores(ranks[:, members], sizes, weights))
+    return np.concatenate(null_scores) if null_scores else np.empty((0, len(sizes)))
+
+
+def normalize_scores(scores, null_scores):
+    ''' NES: divide by the mean null score of the same sign, per set. Returns the NES, the normalized
+     null scores and the nominal p-values (share of same signed null scores at least as extreme)
+     '''
+    positive_null = null_scores >= 0
+    positive_mean = np.nanmean(np.where(positive_null, null_scores, np.nan), axis=0)
+    negative_mean = -np.nanmean(np.where(~positive_null, null_scores, np.nan), axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = np.where(scores >= 0, scores / positive_mean, scores / negative_mean)
+        normalized_null = np.where(positive_null, null_scores / positive_mean, null_scores / negative_mean)
+        pvalues = np.where(scores >= 0,
+                           (positive_null & (null_scores >= scores)).sum(axis=0) / positive_null.sum(axis=0),
+                           (~positive_null & (null_scores <= scores)).sum(axis=0) / (~positive_null).sum(axis=0))
+    return normalized, normalized_null, pvalues
+
+
+def fdr_qvalues(normalized, normalized_null):
+    ''' GSEA FDR of every set: share of null NES at least as extreme as its NES (of the same sign, all sets
+     pooled) over the share of observed NES at least as extreme, capped at 1
+     '''
+    qvalues = np.ones(len(normalized))
+    for sign in (1, -1):
+        null = np.sort(sign * normalized_null[sign * normalized_null >= 0])
+        observed = np.sort(sign * normalized[sign * normalized >= 0])
+        selected = sign * normalized >= 0
+        values = sign * normalized[selected]
+        if len(null) == 0 or len(observed) == 0:
+            continue
+        # shares of scores >= each value via binary search on the sorted scores
+        null_share = (len(null) - np.searchsorted(null, values, side='left')) / len(null)
+        observed_share = (len(observed) - np.searchsorted(observed, values, side='left')) / len(observed)
+        qvalues[selected] = np.minimum(null_share / observed_share, 1)
+    return qvalues
+
+
+@instrument.stage
+def prerank_targets(stats_per_target, gene_sets, n_permutations=1000, n_workers=1, batch_size=100,
+                    min_size=15, max_size=500, weight=1, seed=None, output_folder=None):
+    ''' preranked GSEA of every target in one call. stats_per_target is target -> stats df (gene, logFC, pvalue)
+     from the stats stage, gene_sets name -> genes (see read_gmt). The permutations of all targets are
+     spread over n_workers processes as jobs of batch_size permutations. Returns target -> df of gene_set, size,
+     es, nes, pvalue, fdr sorted by nes, and writes it per target when output_folder is given
+     '''
+    if not stats_per_target:
+        return {}
+    genes = next(iter(stats_per_target.values()))['gene']
+    names, sizes, members = index_gene_sets(gene_sets, genes, min_size=min_size, max_size=max_size)
+    if len(names) == 0:
+        raise ValueError(f"no gene set has between {min_size} and {max_size} genes in the ranked list")
+
+    # observed scores, and permutation jobs of batch_size per target
+    scores, weights, jobs = {}, {}, []
+    seeds = iter(np.random.SeedSequence(seed).spawn(len(stats_per_target) * (-(-n_permutations // batch_size))))
+    for target_gene, stats_df in stats_per_target.items():
+        metric = np.nan_to_num(ranking_metric(stats_df.set_index('gene').reindex(genes).reset_index()))
+        ranks, weights[target_gene] = ranked_order(metric, weight=weight)
+        scores[target_gene] = enrichment_scores(np.append(ranks, len(genes))[members], sizes, weights[target_gene])
+        for start in range(0, n_permutations, batch_size):
+            jobs.append((target_gene, min(batch_size, n_permutations - start), next(seeds)))
+
+    null_scores = {target_gene: [] for target_gene in stats_per_target}
+    if n_workers <= 1:
+        for target_gene, n, job_seed in jobs:
+            null_scores[target_gene].append(null_enrichment_scores(weights[target_gene], n, job_seed, members, sizes))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(members, sizes)) as executor:
+            futures = [(target_gene, executor.submit(null_enrichment_scores, weights[target_gene], n, job_seed))
+                       for target_gene, n, job_seed in jobs]
+            for target_gene, future in futures:
+                null_scores[target_gene].append(future.result())
+
+    results = {}
+    for target_gene in stats_per_target:
+        target_null = np.concatenate(null_scores[target_gene]) if null_scores[target_gene] else np.empty((0, len(names)))
+        normalized, normalized_null, pvalues = normalize_scores(scores[target_gene], target_null)
+        result_df = pd.DataFrame({'gene_set': names, 'size': sizes, 'es': scores[target_gene], 'nes': normalized,
+                                  'pvalue': pvalues, 'fdr': fdr_qvalues(normalized, normalized_null)})
+        results[target_gene] = result_df.sort_values('nes', ascending=False, ignore_index=True)
+
+        if output_folder is not None:
+            os.makedirs(f'{output_folder}/{target_gene}', exist_ok=True)
+            output_filename = f'{output_folder}/{target_gene}/preranked_gsea.csv'
+            print(f"outputting data to {output_filename}")
+            results[target_gene].to_csv(output_filename, index=False)
+            results[target_gene].attrs['output_filename'] = output_filename
+
+    return results
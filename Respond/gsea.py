@@ -1,71 +1,113 @@
-
-import data_load, constants 
+import data_load, constants, mutation_index, instrument
 import pandas as pd
 import numpy as np
 import os
 
-def create_gsea_expression_input(output_folder):
-    expression_df = data_load.load_txt_file_into_dataframe(file_path=constants.expression_file_path)
-    mutation_df = data_load.load_maf_data(file_path=constants.maf_file_path)
+@instrument.stage
+def write_gct(expression_df, output_path, chunksize=2000):
+    ''' stream a gene x sample matrix to a GCT file chunksize genes at a time,
+     so no second copy of the matrix (with the NAME and description columns) is built
+     '''
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as file:
+        file.write("#1.2\n")
+        file.write(f"{expression_df.shape[0]}\t{expression_df.shape[1]}\n")
 
-    # get expression data of individuals with at least one mutation (i.e. has sequencing data)
-    expression_df = expression_df.T[expression_df.T.index.isin(mutation_df['sample'].unique())].T
-    # Add a new column with 'NA' values at a specified position
-    position = 0
-    new_column_name = 'description'
-    expression_df.insert(position, new_column_name, 'NA')
+        for start in range(0, max(len(expression_df), 1), chunksize):
+            chunk = expression_df.iloc[start:start + chunksize]
+            chunk = pd.concat([pd.DataFrame({'NAME': chunk.index, 'description': 'NA'}, index=chunk.index), chunk], axis=1)
+            chunk.to_csv(file, index=False, sep='\t', header=start == 0, lineterminator='\n')
+    return output_path
 
-    # Reset the index and rename the index column
-    expression_df = expression_df.reset_index().rename(columns={'index': 'NAME'})
-    os.makedirs(output_folder, exist_ok=True)
 
-    output_path = f'{output_folder}/GSEA_expression_input.gct'
-    with open(output_path, 'w') as file:
-        file.write("#1.2\n")
-        file.write(f"{expression_df.shape[0]}\t{expression_df.shape[1]- 2}\n")
+def write_cls(mutated, output_path):
+    ''' CLS labels (1.0 mutated, 0.0 not) of the samples in GCT column order '''
+    mutation = np.asarray(mutated).astype(float)
 
-    # Save the DataFrame to a GCT file
-    expression_df.to_csv(output_path, index=False, sep='\t',  mode='a')
+    # check if first sample is 0.0 or 1.0 because this determines the order it needs to appear in cls file
+    if mutation[0] == 1.0:
+        second_line = f"#\t1.0\t0.0\n"
+    else:
+        second_line = f"#\t0.0\t1.0\n"
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as file:
+        file.write(f"{len(mutation)}\t{len(np.unique(mutation))}\t1\n")
+        file.write(second_line)
+        file.write('\t'.join(str(value) for value in mutation) + '\n')
     return output_path
 
-def create_gsea_expression_input_preranked(output_folder, target_gene, stats_path, logFC=1, pvalue=0.05):
-    stats_df=pd.read_csv(stats_path)
 
+def write_rnk(stats_df, output_path, logFC=1, pvalue=0.05):
     # filter cols
     stats_df = stats_df[(abs(stats_df['logFC']) >= logFC) & (stats_df['pvalue'] <+ pvalue)]
 
     # Extract required columns
-    stats_df = stats_df[['gene', 'logFC', 'pvalue']]
-    
+    stats_df = stats_df[['gene', 'logFC', 'pvalue']].copy()
+
     # Calculate the transformed expression
     stats_df['metric'] = np.sign(stats_df['logFC']) * (-np.log10(stats_df['pvalue']))
-    
-    output_filename=f'{output_folder}/{target_gene}/preranked_genes.rnk'
-    stats_df[['gene', 'metric']].to_csv(output_filename, sep='\t', index=False, header=False)
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    stats_df[['gene', 'metric']].to_csv(output_path, sep='\t', index=False, header=False)
+    return output_path
 
 
+@instrument.stage
+def export_gsea_inputs(expression_df, mutation_matrix, output_folder, stats_per_target=None, logFC=1, pvalue=0.05):
+    ''' GSEA inputs of every target in one pass: the shared GCT of the samples with sequencing data,
+     and per target its CLS labels and preranked RNK. expression_df and mutation_matrix as returned
+     by data_load.load_wide_inputs. stats_per_target (target -> stats df) is computed in memory
+     when not given. Returns the path of the GCT and a dict target -> (cls path, rnk path)
+     '''
+    import utils
+    expression_df = expression_df.loc[:, mutation_matrix.index]
+    gct_path = write_gct(expression_df, f'{output_folder}/GSEA_expression_input.gct')
 
+    if stats_per_target is None:
+        stats_per_target = utils.generate_stats_for_targets(expression_df=expression_df, mutation_matrix=mutation_matrix)
+
+    target_paths = {}
+    for target_gene in mutation_matrix.columns:
+        cls_path = write_cls(mutation_matrix[target_gene].to_numpy(), f'{output_folder}/{target_gene}/mutation_GSEA_input.cls')
+        rnk_path = None
+        if target_gene in stats_per_target:
+            rnk_path = write_rnk(stats_per_target[target_gene], f'{output_folder}/{target_gene}/preranked_genes.rnk', logFC=logFC, pvalue=pvalue)
+        target_paths[target_gene] = (cls_path, rnk_path)
+
+    return gct_path, target_paths
+
+
+@instrument.stage
+def create_gsea_expression_input(output_folder):
+    mutations = mutation_index.load_mutation_index(file_path=constants.maf_file_path, cache_folder=constants.cache_folder)
+    expression_df = data_load.load_txt_file_into_dataframe(file_path=constants.expression_file_path,
+                                                               cache_folder=constants.cache_folder,
+                                                               dtype=constants.expression_dtype,
+                                                               reference_folder=constants.normalization_reference_folder)
+
+    # get expression data of individuals with at least one mutation (i.e. has sequencing data)
+    expression_df = expression_df.loc[:, expression_df.columns.isin(mutations.samples)]
+
+    return write_gct(expression_df, f'{output_folder}/GSEA_expression_input.gct')
+
+@instrument.stage
+def create_gsea_expression_input_preranked(output_folder, target_gene, stats_path=None, logFC=1, pvalue=0.05, results_store=None):
+    # with a results store only the genes that pass the filter are read
+    if results_store is not None:
+        stats_df = results_store.read_target(target_gene, columns=['logFC', 'pvalue'], where='abs(logFC) >= ? AND pvalue < ?', params=(logFC, pvalue))
+    else:
+        stats_df=pd.read_csv(stats_path)
+    write_rnk(stats_df, f'{output_folder}/{target_gene}/preranked_genes.rnk', logFC=logFC, pvalue=pvalue)
+
+
+
+@instrument.stage
 def create_mutation_label_gsea(gsea_expression_path, output_folder, target_gene):
-    mutation_df = data_load.load_maf_data(file_path=constants.maf_file_path)
+    mutations = mutation_index.load_mutation_index(file_path=constants.maf_file_path, cache_folder=constants.cache_folder)
 
-    expression_df =  pd.read_csv(gsea_expression_path, sep='\t', skiprows=range(1, 2), header=1).drop(columns=['NAME', 'description'])
-    gsea_mutation_df= expression_df.T.reset_index(names='sample')[['sample']].merge(
-        mutation_df[mutation_df['gene']==target_gene].drop_duplicates(), on='sample', how='left')[['sample', 'mutation']].fillna(0)
+    # only the header line of the gct is needed to know the sample order
+    samples = pd.read_csv(gsea_expression_path, sep='\t', skiprows=2, nrows=0).columns.drop(['NAME', 'description'])
 
-    os.makedirs(f'{output_folder}/{target_gene}', exist_ok=True)
-    output_path=f'{output_folder}/{target_gene}/mutation_GSEA_input.cls'
-    
-    # check if first sample is 0.0 or 1.0 because this determines the order it needs to appear in cls file
-    gsea_mutation_df
-    if gsea_mutation_df['mutation'].iloc[0]==1.0:
-        second_line = f"#\t1.0\t0.0\n"
-    elif gsea_mutation_df['mutation'].iloc[0]==0.0:
-        second_line = f"#\t0.0\t1.0\n"
+    write_cls(samples.isin(mutations.samples_mutated_in(target_gene)), f'{output_folder}/{target_gene}/mutation_GSEA_input.cls')
 
-    with open(output_path, 'w') as file:
-        file.write(f"{gsea_mutation_df.shape[0]}\t{len(gsea_mutation_df['mutation'].unique())}\t1\n")
-        file.write(second_line)
-    
-    gsea_mutation_df[['mutation']].T.to_csv(output_path,
-                                        index=False, header=False, sep='\t', mode='a')
-    
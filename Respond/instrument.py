@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import inspect
+import functools
+
+# stage timing of the pipeline entry points. Decorated functions append one json line per call to the trace
+# file: stage, target, wall and cpu seconds, peak resident memory and rows of the result. Disabled (no trace
+# file) a call costs one extra check. Worker processes inherit the trace file and append to the same one
+
+trace_file_path = os.environ.get('RESPOND_TRACE_FILE')
+# stages running in this process, innermost last, with the peak memory seen before and inside their inner stages
+open_stages = []
+
+
+def enable(file_path):
+    ''' start a new trace in file_path. Set in the environment too so spawned worker processes trace as well '''
+    global trace_file_path
+    trace_file_path = file_path
+    os.environ['RESPOND_TRACE_FILE'] = file_path
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    open(file_path, 'w').close()
+
+
+def disable():
+    global trace_file_path
+    trace_file_path = None
+    os.environ.pop('RESPOND_TRACE_FILE', None)
+
+
+def reset_peak_rss():
+    # linux resets the high water mark of this process when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak since the process started, in kilobytes on linux
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def count_rows(result):
+    ''' rows of a stage's result: length of a data frame or array, summed over a dict of them,
+     or of the first element of a tuple
+     '''
+    if hasattr(result, 'shape') and len(getattr(result, 'shape')) > 0:
+        return int(result.shape[0])
+    if isinstance(result, dict):
+        counts = [count_rows(value) for value in result.values()]
+        return sum(count for count in counts if count is not None) if any(count is not None for count in counts) else len(result)
+    if isinstance(result, tuple) and result:
+        return count_rows(result[0])
+    return None
+
+
+def stage(function=None, name=None):
+    ''' decorator recording a call of function as a stage named name (module.function by default).
+     The target is taken from a target_gene argument when the function has one
+     '''
+    if function is None:
+        return functools.partial(stage, name=name)
+
+    stage_name = name or f'{function.__module__}.{function.__name__}'
+    parameters = list(inspect.signature(function).parameters)
+    target_position = parameters.index('target_gene') if 'target_gene' in parameters else None
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if trace_file_path is None:
+            return function(*args, **kwargs)
+
+        target_gene = kwargs.get('target_gene')
+        if target_gene is None and target_position is not None and len(args) > target_position:
+            target_gene = args[target_position]
+
+        record = {'stage': stage_name, 'target': target_gene, 'pid': os.getpid(), 'depth': len(open_stages)}
+        # the reset below would lose the enclosing stage's own peak so far, it is folded into that stage first
+        if open_stages:
+            open_stages[-1] = max(open_stages[-1], peak_rss_mb())
+        open_stages.append(0.0)
+        exact_peak = reset_peak_rss()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            result = function(*args, **kwargs)
+            record['rows'] = count_rows(result)
+            return result
+        except Exception as error:
+            record['error'] = type(error).__name__
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = time.process_time() - start_cpu
+            # resetting the peak inside an inner stage hides the inner peak from this one, so it is carried up
+            record['peak_rss_mb'] = max(peak_rss_mb(), open_stages.pop())
+            record['peak_rss_scope'] = 'stage' if exact_peak else 'process'
+            if open_stages:
+                open_stages[-1] = max(open_stages[-1], record['peak_rss_mb'])
+            write_record(record)
+
+    return wrapper
+
+
+def write_record(record):
+    # one write per line in append mode, so lines from several processes do not interleave
+    with open(trace_file_path, 'a') as file:
+        file.write(json.dumps(record, default=str) + '\n')
+
+
+def load_trace(file_path=None):
+    with open(file_path or trace_file_path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summarize(records):
+    ''' per stage: calls, total wall and cpu seconds (inner stages are included in their outer stage),
+     highest peak rss and total rows. Per target: wall seconds of its outermost stages
+     '''
+    stages, targets = {}, {}
+    for record in records:
+        summary = stages.setdefault(record['stage'], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0, 'rows': 0})
+        summary['calls'] += 1
+        summary['wall_seconds'] += record['wall_seconds']
+        summary['cpu_seconds'] += record['cpu_seconds']
+        summary['peak_rss_mb'] = max(summary['peak_rss_mb'], record['peak_rss_mb'])
+        summary['rows'] += record.get('rows') or 0
+        if record['target'] is not None and record['depth'] == 0:
+            targets[record['target']] = targets.get(record['target'], 0.0) + record['wall_seconds']
+    return stages, targets
+
+
+def print_summary(file_path=None):
+    if (file_path or trace_file_path) is None:
+        return
+    stages, targets = summarize(load_trace(file_path))
+    print(f"{'stage':<55} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'rows':>10}")
+    for stage_name, summary in sorted(stages.items(), key=lambda item: item[1]['wall_seconds'], reverse=True):
+        print(f"{stage_name:<55} {summary['calls']:>6} {summary['wall_seconds']:>9.3f} {summary['cpu_seconds']:>9.3f} "
+              f"{summary['peak_rss_mb']:>9.1f} {summary['rows']:>10}")
+    for target_gene, wall_seconds in sorted(targets.items(), key=lambda item: item[1], reverse=True):
+        print(f"{target_gene}: {wall_seconds:.3f}s")
@@ -1,6 +1,7 @@
 
 
-import plot, utils, data_load, clustering, constants 
+import plot, utils, data_load, clustering, constants, parallel, manifest, render, enrichment, instrument, results_store
+import pandas as pd
 import warnings
 import random
 
@@ -11,73 +12,191 @@ modules_to_ignore = ("seaborn", "sklearn")
 for module in modules_to_ignore:
     warnings.filterwarnings("ignore", category=FutureWarning, module=module)
 
-maf_df = data_load.load_maf_data(file_path=constants.maf_file_path)
-expression_df = data_load.load_txt_file_into_dataframe(file_path=constants.expression_file_path)
-expression_df_melted = data_load.reformat_expression_data(df=expression_df)
-mutation_expression_df_melted = data_load.preprocess_and_combine_mutation_expression(maf_df= maf_df, expression_df = expression_df_melted)
-
-sil_scores_genes = {}
+# time every stage when a trace file is set, summarized at the end of the run
+if constants.trace_file_path is not None:
+    instrument.enable(constants.trace_file_path)
+
+# targets whose outputs are up to date with the inputs and settings are skipped (see manifest.py)
+run_manifest = manifest.load_manifest(constants.output_folder)
+input_files = [constants.maf_file_path, constants.expression_file_path]
+hash_folder = constants.cache_folder or constants.output_folder
+stats_settings = {'pipeline_mode': constants.pipeline_mode, 
+                  'expression_dtype': constants.expression_dtype, 
+                  'n_permutations': constants.n_permutations,
+                  'results_store': constants.results_store_path,
+                  'normalization_reference': constants.normalization_reference_folder,
+                  'refresh_normalization_reference': constants.refresh_normalization_reference}
+cluster_settings = {'n': 100, 'row_threshold': 7, 'col_threshold': 2, 
+                    'backend': constants.clustering_backend, 'approx_threshold': constants.clustering_approx_threshold,
+                    'sweep_k_values': constants.threshold_sweep_k}
+# plots are their own stages, turning them on or changing how they look does not recompute the stats or clustering
+plot_settings = {'volcano_mode': constants.volcano_mode}
+
+stats_fingerprints = {target_gene: manifest.fingerprint(input_files, target_gene, stats_settings, hash_folder) for target_gene in constants.genes}
+cluster_fingerprints = {target_gene: manifest.fingerprint(input_files, target_gene, {**stats_settings, **cluster_settings}, hash_folder) for target_gene in constants.genes}
+stats_plot_fingerprints = {target_gene: manifest.fingerprint(input_files, target_gene, {**stats_settings, **plot_settings}, hash_folder) for target_gene in constants.genes}
+
+# one sqlite results store instead of a stats csv per target, when set
+store = results_store.ResultsStore(constants.results_store_path) if constants.results_store_path is not None else None
+stats_output_folder = constants.output_folder if store is None else None
+stored_targets = set(store.targets()) if store is not None else None
+
+# targets whose recorded stats csv (or store rows) are gone are recomputed
+stale_stats_targets = [target_gene for target_gene in constants.genes 
+                       if not manifest.is_up_to_date(run_manifest, target_gene, 'stats', stats_fingerprints[target_gene], stored_targets)]
+
+if constants.pipeline_mode == 'wide':
+    # dense gene x sample matrix and a sample-indexed mutation lookup, no melt/merge
+    expression_df, mutation_matrix = data_load.load_wide_inputs(maf_file_path=constants.maf_file_path, 
+                                                                expression_file_path=constants.expression_file_path, 
+                                                                targets=constants.genes,
+                                                                cache_folder=constants.cache_folder,
+                                                                dtype=constants.expression_dtype,
+                                                                reference_folder=constants.normalization_reference_folder,
+                                                                refresh_reference=constants.refresh_normalization_reference)
+
+    # calculate logfc, pvalue for every stale target gene in one pass, nothing to do when all are up to date
+    stats_per_target = {}
+    if stale_stats_targets:
+        stats_per_target = utils.generate_stats_for_targets(expression_df=expression_df, 
+                                                            mutation_matrix=mutation_matrix[stale_stats_targets], 
+                                                            output_folder=stats_output_folder,
+                                                            n_permutations=constants.n_permutations,
+                                                            results_store=store)
+    output_filenames = {target_gene: stats_df.attrs.get('output_filename') for target_gene, stats_df in stats_per_target.items()}
+elif constants.pipeline_mode == 'out_of_core':
+    # the normalized matrix is memory-mapped from the cache folder, and the stats are computed and written
+    # out_of_core_block_size genes at a time. The finished stats of every target are read back for the next stages
+    expression_df, mutation_matrix = data_load.load_wide_inputs(maf_file_path=constants.maf_file_path, 
+                                                                expression_file_path=constants.expression_file_path, 
+                                                                targets=constants.genes,
+                                                                cache_folder=constants.cache_folder,
+                                                                dtype=constants.expression_dtype,
+                                                                reference_folder=constants.normalization_reference_folder,
+                                                                refresh_reference=constants.refresh_normalization_reference,
+                                                                out_of_core=True,
+                                                                block_size=constants.out_of_core_block_size)
+
+    output_filenames = {}
+    if stale_stats_targets:
+        output_filenames = utils.generate_stats_for_targets_blockwise(expression_df=expression_df, 
+                                                                      mutation_matrix=mutation_matrix[stale_stats_targets], 
+                                                                      output_folder=stats_output_folder,
+                                                                      n_permutations=constants.n_permutations,
+                                                                      results_store=store,
+                                                                      block_size=constants.out_of_core_block_size)
+    stats_per_target = {target_gene: pd.read_csv(output_filename, float_precision='round_trip') if store is None else store.read_target(target_gene)
+                        for target_gene, output_filename in output_filenames.items()}
+else:
+    # original long format: melt expression and merge it with the maf, one target at a time
+    maf_df = data_load.load_maf_data(file_path=constants.maf_file_path)
+    expression_df = data_load.load_txt_file_into_dataframe(file_path=constants.expression_file_path, 
+                                                                 cache_folder=constants.cache_folder, 
+                                                                 dtype=constants.expression_dtype,
+                                                                reference_folder=constants.normalization_reference_folder,
+                                                                refresh_reference=constants.refresh_normalization_reference)
+    expression_df_melted = data_load.reformat_expression_data(df=expression_df)
+    mutation_expression_df_melted = data_load.preprocess_and_combine_mutation_expression(maf_df= maf_df, expression_df = expression_df_melted)
+    mutation_matrix = data_load.build_mutation_matrix(maf_df=maf_df, targets=constants.genes)
+
+    stats_per_target, output_filenames = {}, {}
+    for target_gene in stale_stats_targets:
+        stats_per_target[target_gene], _, output_filenames[target_gene] = utils.generate_stats_per_gene(
+            express_mut_genes_df=mutation_expression_df_melted, 
+            target_gene=target_gene,
+            output_folder=constants.output_folder)
+    if store is not None:
+        store.append(stats_per_target)
+
+for target_gene, output_filename in output_filenames.items():
+    manifest.mark_done(run_manifest, constants.output_folder, target_gene, 'stats', stats_fingerprints[target_gene], {'output_filename': output_filename})
+
+# targets the stats rejected (not in the expression data, mutated in none or all samples) are recorded as
+# skipped, so they are only tried again when the inputs or settings change
+for target_gene in stale_stats_targets:
+    if target_gene not in output_filenames:
+        manifest.mark_done(run_manifest, constants.output_folder, target_gene, 'stats', stats_fingerprints[target_gene], {'skipped': True})
+
+# reuse the stats of up to date targets from their csv
 for target_gene in constants.genes:
-    # calculate logfc, pvalue
-    volcano_plot_df, individuals_mutated_target_gene, volcano_input_filename = utils.generate_stats_per_gene(
-        express_mut_genes_df=mutation_expression_df_melted, 
-        target_gene=target_gene,
-        output_folder=target_gene)
-
-    # get top 100 genes with the lowest p-values
-    heatmap_data = data_load.generate_expression_heatmap(expression_df=expression_df, volcano_plot_df=volcano_plot_df, n=100)
-
-    mutated_status_df = utils.get_mutated_status(expression_df_heatmap=heatmap_data, 
-                                             individuals_mutated_target_gene=individuals_mutated_target_gene, 
-                                             output_folder=target_gene)
-
-    # cluster top 100 genes and samples
-    row_linkage, col_linkage, row_clusters, col_clusters, gene_sil_score, sample_sil_score = clustering.hierarchical_clustering(
-                                                                                                expression_df_heatmap=heatmap_data, 
-                                                                                                output_folder=target_gene,
-                                                                                                row_threshold=7, 
-                                                                                                col_threshold=2)
-
-    sil_scores_genes[target_gene]=gene_sil_score
-
+    if target_gene not in stats_per_target and manifest.is_up_to_date(run_manifest, target_gene, 'stats', stats_fingerprints[target_gene], stored_targets):
+        record = manifest.get_record(run_manifest, target_gene, 'stats')
+        if record.get('skipped'):
+            continue
+        output_filenames[target_gene] = record['output_filename']
+        stats_per_target[target_gene] = pd.read_csv(record['output_filename']) if store is None else store.read_target(target_gene)
+stats_per_target = {target_gene: stats_per_target[target_gene] for target_gene in constants.genes if target_gene in stats_per_target}
+
+# plots render in their own worker processes while the next stages compute
+renderer = render.PlotRenderer(n_workers=constants.n_plot_workers) if constants.make_plots else None
+
+def mark_done_after_plots(target_gene, stage, stage_fingerprint):
+    # a plot stage is recorded as soon as the plots just queued for it are written, so an interrupted run keeps
+    # every finished target. A stage with a failed plot stays unrecorded and is redone next run
+    def record_if_plotted(errors):
+        if not errors:
+            manifest.mark_done(run_manifest, constants.output_folder, target_gene, stage, stage_fingerprint)
+    renderer.when_done(record_if_plotted)
+
+
+if renderer is not None:
+    for target_gene, stats_df in stats_per_target.items():
+        if not manifest.is_up_to_date(run_manifest, target_gene, 'stats_plots', stats_plot_fingerprints[target_gene]):
+            render.submit_stats_plots(renderer, expression_df, stats_df, output_filenames[target_gene], 
+                                      mutation_matrix.index[mutation_matrix[target_gene]], constants.output_folder, target_gene,
+                                      volcano_mode=constants.volcano_mode)
+            mark_done_after_plots(target_gene, 'stats_plots', stats_plot_fingerprints[target_gene])
+
+# preranked GSEA of every stale target against the gene sets, all of them in one call
+if constants.gene_sets_file_path is not None:
+    enrichment_settings = {**stats_settings, 'gsea_permutations': constants.gsea_permutations}
+    enrichment_fingerprints = {target_gene: manifest.fingerprint(input_files + [constants.gene_sets_file_path], target_gene, enrichment_settings, hash_folder)
+                               for target_gene in stats_per_target}
+    stale_enrichment_targets = {target_gene: stats_df for target_gene, stats_df in stats_per_target.items()
+                                if not manifest.is_up_to_date(run_manifest, target_gene, 'enrichment', enrichment_fingerprints[target_gene])}
+    if stale_enrichment_targets:
+        enrichment_results = enrichment.prerank_targets(stats_per_target=stale_enrichment_targets, 
+                                                        gene_sets=enrichment.read_gmt(constants.gene_sets_file_path),
+                                                        n_permutations=constants.gsea_permutations,
+                                                        n_workers=constants.n_workers,
+                                                        output_folder=constants.output_folder)
+        for target_gene, result_df in enrichment_results.items():
+            manifest.mark_done(run_manifest, constants.output_folder, target_gene, 'enrichment', enrichment_fingerprints[target_gene],
+                               {'output_filename': result_df.attrs['output_filename']})
+
+# targets whose heatmap and dendrograms are missing are clustered again to draw them
+stale_cluster_targets = {target_gene: stats_df for target_gene, stats_df in stats_per_target.items() 
+                         if not manifest.is_up_to_date(run_manifest, target_gene, 'clustering', cluster_fingerprints[target_gene])
+                         or (renderer is not None and not manifest.is_up_to_date(run_manifest, target_gene, 'cluster_plots', cluster_fingerprints[target_gene]))}
+
+def record_clustering(target_gene, result):
+    # record the scores of a finished target, then queue its heatmap and dendrograms
+    plot_inputs = result.pop('plot_inputs', None)
+    manifest.mark_done(run_manifest, constants.output_folder, target_gene, 'clustering', cluster_fingerprints[target_gene], result)
+    if plot_inputs is not None:
+        render.submit_cluster_plots(renderer, **plot_inputs, output_folder=constants.output_folder, target_gene=target_gene)
+        mark_done_after_plots(target_gene, 'cluster_plots', cluster_fingerprints[target_gene])
+        # record the targets whose plots finished in the meantime
+        renderer.poll()
+
+
+# cluster the top genes of every stale target, targets are spread across worker processes
+target_results, failed_targets, _ = parallel.run_targets(expression_df=expression_df, 
+                                                         stats_per_target=stale_cluster_targets, 
+                                                         mutation_matrix=mutation_matrix, 
+                                                         output_folder=constants.output_folder,
+                                                         n_workers=constants.n_workers,
+                                                         on_result=record_clustering,
+                                                         return_plot_inputs=renderer is not None,
+                                                         **cluster_settings)
+
+if renderer is not None:
+    renderer.close()
+
+sil_scores_genes = {target_gene: (target_results[target_gene] if target_gene in target_results 
+                                  else manifest.get_record(run_manifest, target_gene, 'clustering'))['gene_sil_score'] 
+                    for target_gene in stats_per_target if target_gene not in failed_targets}
 
 print(sil_scores_genes)
 
-# # getting indviduals with mutation for heatmap
-# # TODO: combine this func into other functions
-# mutated_status_df = utils.get_mutated_status(expression_df_heatmap=heatmap_data, 
-#                                             individuals_mutated_target_gene=individuals_mutated_target_gene, 
-#                                             output_folder=target_gene)
-
-# # plot clustered heatmap
-# clustered_heatmap = plot.create_clustered_heatmap_and_save(heatmap_data, 
-#                                                       row_linkage, 
-#                                                       col_linkage,
-#                                                       mutated_status_df,
-#                                                       output_folder=target_gene)
-
-# # plot truncated dendograms 
-# row_dendrogram, col_dendrogram = clustering.plot_and_save_dendrograms(row_linkage, 
-#                                                            col_linkage, 
-#                                                            heatmap_data, 
-#                                                            output_folder=target_gene)
-
-# # plot histograms of adjusted and regular pvalues 
-# plot.histogram_of_column_and_save(volcano_plot_df, 'pvalue', output_folder=target_gene)
-# plot.histogram_of_column_and_save(volcano_plot_df, 'adjusted_pvalue', output_folder=target_gene)
-
-# # calculate significant genes determined by cutoffs
-# significant_genes_positive, significant_genes_negative  = plot.volcano_plot(input_file_path=volcano_input_filename, 
-#                                                                         yaxis='pvalue', 
-#                                                                         xaxis='logFC', 
-#                                                                         output_folder=target_gene,
-#                                                                         significance_threshold=0.05, 
-#                                                                         logfold_positive_threshold=2, 
-#                                                                         logfold_negative_threshold=-2)
-
-# # create box plots of significant genes (uoregulated and downregulated genes)
-# plot.create_gene_expression_boxplot(expression_df, significant_genes_positive, mutated_status_df, positive=1, output_folder=target_gene)
-# plot.create_gene_expression_boxplot(expression_df, significant_genes_negative, mutated_status_df, positive=0, output_folder=target_gene)
-
-# # Reset warnings to default behavior after the code block
-# warnings.resetwarnings()
\ No newline at end of file
+instrument.print_summary()
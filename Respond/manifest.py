@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+import cache
+
+
+def manifest_path(output_folder):
+    return os.path.join(output_folder, 'run_manifest.json')
+
+
+def load_manifest(output_folder):
+    ''' target -> stage -> {'fingerprint': ..., 'record': ...} of every stage that finished '''
+    if not os.path.exists(manifest_path(output_folder)):
+        return {}
+    with open(manifest_path(output_folder)) as file:
+        return json.load(file)
+
+
+def save_manifest(run_manifest, output_folder):
+    # write to a temporary file first so an interrupted run never leaves a truncated manifest
+    os.makedirs(output_folder, exist_ok=True)
+    tmp_path = f'{manifest_path(output_folder)}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as file:
+        json.dump(run_manifest, file, indent=1, default=float)
+    os.replace(tmp_path, manifest_path(output_folder))
+
+
+def fingerprint(input_files, target_gene, settings, cache_folder):
+    ''' content hash of the input files, the target and the settings (thresholds etc.) of a stage '''
+    file_hashes = [cache.file_hash(file_path, cache_folder) for file_path in input_files]
+    key = json.dumps({'files': file_hashes, 'target': target_gene, 'settings': settings}, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def outputs_exist(record, target_gene, stored_targets=None):
+    ''' the output file a stage recorded is still there. A None output_filename means the stats went
+     to a results store, then the target must still be among stored_targets (when they are given)
+     '''
+    if not isinstance(record, dict) or 'output_filename' not in record:
+        return True
+    if record['output_filename'] is None:
+        return stored_targets is None or target_gene in stored_targets
+    return os.path.exists(record['output_filename'])
+
+
+def is_up_to_date(run_manifest, target_gene, stage, stage_fingerprint, stored_targets=None):
+    # same inputs and settings as the finished stage, and its outputs were not removed since
+    entry = run_manifest.get(target_gene, {}).get(stage)
+    return (entry is not None and entry['fingerprint'] == stage_fingerprint 
+            and outputs_exist(entry['record'], target_gene, stored_targets))
+
+
+def get_record(run_manifest, target_gene, stage):
+    return run_manifest[target_gene][stage]['record']
+
+
+def mark_done(run_manifest, output_folder, target_gene, stage, stage_fingerprint, record=None):
+    ''' record a finished stage and save the manifest straight away so a crash keeps the progress '''
+    run_manifest.setdefault(target_gene, {})[stage] = {'fingerprint': stage_fingerprint, 'record': record}
+    save_manifest(run_manifest, output_folder)
@@ -0,0 +1,119 @@
+import os
+import json
+import cache
+import instrument
+import numpy as np
+import pandas as pd
+
+# bump when the index layout changes so old cache entries are not reused
+index_settings = {'index': 'sample_x_gene_csc', 'columns': ['Hugo_Symbol', 'Tumor_Sample_Barcode']}
+
+
+class MutationIndex:
+    ''' integer coded genes and samples with a sparse boolean sample x gene mutation matrix.
+     stored column-compressed so the samples mutated in a gene are one slice of the index
+     '''
+
+    def __init__(self, genes, samples, matrix):
+        from scipy import sparse
+        self.genes = np.asarray(genes, dtype=object)
+        self.samples = np.asarray(samples, dtype=object)
+        self.matrix = sparse.csc_matrix(matrix, dtype=bool)
+        self.gene_codes = {gene: code for code, gene in enumerate(self.genes)}
+        self.sample_codes = {sample: code for code, sample in enumerate(self.samples)}
+
+    def __contains__(self, gene):
+        return gene in self.gene_codes
+
+    def sample_codes_mutated_in(self, gene):
+        # integer codes of the samples with at least one mutation in gene
+        if gene not in self.gene_codes:
+            return np.empty(0, dtype=self.matrix.indices.dtype)
+        code = self.gene_codes[gene]
+        return self.matrix.indices[self.matrix.indptr[code]:self.matrix.indptr[code + 1]]
+
+    def samples_mutated_in(self, gene):
+        return self.samples[self.sample_codes_mutated_in(gene)]
+
+    def mutation_matrix(self, targets, samples=None):
+        ''' boolean sample x target DataFrame, same layout as data_load.build_mutation_matrix.
+         samples defaults to every sample with sequencing data (appears in the maf)
+         '''
+        if samples is None:
+            samples = self.samples
+        # position of every indexed sample in the requested samples, -1 if not requested
+        row_codes = pd.Index(self.samples).get_indexer(samples)
+        sample_positions = np.full(len(self.samples), -1)
+        sample_positions[row_codes[row_codes >= 0]] = np.flatnonzero(row_codes >= 0)
+
+        mutation_matrix = np.zeros((len(samples), len(targets)), dtype=bool)
+        for i, target_gene in enumerate(targets):
+            rows = sample_positions[self.sample_codes_mutated_in(target_gene)]
+            mutation_matrix[rows[rows >= 0], i] = True
+
+        return pd.DataFrame(mutation_matrix, index=pd.Index(samples, name='sample'), columns=pd.Index(targets, name='gene'))
+
+    def save(self, folder):
+        from scipy import sparse
+        tmp_folder = cache.temporary_folder(folder)
+        sparse.save_npz(os.path.join(tmp_folder, 'matrix.npz'), self.matrix)
+        with open(os.path.join(tmp_folder, 'labels.json'), 'w') as file:
+            json.dump({'genes': self.genes.tolist(), 'samples': self.samples.tolist()}, file)
+        cache.replace_folder(tmp_folder, folder)
+
+    @classmethod
+    def load(cls, folder):
+        from scipy import sparse
+        with open(os.path.join(folder, 'labels.json')) as file:
+            labels = json.load(file)
+        return cls(labels['genes'], labels['samples'], sparse.load_npz(os.path.join(folder, 'matrix.npz')))
+
+
+def build_mutation_index(file_path, columns=["Hugo_Symbol", "Tumor_Sample_Barcode"], chunksize=1_000_000):
+    ''' read only the gene and sample columns of the maf, chunksize rows at a time,
+     and integer code them as they stream in
+     '''
+    from scipy import sparse
+    gene_codes, sample_codes = {}, {}
+    gene_chunks, sample_chunks = [], []
+
+    for chunk in pd.read_csv(file_path, sep='\t', comment="#", usecols=columns, dtype=str, chunksize=chunksize):
+        for labels, codes, code_chunks in ((chunk[columns[0]], gene_codes, gene_chunks),
+                                           (chunk[columns[1]], sample_codes, sample_chunks)):
+            chunk_codes, uniques = pd.factorize(labels)
+            for label in uniques:
+                codes.setdefault(label, len(codes))
+            # translate chunk-local codes into global codes. Blank labels keep code -1 instead of
+            # wrapping around to the last label of the chunk
+            global_codes = np.array([codes[label] for label in uniques], dtype=np.int32)
+            code_chunks.append(np.where(chunk_codes >= 0, global_codes[chunk_codes], -1).astype(np.int32))
+
+    gene_rows = np.concatenate(gene_chunks) if gene_chunks else np.empty(0, dtype=np.int32)
+    sample_rows = np.concatenate(sample_chunks) if sample_chunks else np.empty(0, dtype=np.int32)
+
+    # rows without a gene or sample mark nothing as mutated, like build_mutation_matrix.
+    # a sample is still counted as sequenced when only its gene is blank
+    labelled = (gene_rows >= 0) & (sample_rows >= 0)
+    gene_rows, sample_rows = gene_rows[labelled], sample_rows[labelled]
+
+    # duplicate (sample, gene) pairs collapse into a single True entry
+    matrix = sparse.coo_matrix((np.ones(len(gene_rows), dtype=bool), (sample_rows, gene_rows)),
+                               shape=(len(sample_codes), len(gene_codes))).tocsc()
+    matrix.sum_duplicates()
+
+    return MutationIndex(list(gene_codes), list(sample_codes), matrix)
+
+
+@instrument.stage
+def load_mutation_index(file_path, cache_folder=None, chunksize=1_000_000):
+    # reuse the index built by an earlier run if it is cached
+    if cache_folder is None:
+        return build_mutation_index(file_path, chunksize=chunksize)
+
+    folder = os.path.join(cache_folder, cache.cache_key(file_path, index_settings, cache_folder))
+    if os.path.exists(os.path.join(folder, 'labels.json')):
+        return MutationIndex.load(folder)
+
+    index = build_mutation_index(file_path, chunksize=chunksize)
+    index.save(folder)
+    return index
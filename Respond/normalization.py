@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+import numpy as np
+import cache
+
+# deseq2 median-of-ratios size factors against a stored reference. The per gene log geometric means of the
+# cohort and the size factor of every sample are kept in a folder. Samples added later are normalized against
+# the stored geometric means, so existing samples keep their size factors and adding samples costs
+# O(genes x new samples) instead of refitting deseq2_norm on the whole matrix. A refresh refits on every sample,
+# which is the same as normalizing the full matrix from scratch
+
+
+class SizeFactorReference:
+    ''' per gene log geometric means (the reference sample) and the size factor of every sample seen so far '''
+
+    def __init__(self, genes, logmeans, size_factors=None):
+        self.genes = np.asarray(genes, dtype=object)
+        self.logmeans = np.asarray(logmeans)
+        self.size_factors = dict(size_factors or {})
+
+    @classmethod
+    def fit(cls, counts, genes, samples, block_size=None):
+        ''' reference of a gene x sample count matrix, every sample included. block_size reads a
+         (memory-mapped) matrix that many genes at a time
+         '''
+        import data_load
+        if block_size is None:
+            logmeans = data_load.deseq2_logmeans(counts)
+            size_factors = data_load.deseq2_size_factors(counts, logmeans=logmeans)
+        else:
+            logmeans = data_load.deseq2_logmeans_blockwise(counts, block_size=block_size)
+            size_factors = data_load.deseq2_size_factors_blockwise(counts, block_size=block_size, logmeans=logmeans)
+        return cls(genes, logmeans, zip(samples, size_factors.tolist()))
+
+    def add_samples(self, counts, samples, block_size=None):
+        ''' size factors of the samples (columns of counts, genes in reference order) that are not in the reference yet,
+         against the stored geometric means. Only their columns are read. Returns the new samples
+         '''
+        import data_load
+        new_positions = [position for position, sample in enumerate(samples) if sample not in self.size_factors]
+        if not new_positions:
+            return []
+
+        new_counts = np.ascontiguousarray(counts[:, new_positions])
+        if block_size is None:
+            size_factors = data_load.deseq2_size_factors(new_counts, logmeans=self.logmeans)
+        else:
+            size_factors = data_load.deseq2_size_factors_blockwise(new_counts, block_size=block_size, logmeans=self.logmeans)
+
+        new_samples = [samples[position] for position in new_positions]
+        self.size_factors.update(zip(new_samples, size_factors.tolist()))
+        return new_samples
+
+    def factors(self, samples):
+        return np.array([self.size_factors[sample] for sample in samples])
+
+    def digest(self):
+        # identifies the geometric means, normalized matrices cached against the reference are keyed on it
+        digest = hashlib.sha256(np.ascontiguousarray(self.logmeans).tobytes())
+        digest.update(json.dumps(self.genes.tolist()).encode())
+        return digest.hexdigest()[:16]
+
+    def save(self, folder):
+        tmp_folder = cache.temporary_folder(folder)
+        np.save(os.path.join(tmp_folder, 'logmeans.npy'), self.logmeans)
+        with open(os.path.join(tmp_folder, 'reference.json'), 'w') as file:
+            json.dump({'genes': self.genes.tolist(), 'size_factors': self.size_factors}, file)
+        cache.replace_folder(tmp_folder, folder)
+
+    @classmethod
+    def load(cls, folder):
+        # None when no reference has been saved in folder yet
+        if not os.path.exists(os.path.join(folder, 'reference.json')):
+            return None
+        with open(os.path.join(folder, 'reference.json')) as file:
+            reference = json.load(file)
+        return cls(reference['genes'], np.load(os.path.join(folder, 'logmeans.npy')), reference['size_factors'])
+
+
+def update_reference(reference, counts, genes, samples, block_size=None):
+    ''' the reference with size factors for every sample of counts: reference extended with the samples it has not
+     seen, or fitted on all of them when there is no reference (or a refresh dropped it) or the genes changed
+     '''
+    if reference is not None and not np.array_equal(reference.genes, np.asarray(genes, dtype=object)):
+        print("genes differ from the size factor reference, refitting it on every sample")
+        reference = None
+
+    if reference is None:
+        reference = SizeFactorReference.fit(counts, genes, samples, block_size=block_size)
+        print(f"fitted size factor reference on {len(samples)} samples")
+        return reference
+
+    new_samples = reference.add_samples(counts, samples, block_size=block_size)
+    print(f"size factors of {len(new_samples)} new samples against the stored reference, {len(samples) - len(new_samples)} reused")
+    return reference
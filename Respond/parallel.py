@@ -0,0 +1,181 @@
+import os
+import traceback
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import utils, data_load, clustering
+
+# expression matrix attached from shared memory, set once per worker process, and the block it lives in
+shared_expression_df = None
+shared_block = None
+
+
+def memmap_file(values):
+    # file of the memory-mapped array values is exactly (e.g. a cached matrix), None when it is not one
+    base = values
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    if base is None or base.filename is None or base.shape != values.shape or base.dtype != values.dtype:
+        return None
+    if not values.flags.c_contiguous or values.__array_interface__['data'][0] != base.__array_interface__['data'][0]:
+        return None
+    return base.filename
+
+
+def share_dataframe(df):
+    ''' copy a numeric DataFrame into a shared memory block once. Returns the block
+     (the caller must close and unlink it) and a small picklable description of it.
+     A DataFrame over a memory-mapped .npy file (e.g. out of core) is not copied, workers
+     map the same file and the returned block is None
+     '''
+    file_name = memmap_file(df.to_numpy())
+    if file_name is not None:
+        return None, {'file': file_name, 'index': df.index.tolist(), 'columns': df.columns.tolist()}
+
+    values = np.ascontiguousarray(df.to_numpy())
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+
+    description = {'name': shm.name, 'shape': values.shape, 'dtype': values.dtype.str,
+                   'index': df.index.tolist(), 'columns': df.columns.tolist()}
+    return shm, description
+
+
+def attach_dataframe(description):
+    ''' zero-copy, read only DataFrame over a block created by share_dataframe '''
+    if 'file' in description:
+        values = np.load(description['file'], mmap_mode='r')
+        return None, pd.DataFrame(values, index=description['index'], columns=description['columns'], copy=False)
+
+    shm = shared_memory.SharedMemory(name=description['name'])
+
+    values = np.ndarray(description['shape'], dtype=description['dtype'], buffer=shm.buf)
+    values.flags.writeable = False
+    return shm, pd.DataFrame(values, index=description['index'], columns=description['columns'], copy=False)
+
+
+def init_worker(description):
+    global shared_expression_df, shared_block
+    # keep a reference to the block so its buffer stays mapped for the life of the worker
+    shared_block, shared_expression_df = attach_dataframe(description)
+
+
+def analyze_target(expression_df, target_gene, volcano_plot_df, mutated_samples, output_folder,
+                   n=100, row_threshold=7, col_threshold=2, backend='scipy', approx_threshold=20000, sweep_k_values=None,
+                   return_plot_inputs=False):
+    os.makedirs(f'{output_folder}/{target_gene}', exist_ok=True)
+
+    # get top n genes with the lowest p-values
+    heatmap_data = data_load.generate_expression_heatmap(expression_df=expression_df, volcano_plot_df=volcano_plot_df, n=n, top=True)
+
+    mutated_status_df = utils.get_mutated_status(expression_df_heatmap=heatmap_data,
+                             individuals_mutated_target_gene=mutated_samples,
+                             output_folder=output_folder,
+                             target_gene=target_gene)
+
+    # cluster top n genes and samples
+    clustering_results = clustering.hierarchical_clustering(
+        expression_df_heatmap=heatmap_data,
+        output_folder=output_folder,
+        row_threshold=row_threshold,
+        col_threshold=col_threshold,
+        mutated_samples=mutated_samples,
+        target_gene=target_gene,
+        backend=backend,
+        approx_threshold=approx_threshold,
+        return_distances=True)
+    row_linkage, col_linkage, _, _, gene_sil_score, sample_sil_score, mutated_sample_sil_score, row_distances, col_distances = clustering_results
+
+    # silhouette scores of other cluster counts, to help choose the thresholds. The sweep cuts the linkages
+    # the clustering just built instead of rebuilding them
+    if sweep_k_values is not None:
+        for axis, linkage_matrix, distances in (('rows', row_linkage, row_distances), ('columns', col_linkage, col_distances)):
+            sweep_df = clustering.sweep_cluster_thresholds(heatmap_data, mutated_samples, k_values=sweep_k_values, axis=axis,
+                                                           linkage_matrix=linkage_matrix, distances=distances)
+            sweep_df.to_csv(f'{output_folder}/{target_gene}/{axis}_threshold_sweep.csv', index=False)
+
+    result = {'gene_sil_score': gene_sil_score,
+              'sample_sil_score': sample_sil_score,
+              'mutated_sample_sil_score': mutated_sample_sil_score}
+
+    # everything the clustered heatmap and dendrograms need, rendered by the caller (see render.py)
+    if return_plot_inputs:
+        result['plot_inputs'] = {'heatmap_data': heatmap_data, 'row_linkage': row_linkage, 
+                                 'col_linkage': col_linkage, 'mutated_status_df': mutated_status_df}
+
+    return result
+
+
+def run_target(target_gene, volcano_plot_df, mutated_samples, output_folder, analysis_kwargs, expression_df=None):
+    # one failing target must not abort the others, hand the error back instead of raising
+    if expression_df is None:
+        expression_df = shared_expression_df
+    try:
+        return target_gene, analyze_target(expression_df, target_gene, volcano_plot_df, mutated_samples, output_folder, **analysis_kwargs), None
+    except Exception:
+        return target_gene, None, traceback.format_exc()
+
+
+def run_in_pool(tasks, n_workers, description, collect):
+    ''' run_target for every task in a pool of n_workers processes, collecting each outcome.
+     Returns the tasks lost because the pool broke
+     '''
+    broken_tasks = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(description,)) as executor:
+        futures = [executor.submit(run_target, *task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                collect(future.result())
+            except BrokenProcessPool:
+                broken_tasks.append(task)
+            except Exception:
+                collect((task[0], None, traceback.format_exc()))
+    return broken_tasks
+
+
+def run_targets(expression_df, stats_per_target, mutation_matrix, output_folder, n_workers=1, on_result=None, **analysis_kwargs):
+    ''' run analyze_target for every target, spread across n_workers processes that share
+     the expression matrix read only. Returns the results and the analysis errors per target,
+     both in the order of stats_per_target, and the errors of on_result per target. 
+     on_result(target_gene, result) is called as soon as each target succeeds, e.g. to record progress.
+     A failing on_result does not fail the analysis of its target or stop the others
+     '''
+    tasks = [(target_gene, volcano_plot_df, list(mutation_matrix.index[mutation_matrix[target_gene]]), output_folder, analysis_kwargs)
+             for target_gene, volcano_plot_df in stats_per_target.items()]
+
+    results, errors, callback_errors = {}, {}, {}
+
+    def collect(outcome):
+        target_gene, result, error = outcome
+        if error is None:
+            results[target_gene] = result
+            if on_result is not None:
+                try:
+                    on_result(target_gene, result)
+                except Exception:
+                    callback_errors[target_gene] = traceback.format_exc()
+                    print(f"handling the result of {target_gene} failed:\n{callback_errors[target_gene]}")
+        else:
+            print(f"analysis of {target_gene} failed:\n{error}")
+            errors[target_gene] = error
+
+    if n_workers <= 1:
+        for task in tasks:
+            collect(run_target(*task, expression_df=expression_df))
+    else:
+        shm, description = share_dataframe(expression_df)
+        try:
+            broken_tasks = run_in_pool(tasks, n_workers, description, collect)
+            # a worker that died (e.g. out of memory) takes every unfinished target of the pool with it.
+            # those are rerun one per fresh worker, so only the target that kills its worker fails
+            for task in broken_tasks:
+                for lost_task in run_in_pool([task], 1, description, collect):
+                    collect((lost_task[0], None, f"worker process died while analyzing {lost_task[0]}"))
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return results, errors, callback_errors
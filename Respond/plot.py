@@ -1,9 +1,21 @@
 import os
+import instrument
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
 
+# every plot draws on its own Figure instead of pyplot's global state, so plots can render 
+# concurrently in worker processes (see render.py). Only seaborn's clustermap needs pyplot
+
+def select_significant_genes(df, yaxis, significance_threshold, logfold_positive_threshold, logfold_negative_threshold, n=25):
+    # Highlight significant points with large log-fold changes
+    # output top 25 only, to be able to see clearly on a plot
+    significant_genes_positive = df[(df[yaxis] < significance_threshold) & (df['logFC'] > logfold_positive_threshold)].sort_values(by='logFC', ascending=False).head(n)
+    significant_genes_negative = df[(df[yaxis] < significance_threshold) & (df['logFC'] < logfold_negative_threshold)].sort_values(by='logFC', ascending=True).head(n)
+
+    return significant_genes_positive, significant_genes_negative
+
+
+@instrument.stage
 def volcano_plot(input_file_path, 
                  yaxis, 
                  xaxis,
@@ -11,47 +23,68 @@ def volcano_plot(input_file_path,
                  target_gene,
                  significance_threshold, 
                  logfold_positive_threshold, 
-                 logfold_negative_threshold):
-    df = pd.read_csv(input_file_path)
+                 logfold_negative_threshold,
+                 stats_df=None,
+                 mode='scatter',
+                 gridsize=100,
+                 results_store=None):
+    ''' mode 'scatter' draws every gene as a marker. mode 'density' draws the genes that are not 
+     significant as a hexbin raster and only the significant ones as markers, so render time and 
+     file size stay flat however many genes there are. stats_df skips reading input_file_path,
+     as does results_store (the stats of target_gene are read from it) '''
+    from matplotlib.figure import Figure
+    if stats_df is not None:
+        df = stats_df.copy()
+    elif results_store is not None:
+        df = results_store.read_target(target_gene)
+    else:
+        df = pd.read_csv(input_file_path)
 
     # Apply -log10 transformation to the p-value
     df['-log10_pvalue'] = -np.log10(df[yaxis])
 
-    # Highlight significant points with large log-fold changes
-    # output top 25 only, to be able to see clearly on a plot
-    significant_genes_positive = df[(df[yaxis] < significance_threshold) & (df['logFC'] > logfold_positive_threshold)].sort_values(by='logFC', ascending=False).head(25)
-    significant_genes_negative = df[(df[yaxis] < significance_threshold) & (df['logFC'] < logfold_negative_threshold)].sort_values(by='logFC', ascending=True).head(25)
+    significant_genes_positive, significant_genes_negative = select_significant_genes(
+        df, yaxis, significance_threshold, logfold_positive_threshold, logfold_negative_threshold)
 
     # Clip outliers in 'logFC' column for the plot
     df['logFC'] = df['logFC'].clip(lower=-10, upper=10)
 
-    plt.scatter(x=df[xaxis], y=df['-log10_pvalue'], s=1, label='All Genes', alpha=0.5)
-    plt.scatter(x=significant_genes_positive[xaxis], y=significant_genes_positive['-log10_pvalue'], s=10, c='red', marker='^', label='Significant Genes (Positive LogFC)')
-    plt.scatter(x=significant_genes_negative[xaxis], y=significant_genes_negative['-log10_pvalue'], s=10, c='blue', marker='v', label='Significant Genes (Negative LogFC)')
-
-    plt.xlabel(xaxis)
-    plt.ylabel(f'-log10({yaxis})')
-    plt.title('Volcano Plot')
-    plt.axhline(-np.log10(significance_threshold), color='gray', linestyle='--', label=f'Significance Threshold ({significance_threshold})')
-    plt.axvline(logfold_positive_threshold, color='gray', linestyle='--', label=f'Positive Log-Fold Change Threshold ({logfold_positive_threshold})')
-    plt.axvline(logfold_negative_threshold, color='gray', linestyle='--', label=f'Negative Log-Fold Change Threshold ({logfold_negative_threshold})')
+    fig = Figure()
+    ax = fig.add_subplot()
+    if mode == 'density':
+        significant = (df[yaxis] < significance_threshold) & ((df['logFC'] > logfold_positive_threshold) | (df['logFC'] < logfold_negative_threshold))
+        ax.hexbin(x=df.loc[~significant, xaxis], y=df.loc[~significant, '-log10_pvalue'], gridsize=gridsize, 
+                  bins='log', mincnt=1, cmap='Blues', rasterized=True, label='Non-significant Genes (density)')
+        ax.scatter(x=df.loc[significant, xaxis], y=df.loc[significant, '-log10_pvalue'], s=3, c='black', label='Significant Genes')
+    else:
+        ax.scatter(x=df[xaxis], y=df['-log10_pvalue'], s=1, label='All Genes', alpha=0.5)
+    ax.scatter(x=significant_genes_positive[xaxis], y=significant_genes_positive['-log10_pvalue'], s=10, c='red', marker='^', label='Significant Genes (Positive LogFC)')
+    ax.scatter(x=significant_genes_negative[xaxis], y=significant_genes_negative['-log10_pvalue'], s=10, c='blue', marker='v', label='Significant Genes (Negative LogFC)')
+
+    ax.set_xlabel(xaxis)
+    ax.set_ylabel(f'-log10({yaxis})')
+    ax.set_title('Volcano Plot')
+    ax.axhline(-np.log10(significance_threshold), color='gray', linestyle='--', label=f'Significance Threshold ({significance_threshold})')
+    ax.axvline(logfold_positive_threshold, color='gray', linestyle='--', label=f'Positive Log-Fold Change Threshold ({logfold_positive_threshold})')
+    ax.axvline(logfold_negative_threshold, color='gray', linestyle='--', label=f'Negative Log-Fold Change Threshold ({logfold_negative_threshold})')
     
      # Create a separate legend outside the plot
-    fig = plt.gcf()
-    handles, labels = plt.gca().get_legend_handles_labels()
+    handles, labels = ax.get_legend_handles_labels()
     fig.legend(handles, labels, loc='center left', bbox_to_anchor=(1, 0.5))
     
     
     output_filename = f'{output_folder}/{target_gene}/volcano_plot.png'
-    plt.savefig(output_filename, bbox_inches='tight')
-    plt.close()
+    fig.savefig(output_filename, bbox_inches='tight')
     significant_genes_positive.to_csv(f'{output_folder}/{target_gene}/signif_genes_positive.csv')
     significant_genes_negative.to_csv(f'{output_folder}/{target_gene}/signif_genes_negative.csv')
 
     return significant_genes_positive, significant_genes_negative
 
 
+@instrument.stage
 def create_gene_expression_boxplot(expression_df, significant_genes_df, mutated_status_df, output_folder, target_gene, positive=1 ):
+    from matplotlib.figure import Figure
+    import seaborn as sns
 
     if len(significant_genes_df)==0:
         if positive ==1:
@@ -73,56 +106,67 @@ def create_gene_expression_boxplot(expression_df, significant_genes_df, mutated_
     boxplot_df.columns = ['Sample', 'Gene', 'Expression', 'Target Gene Mutation Status']
 
     # Set up the plot
-    plt.figure(figsize=(12, 8))
+    fig = Figure(figsize=(12, 8))
+    ax = fig.add_subplot()
 
     # Create a box plot with 'hue' for each gene and 'dodge' for Mutation Status 
-    sns.boxplot(x='Gene', y='Expression', data=boxplot_df, hue='Target Gene Mutation Status', dodge=True)
+    sns.boxplot(x='Gene', y='Expression', data=boxplot_df, hue='Target Gene Mutation Status', dodge=True, ax=ax)
 
     # Customize the plot
-    plt.xlabel('Gene')
-    plt.ylabel('Gene Expression')
-    plt.title('Box Plots of Gene Expression for Mutated and Non-Mutated Individuals')
+    ax.set_xlabel('Gene')
+    ax.set_ylabel('Gene Expression')
+    ax.set_title('Box Plots of Gene Expression for Mutated and Non-Mutated Individuals')
 
     # Rotate x-axis labels for better readability
-    plt.xticks(rotation=45, ha='right')
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_horizontalalignment('right')
 
     if positive == 1:
         output_filename = f'{output_folder}/{target_gene}/positive_genes_expression_boxplot.png'
     else:
         output_filename = f'{output_folder}/{target_gene}/negative_genes_expression_boxplot.png'
-    plt.savefig(output_filename)
-    plt.close()
+    fig.savefig(output_filename)
 
 
+@instrument.stage
 def histogram_of_column_and_save(df, column, output_folder, target_gene):
+    from matplotlib.figure import Figure
     # Plot the distribution of p-values
-    plt.figure(figsize=(10, 6))
-    plt.hist(df[column], bins=30, color='blue', edgecolor='black')
-    plt.title(f'Distribution of {column}')
-    plt.xlabel('P-values')
-    plt.ylabel('Frequency')
+    fig = Figure(figsize=(10, 6))
+    ax = fig.add_subplot()
+    ax.hist(df[column], bins=30, color='blue', edgecolor='black')
+    ax.set_title(f'Distribution of {column}')
+    ax.set_xlabel('P-values')
+    ax.set_ylabel('Frequency')
 
     output_filename = f'{output_folder}/{target_gene}/histogram_{column}.png'
     # Save the histogram plot to a file
-    plt.savefig(output_filename)
-    plt.close()
+    fig.savefig(output_filename)
 
+@instrument.stage
 def create_heatmap_and_save(expression_df_heatmap,
                             output_folder,
                             output_file_name,
                             target_gene
                             ):
-
-    sns.set(font_scale=1.0) 
-
-    # Create a clustered heatmap
-    ax = sns.heatmap(
-        expression_df_heatmap,
-        annot=False,
-        xticklabels=False, 
-        yticklabels=expression_df_heatmap.index,
-        cmap='coolwarm'
-    )
+    from matplotlib.figure import Figure
+    import seaborn as sns
+
+    # seaborn's default theme at font_scale 1, scoped to this plot instead of set globally
+    with sns.axes_style('darkgrid'), sns.plotting_context('notebook', font_scale=1.0):
+        fig = Figure()
+        ax = fig.add_subplot()
+
+        # Create a clustered heatmap
+        sns.heatmap(
+            expression_df_heatmap,
+            annot=False,
+            xticklabels=False, 
+            yticklabels=expression_df_heatmap.index,
+            cmap='coolwarm',
+            ax=ax
+        )
 
     #Set the size of the overall figure
     # sns_df.fig.set_size_inches(15, len(expression_df_heatmap) * 0.2)  
@@ -132,16 +176,14 @@ def create_heatmap_and_save(expression_df_heatmap,
     # sns_df.ax_heatmap.set_yticklabels(sns_df.ax_heatmap.get_yticklabels(), rotation=0)
     
     # Save the plot to a file
-    plt.savefig(output_filename, bbox_inches='tight')
-
-    # Close the plot to prevent displaying it in the notebook (optional)
-    plt.close()
+    fig.savefig(output_filename, bbox_inches='tight')
 
     return ax
     
     
 
 
+@instrument.stage
 def create_clustered_heatmap_and_save(expression_df_heatmap, 
                                       row_linkage, 
                                       col_linkage, 
@@ -149,24 +191,26 @@ def create_clustered_heatmap_and_save(expression_df_heatmap,
                                       output_folder,
                                       output_file_name,
                                       target_gene):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     # Group labels and colors for color bar
     type_map = {1: 'red', 0: 'yellow'}
 
-    sns.set(font_scale=1.0) 
-
-    # Create a clustered heatmap
-    clustered_df = sns.clustermap(
-        expression_df_heatmap,
-        row_linkage=row_linkage,
-        col_linkage=col_linkage,
-        cmap='viridis',
-        annot=False,
-        fmt=".1f",
-        linewidths=.5,
-        col_colors=sample_mutation_df.set_index('Sample')['Mutation Status'].map(type_map),
-        z_score=0,
-        cbar_kws={"shrink": 0.7, "aspect": 30}  # Adjust color bar size
-    )
+    # seaborn's default theme at font_scale 1, scoped to this plot instead of set globally
+    with sns.axes_style('darkgrid'), sns.plotting_context('notebook', font_scale=1.0):
+        # Create a clustered heatmap
+        clustered_df = sns.clustermap(
+            expression_df_heatmap,
+            row_linkage=row_linkage,
+            col_linkage=col_linkage,
+            cmap='viridis',
+            annot=False,
+            fmt=".1f",
+            linewidths=.5,
+            col_colors=sample_mutation_df.set_index('Sample')['Mutation Status'].map(type_map),
+            z_score=0,
+            cbar_kws={"shrink": 0.7, "aspect": 30}  # Adjust color bar size
+        )
 
     #Set the size of the overall figure
     clustered_df.fig.set_size_inches(15, len(expression_df_heatmap) * 0.2)  
@@ -178,7 +222,7 @@ def create_clustered_heatmap_and_save(expression_df_heatmap,
     # Save the plot to a file
     clustered_df.savefig(output_filename, bbox_inches='tight')
 
-    # Close the plot to prevent displaying it in the notebook (optional)
-    plt.close()
+    # clustermap always draws through pyplot, close only its own figure
+    plt.close(clustered_df.fig)
 
     return clustered_df
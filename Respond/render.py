@@ -0,0 +1,144 @@
+import traceback
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import plot, clustering
+
+
+def use_headless_backend():
+    # Agg renders straight to files, no display needed
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+
+def render_job(function, args, kwargs):
+    # a failing plot must not stop the others, hand the error back instead of raising
+    try:
+        function(*args, **kwargs)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+class PlotRenderer:
+    ''' renders plot jobs from a queue in a pool of worker processes on the Agg backend,
+     so plotting one target overlaps with computing the next. n_workers=0 renders
+     synchronously in this process instead
+     '''
+
+    def __init__(self, n_workers=2):
+        # only the processes that render switch to Agg, the backend of the caller is left alone unless it renders itself
+        if n_workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=use_headless_backend)
+        else:
+            use_headless_backend()
+            self.executor = None
+        self.jobs = []
+        # (jobs, callback) of every when_done whose jobs are not all finished yet
+        self.waiting = []
+        self.errors = {}
+
+    def submit(self, description, function, *args, **kwargs):
+        if self.executor is None:
+            self.jobs.append((description, render_job(function, args, kwargs)))
+        else:
+            self.jobs.append((description, self.executor.submit(render_job, function, args, kwargs)))
+
+    def when_done(self, callback):
+        ''' call callback(errors) once every job submitted since the last when_done has finished, with the
+         errors per failed job description (empty when all succeeded). Callbacks run in this process, 
+         from when_done, poll and close
+         '''
+        self.waiting.append((self.jobs, callback))
+        self.jobs = []
+        self.poll()
+
+    def job_error(self, description, job):
+        if self.executor is None:
+            error = job
+        else:
+            try:
+                error = job.result()
+            except Exception:
+                # the job never ran to completion, e.g. its worker died or its inputs could not be sent
+                error = traceback.format_exc()
+        if error is not None:
+            print(f"plot {description} failed:\n{error}")
+            self.errors[description] = error
+        return error
+
+    def finish(self, jobs, callback):
+        errors = {}
+        for description, job in jobs:
+            error = self.job_error(description, job)
+            if error is not None:
+                errors[description] = error
+        if callback is not None:
+            callback(errors)
+
+    def poll(self):
+        # run the callbacks whose jobs have all finished, without waiting for the others
+        still_waiting = []
+        for jobs, callback in self.waiting:
+            if self.executor is None or all(job.done() for _, job in jobs):
+                self.finish(jobs, callback)
+            else:
+                still_waiting.append((jobs, callback))
+        self.waiting = still_waiting
+
+    def close(self):
+        ''' wait for every queued plot and run the remaining callbacks. Returns the errors per failed job description '''
+        waiting, self.waiting = self.waiting + [(self.jobs, None)], []
+        self.jobs = []
+        for jobs, callback in waiting:
+            self.finish(jobs, callback)
+        if self.executor is not None:
+            self.executor.shutdown()
+        errors, self.errors = self.errors, {}
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def submit_stats_plots(renderer, expression_df, stats_df, volcano_input_filename, mutated_samples, output_folder, target_gene,
+                       significance_threshold=0.05, logfold_positive_threshold=2, logfold_negative_threshold=-2, volcano_mode='scatter'):
+    # plot histograms of adjusted and regular pvalues
+    for column in ('pvalue', 'adjusted_pvalue'):
+        renderer.submit(f'{target_gene} {column} histogram', plot.histogram_of_column_and_save,
+                        stats_df[[column]], column, output_folder=output_folder, target_gene=target_gene)
+
+    renderer.submit(f'{target_gene} volcano plot', plot.volcano_plot,
+                    input_file_path=volcano_input_filename,
+                    yaxis='pvalue',
+                    xaxis='logFC',
+                    output_folder=output_folder,
+                    target_gene=target_gene,
+                    significance_threshold=significance_threshold,
+                    logfold_positive_threshold=logfold_positive_threshold,
+                    logfold_negative_threshold=logfold_negative_threshold,
+                    stats_df=stats_df,
+                    mode=volcano_mode)
+
+    # box plots of the significant genes (upregulated and downregulated genes), only their rows are sent to the worker
+    significant_genes_positive, significant_genes_negative = plot.select_significant_genes(
+        stats_df, 'pvalue', significance_threshold, logfold_positive_threshold, logfold_negative_threshold)
+    mutated_status_df = pd.DataFrame({'Sample': expression_df.columns,
+                                      'Mutation Status': expression_df.columns.isin(mutated_samples).astype(int)})
+    for positive, significant_genes_df in ((1, significant_genes_positive), (0, significant_genes_negative)):
+        renderer.submit(f'{target_gene} boxplot positive={positive}', plot.create_gene_expression_boxplot,
+                        expression_df.loc[significant_genes_df['gene']], significant_genes_df, mutated_status_df,
+                        output_folder=output_folder, target_gene=target_gene, positive=positive)
+
+
+def submit_cluster_plots(renderer, heatmap_data, row_linkage, col_linkage, mutated_status_df, output_folder, target_gene):
+    # plot clustered heatmap
+    renderer.submit(f'{target_gene} clustered heatmap', plot.create_clustered_heatmap_and_save,
+                    heatmap_data, row_linkage, col_linkage, mutated_status_df,
+                    output_folder=output_folder, output_file_name='clustered_heatmap.png', target_gene=target_gene)
+
+    # plot truncated dendograms
+    renderer.submit(f'{target_gene} dendrograms', clustering.plot_and_save_dendrograms,
+                    row_linkage, col_linkage, heatmap_data, output_folder=output_folder, target_gene=target_gene)
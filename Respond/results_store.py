@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# one sqlite file for the stats of every target instead of a csv per target folder. Rows are indexed by
+# target and by gene, so questions like "every target where gene X has adjusted_pvalue < 0.05" read only
+# the matching rows:
+#
+#   store = ResultsStore('results.sqlite')
+#   store.query('gene = ? AND adjusted_pvalue < ?', ('TP53', 0.05))
+
+stats_columns = ['logFC', 'pvalue', 'effect_size', 'expression_mutated_mean', 'expression_nonmutated_mean', 'adjusted_pvalue']
+
+
+class ResultsStore:
+    ''' stats of every target in one sqlite file, appended a batch of targets per transaction '''
+
+    def __init__(self, file_path):
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path)
+        # readers are not blocked by a run appending, and appends are not synced to disk row by row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS targets (target TEXT PRIMARY KEY, n_mutated INTEGER, n_nonmutated INTEGER)')
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS stats (target TEXT NOT NULL, gene TEXT NOT NULL, "
+                                    f"{', '.join(f'{column} REAL' for column in stats_columns)})")
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS stats_target_gene ON stats (target, gene)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS stats_gene ON stats (gene)')
+        self.columns = [row[1] for row in self.connection.execute('PRAGMA table_info(stats)')]
+
+    def add_columns(self, columns):
+        # extra stats columns (e.g. permutation_pvalue) are added to the table the first time they are appended
+        with self.connection:
+            for column in columns:
+                if column not in self.columns:
+                    self.connection.execute(f'ALTER TABLE stats ADD COLUMN "{column}" REAL')
+                    self.columns.append(column)
+
+    def append(self, stats_per_target, n_mutated=None, replace=True):
+        ''' store the stats df of every target in stats_per_target (target -> df with a gene column) in one
+         transaction, replacing earlier rows of the same targets (added to them without replace, e.g. for
+         the later blocks of genes of an out-of-core run). n_mutated is target -> (mutated, non-mutated) counts
+         '''
+        n_mutated = n_mutated or {}
+        for stats_df in stats_per_target.values():
+            self.add_columns([column for column in stats_df.columns if column != 'gene'])
+
+        with self.connection:
+            for target_gene, stats_df in stats_per_target.items():
+                if replace:
+                    self.connection.execute('DELETE FROM stats WHERE target = ?', (target_gene,))
+                columns = ['gene'] + [column for column in stats_df.columns if column != 'gene']
+                quoted = ', '.join(f'"{column}"' for column in columns)
+                rows = ((target_gene, *row) for row in stats_df[columns].itertuples(index=False, name=None))
+                self.connection.executemany(f'INSERT INTO stats (target, {quoted}) VALUES ({", ".join(["?"] * (len(columns) + 1))})', rows)
+                counts = n_mutated.get(target_gene, (None, None))
+                self.connection.execute('INSERT OR REPLACE INTO targets VALUES (?, ?, ?)', (target_gene, *counts))
+
+    def set_values(self, target_gene, column, genes, values):
+        # fill one column of rows already stored, e.g. adjusted pvalues known only once every gene is appended
+        self.add_columns([column])
+        with self.connection:
+            self.connection.executemany(f'UPDATE stats SET "{column}" = ? WHERE target = ? AND gene = ?',
+                                        ((None if np.isnan(value) else float(value), target_gene, gene) for gene, value in zip(genes, values)))
+
+    def targets(self):
+        return [row[0] for row in self.connection.execute('SELECT target FROM targets ORDER BY rowid')]
+
+    def query(self, where=None, params=(), columns=None):
+        ''' rows of every target matching the sql condition where (with ? placeholders filled from params),
+         only the given columns. Conditions on target and gene use the indexes
+         '''
+        selected = ', '.join(['target', 'gene'] + [f'"{column}"' for column in (columns or self.columns[2:]) if column not in ('target', 'gene')])
+        sql = f'SELECT {selected} FROM stats' + (f' WHERE {where}' if where else '') + ' ORDER BY rowid'
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def read_target(self, target_gene, columns=None, where=None, params=()):
+        # stats of one target in the same layout as its csv, rows in the order they were appended
+        condition = 'target = ?' + (f' AND ({where})' if where else '')
+        return self.query(condition, (target_gene, *params), columns=columns).drop(columns='target')
+
+    def targets_where(self, gene, column='adjusted_pvalue', threshold=0.05):
+        # every target where gene has column < threshold
+        return self.query(f'gene = ? AND "{column}" < ?', (gene, threshold))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+# top-k selection over the stats arrays with a partial sort (argpartition) instead of sorting whole stats
+# frames, and row z-scores as one array operation. Ties keep the earlier row, like nsmallest/nlargest
+
+
+def top_k_positions(values, k, largest=False, mask=None):
+    ''' positions of the k smallest (largest) values, in order. NaNs and rows outside mask are never selected '''
+    values = np.asarray(values, dtype=np.float64)
+    keep = ~np.isnan(values)
+    if mask is not None:
+        keep &= mask
+    candidates = np.flatnonzero(keep)
+    keys = -values[candidates] if largest else values[candidates]
+
+    if k < len(candidates):
+        # everything strictly below the k-th key, then the earliest rows equal to it
+        kth = np.partition(keys, k - 1)[k - 1]
+        below = keys < kth
+        equal = np.flatnonzero(keys == kth)[:k - below.sum()]
+        chosen = np.concatenate([np.flatnonzero(below), equal])
+        candidates, keys = candidates[chosen], keys[chosen]
+
+    return candidates[np.lexsort((candidates, keys))][:k]
+
+
+def select_top_genes(stats_df, n, significance_threshold=0.05):
+    ''' the views heatmaps are built from, as row positions in stats_df:
+     lowest_pvalue, highest_pvalue, and among the genes with pvalue < significance_threshold
+     positive (highest logFC first) and negative (lowest logFC first)
+     '''
+    pvalues = stats_df['pvalue'].to_numpy(dtype=np.float64)
+    logfc = stats_df['logFC'].to_numpy(dtype=np.float64)
+    significant = pvalues < significance_threshold
+
+    return {'lowest_pvalue': top_k_positions(pvalues, n),
+            'highest_pvalue': top_k_positions(pvalues, n, largest=True),
+            'positive': top_k_positions(logfc, n, largest=True, mask=significant),
+            'negative': top_k_positions(logfc, n, mask=significant)}
+
+
+def zscore_rows(values, ddof=0):
+    # same as scipy.stats.zscore(axis=1), rows without variance become nan
+    values = np.asarray(values, dtype=np.float64)
+    mean = values.mean(axis=1, keepdims=True)
+    std = values.std(axis=1, ddof=ddof, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - mean) / std
+
+
+def gather_rows(expression_df, genes, zscore=False):
+    ''' expression rows of genes taken by integer position, optionally z-scored per row '''
+    positions = expression_df.index.get_indexer(genes)
+    if (positions < 0).any():
+        raise KeyError(f"{list(np.asarray(genes)[positions < 0])} not in the expression data")
+
+    values = np.take(expression_df.to_numpy(), positions, axis=0)
+    if zscore:
+        values = zscore_rows(values)
+    return pd.DataFrame(values, index=pd.Index(genes, name=expression_df.index.name), columns=expression_df.columns)
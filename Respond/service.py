@@ -0,0 +1,270 @@
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs, unquote
+import numpy as np
+import pandas as pd
+import data_load, mutation_index, utils, clustering, selection
+
+# local http service answering questions about single targets without rerunning the pipeline. The normalized
+# expression matrix, its row ranks and the mutation index are loaded once and stay in memory, and every answer
+# is kept in a size bounded LRU cache, so a repeated question is a dictionary lookup:
+#
+#   GET /targets                                          targets with mutations in the expression samples
+#   GET /stats/KMT2D?limit=50&format=csv                  rank-sum stats (lowest pvalue first when limited)
+#   GET /heatmap/KMT2D?n=100&zscore=1                     expression of the top n genes
+#   GET /clusters/KMT2D?n=100&row_threshold=7&col_threshold=2
+#   GET /cache                                            cache size and hit counts
+#
+# started with `python cli.py serve --maf ... --expression ...`. Only GET, answers are json (or csv for stats)
+
+
+class LRUCache:
+    ''' encoded responses by key, least recently used dropped once together they take more than max_bytes '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        # value is (content type, body bytes). Bodies larger than the whole cache are not kept
+        size = len(value[1])
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.n_bytes -= len(self.entries.pop(key)[1])
+        self.entries[key] = value
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes:
+            _, (_, body) = self.entries.popitem(last=False)
+            self.n_bytes -= len(body)
+
+    def info(self):
+        return {'entries': len(self.entries), 'bytes': self.n_bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class UnknownTarget(LookupError):
+    ''' a target the service has no answer for, answered with 404 '''
+
+
+class UnknownEndpoint(LookupError):
+    ''' a path that is not one of the endpoints above, answered with 404 '''
+
+
+class BadParameter(ValueError):
+    ''' an invalid query parameter, answered with 400 '''
+
+
+def int_param(query, name, default, minimum=1):
+    value = query.get(name, [default])[0]
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BadParameter(f"{name} must be an integer, got {value!r}")
+    if value < minimum:
+        raise BadParameter(f"{name} must be at least {minimum}, got {value}")
+    return value
+
+
+def bool_param(query, name, default=False):
+    return query.get(name, [str(default)])[0].lower() in ('1', 'true', 'yes')
+
+
+def to_json(data):
+    # nan and inf (e.g. z-scores of rows without variance) are not valid json, sent as null
+    return json.dumps(data, allow_nan=False, default=str).encode()
+
+
+def records(values):
+    return [[None if not np.isfinite(value) else float(value) for value in row] for row in np.asarray(values, dtype=np.float64)]
+
+
+class AnalysisService:
+    ''' answers for single targets from the resident expression matrix and mutation index '''
+
+    def __init__(self, expression_df, mutations, cache_mb=256):
+        # one contiguous copy of the matrix, genes sorted and the samples with sequencing data first. The stats
+        # are tested on a view of its first columns, in the layout generate_stats_for_targets uses. Heatmaps are
+        # taken from all of it, like the pipeline does, with the samples put back in file order
+        sequenced = expression_df.columns.isin(mutations.samples)
+        gene_order = np.argsort(expression_df.index.to_numpy(), kind='stable')
+        sample_order = np.concatenate([np.flatnonzero(sequenced), np.flatnonzero(~sequenced)])
+        values = np.ascontiguousarray(expression_df.to_numpy()[np.ix_(gene_order, sample_order)])
+        genes, samples = expression_df.index[gene_order], expression_df.columns[sample_order]
+        self.heatmap_df = pd.DataFrame(values, index=genes, columns=samples, copy=False)
+        self.expression_df = pd.DataFrame(values[:, :sequenced.sum()], index=genes, columns=samples[:sequenced.sum()], copy=False)
+        self.file_order = np.argsort(sample_order)
+        self.mutations = mutations
+        # everything the stats share across targets, so a request only does the two matrix products of its target
+        self.values = self.expression_df.to_numpy()
+        self.row_sums = self.values.sum(axis=1, keepdims=True)
+        self.ranks = utils.rank_rows(self.values)
+        self.cache = LRUCache(int(cache_mb * 1024 * 1024))
+        # answers being computed, so identical requests arriving together wait for one computation
+        self.pending = {}
+        self.targets = [gene for gene in mutations.genes if gene in self.expression_df.index]
+
+    def mutation_matrix(self, target_gene):
+        if target_gene not in self.mutations or target_gene not in self.expression_df.index:
+            raise UnknownTarget(f"{target_gene} not in expression data or no mutations with this gene exist")
+        mutation_matrix = self.mutations.mutation_matrix([target_gene], samples=self.expression_df.columns)
+        n_mutated = int(mutation_matrix[target_gene].sum())
+        if n_mutated == 0 or n_mutated == len(mutation_matrix):
+            raise UnknownTarget(f"{target_gene} is mutated in none or all of the expression samples")
+        return mutation_matrix
+
+    def stats(self, target_gene):
+        # same table as generate_stats_for_targets, without copying the expression matrix per request
+        mutation_matrix = self.mutation_matrix(target_gene)
+        stats = utils.calculate_ranksum_stats_batch(self.values, mutation_matrix[[target_gene]].to_numpy(), ranks=self.ranks, row_sums=self.row_sums)
+        stats_df = pd.DataFrame({'gene': self.expression_df.index, **{column: values[:, 0] for column, values in stats.items()}})
+        stats_df['adjusted_pvalue'] = utils.calculate_adjusted_pvalue(stats_df['pvalue'].values)
+        return stats_df, mutation_matrix
+
+    def heatmap(self, target_gene, n, zscore=False):
+        # the top n genes by pvalue, the heatmap the pipeline clusters
+        stats_df, mutation_matrix = self.stats(target_gene)
+        genes = stats_df['gene'].to_numpy()[selection.top_k_positions(stats_df['pvalue'].to_numpy(), n)]
+        heatmap_data = selection.gather_rows(self.heatmap_df, genes).iloc[:, self.file_order]
+        if zscore:
+            heatmap_data = pd.DataFrame(selection.zscore_rows(heatmap_data.to_numpy()), index=heatmap_data.index, columns=heatmap_data.columns)
+        mutated = heatmap_data.columns.isin(mutation_matrix.index[mutation_matrix[target_gene].to_numpy()])
+        return heatmap_data, mutated
+
+    def answer_targets(self, query):
+        return 'application/json', to_json({'targets': self.targets})
+
+    def answer_stats(self, target_gene, query):
+        # parameters are checked before anything is computed
+        limit = int_param(query, 'limit', None) if 'limit' in query else None
+        stats_df, mutation_matrix = self.stats(target_gene)
+        if limit is not None:
+            stats_df = stats_df.iloc[selection.top_k_positions(stats_df['pvalue'].to_numpy(), limit)]
+
+        if query.get('format', ['json'])[0] == 'csv':
+            return 'text/csv', stats_df.to_csv(index=False).encode()
+        n_mutated = int(mutation_matrix[target_gene].sum())
+        return 'application/json', to_json({'target': target_gene, 'n_mutated': n_mutated, 'n_nonmutated': len(mutation_matrix) - n_mutated,
+                                            'columns': list(stats_df.columns.drop('gene')), 'genes': stats_df['gene'].tolist(),
+                                            'values': records(stats_df.drop(columns='gene').to_numpy())})
+
+    def answer_heatmap(self, target_gene, query):
+        heatmap_data, mutated = self.heatmap(target_gene, int_param(query, 'n', 100), zscore=bool_param(query, 'zscore'))
+        return 'application/json', to_json({'target': target_gene, 'genes': heatmap_data.index.tolist(), 'samples': heatmap_data.columns.tolist(),
+                                            'mutated': mutated.astype(int).tolist(), 'values': records(heatmap_data.to_numpy())})
+
+    def answer_clusters(self, target_gene, query):
+        row_threshold, col_threshold = int_param(query, 'row_threshold', 7), int_param(query, 'col_threshold', 2)
+        heatmap_data, mutated = self.heatmap(target_gene, int_param(query, 'n', 100))
+        mutated_samples = heatmap_data.columns[mutated]
+        _, _, row_clusters, col_clusters, row_score, col_score, mutated_col_score = clustering.cluster_labels(
+            heatmap_data, row_threshold, col_threshold, mutated_samples)
+        return 'application/json', to_json({'target': target_gene,
+                                            'gene_clusters': dict(zip(heatmap_data.index, row_clusters.tolist())),
+                                            'sample_clusters': dict(zip(heatmap_data.columns, col_clusters.tolist())),
+                                            'gene_sil_score': float(row_score), 'sample_sil_score': float(col_score),
+                                            'mutated_sample_sil_score': float(mutated_col_score)})
+
+    def compute(self, path, query):
+        ''' (content type, body) of a request path, raises UnknownTarget, UnknownEndpoint or BadParameter '''
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts == ['targets']:
+            return self.answer_targets(query)
+        if len(parts) == 2 and parts[0] in ('stats', 'heatmap', 'clusters'):
+            return getattr(self, f'answer_{parts[0]}')(parts[1], query)
+        raise UnknownEndpoint(f"no such endpoint: {path}")
+
+    async def respond(self, path, query):
+        if path.strip('/') == 'cache':
+            return 200, 'application/json', to_json(self.cache.info())
+
+        key = (path, tuple(sorted((name, tuple(values)) for name, values in query.items())))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return (200, *cached)
+
+        if key not in self.pending:
+            # numpy releases the gil, so computations run in threads next to the event loop
+            self.pending[key] = asyncio.get_running_loop().run_in_executor(None, self.compute, path, query)
+        try:
+            content_type, body = await asyncio.shield(self.pending[key])
+        except (UnknownTarget, UnknownEndpoint) as error:
+            return 404, 'application/json', to_json({'error': str(error)})
+        except BadParameter as error:
+            return 400, 'application/json', to_json({'error': str(error)})
+        except Exception as error:
+            # anything else is a bug of the service, not of the request
+            return 500, 'application/json', to_json({'error': f'{type(error).__name__}: {error}'})
+        finally:
+            self.pending.pop(key, None)
+
+        self.cache.put(key, (content_type, body))
+        return 200, content_type, body
+
+    async def handle_connection(self, reader, writer):
+        # minimal http/1.1: GET only, no request bodies, connections kept alive unless asked to close
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                if method != 'GET':
+                    status, content_type, body = 405, 'application/json', to_json({'error': 'only GET is supported'})
+                else:
+                    url = urlsplit(target)
+                    status, content_type, body = await self.respond(url.path, parse_qs(url.query))
+                print(f"{method} {target} {status} {(time.perf_counter() - start) * 1000:.1f}ms")
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(f"{version} {status} {reasons[status]}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"serving {len(self.targets)} targets on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def serve(maf_file_path, expression_file_path, host='127.0.0.1', port=8765, cache_folder=None, dtype='float64', cache_mb=256,
+          reference_folder=None, refresh_reference=False):
+    mutations = mutation_index.load_mutation_index(file_path=maf_file_path, cache_folder=cache_folder)
+    # the loaded matrix is not kept, the service holds its own sorted copy
+    service = AnalysisService(data_load.load_txt_file_into_dataframe(file_path=expression_file_path, cache_folder=cache_folder, dtype=dtype,
+                                                                     reference_folder=reference_folder, refresh_reference=refresh_reference),
+                              mutations, cache_mb=cache_mb)
+    try:
+        asyncio.run(service.serve_forever(host, port))
+    except KeyboardInterrupt:
+        pass
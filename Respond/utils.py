@@ -1,9 +1,8 @@
 
 import os
+import instrument
 import numpy as np
 import pandas as pd
-from statsmodels.stats import multitest
-from scipy.stats import ranksums
 from statistics import mean
 
 
@@ -26,6 +25,7 @@ def calculate_z_score(list_mutated, list_non_mutated):
 
 
 def calculate_pvalue_and_effect_size_wilcox_ranksum(list_mutated, list_non_mutated):
+     from scipy.stats import ranksums
      test = ranksums(list_mutated, list_non_mutated)
      u_statistic = test.statistic 
      effect_size = u_statistic / (len(list_mutated) * len(list_non_mutated))
@@ -34,10 +34,23 @@ def calculate_pvalue_and_effect_size_wilcox_ranksum(list_mutated, list_non_mutat
 
 
 def calculate_adjusted_pvalue(pvalues, method='fdr_bh'):
+    # benjamini-hochberg in numpy (same values as statsmodels) so stats runs don't need to import statsmodels
+    if method == 'fdr_bh':
+        pvalues = np.asarray(pvalues, dtype=np.float64)
+        # same order of operations as statsmodels (divide by the ecdf factor i / n), so the values are bit identical
+        order = np.argsort(pvalues)
+        n = len(pvalues)
+        scaled = pvalues[order] / (np.arange(1, n + 1) / float(n))
+        corrected_pvalues = np.empty_like(pvalues)
+        corrected_pvalues[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1)
+        return corrected_pvalues
+
+    from statsmodels.stats import multitest
     _, corrected_pvalues, _, _ = multitest.multipletests(pvalues, method=method)
     return corrected_pvalues
 
 
+@instrument.stage
 def generate_stats_per_gene(express_mut_genes_df, target_gene, output_folder):
     """
     Given expression and mutation data calculates LogFC, pvalue, mean of expression per gene 
@@ -92,10 +105,295 @@ def generate_stats_per_gene(express_mut_genes_df, target_gene, output_folder):
     return combined_data, mutated_samples, output_filename
 
 
-def get_mutated_status(expression_df_heatmap, individuals_mutated_target_gene, output_folder, target_gene):
-    individuals_mutated_target_gene = list(individuals_mutated_target_gene)
+def rank_rows(expression_values):
+    from scipy.stats import rankdata
+    # average ranks within each gene (row), the same tie handling scipy's ranksums uses.
+    # kept in the dtype of the expression matrix so float32 inputs stay float32
+    return rankdata(expression_values, axis=1).astype(expression_values.dtype, copy=False)
+
+
+def calculate_ranksum_stats_batch(expression_values, mutation_matrix, ranks=None, smoothing_factor=1e-8, row_sums=None):
+    """
+    Rank-sum statistics for many targets at once. mutation_matrix is a boolean sample x target 
+    matrix; every returned array is gene x target. The per-gene ranks are computed once 
+    (or passed in) and reused across targets, rank sums and group sums are matrix products.
+    row_sums (expression_values.sum(axis=1, keepdims=True)) can be passed in like the ranks.
+
+    """
+    from scipy.stats import norm
+    mutation_matrix = np.asarray(mutation_matrix, dtype=bool)
+    n_mutated = mutation_matrix.sum(axis=0).astype(np.float64)
+    n_non_mutated = mutation_matrix.shape[0] - n_mutated
+
+    if ranks is None:
+        ranks = rank_rows(expression_values)
+
+    mutation_weights = mutation_matrix.astype(expression_values.dtype)
+
+    # wilcoxon rank-sum statistic (normal approximation, no tie correction, as in ranksums)
+    rank_sum = ranks @ mutation_weights
+    expected = n_mutated * (n_mutated + n_non_mutated + 1) / 2.0
+    z_statistic = (rank_sum - expected) / np.sqrt(n_mutated * n_non_mutated * (n_mutated + n_non_mutated + 1) / 12.0)
+    pvalue = 2 * norm.sf(np.abs(z_statistic))
+
+    sum_mutated = expression_values @ mutation_weights
+    if row_sums is None:
+        row_sums = expression_values.sum(axis=1, keepdims=True)
+    sum_non_mutated = row_sums - sum_mutated
+    mean_mutated = sum_mutated / n_mutated
+    mean_non_mutated = sum_non_mutated / n_non_mutated
+
+    return {
+        'logFC': np.log2((mean_mutated + smoothing_factor) / (mean_non_mutated + smoothing_factor)),
+        'pvalue': pvalue,
+        'effect_size': z_statistic / (n_mutated * n_non_mutated),
+        'expression_mutated_mean': mean_mutated,
+        'expression_nonmutated_mean': mean_non_mutated,
+    }
+
+
+def calculate_ranksum_stats(expression_values, mutated_mask, ranks=None, smoothing_factor=1e-8):
+    """
+    Vectorized version of calculate_log_fold, calculate_pvalue_and_effect_size_wilcox_ranksum 
+    and the group means, computed for every gene (row) of a gene x sample matrix in one pass.
+    mutated_mask is a boolean array over the samples (columns)
+
+    """
+    mutation_matrix = np.asarray(mutated_mask, dtype=bool)[:, None]
+    stats = calculate_ranksum_stats_batch(expression_values, mutation_matrix, ranks=ranks, smoothing_factor=smoothing_factor)
+    return {column: values[:, 0] for column, values in stats.items()}
+
+
+@instrument.stage
+def generate_stats_per_gene_wide(expression_df, maf_df, target_gene, output_folder):
+    """
+    Same output as generate_stats_per_gene, but works directly on the wide gene x sample 
+    expression matrix instead of the melted and merged long frame.
+    Each gene is ranked once and all statistics are computed with numpy for every gene at once.
+
+    """
+    if target_gene not in expression_df.index:
+        raise ValueError("This gene is not valid! No mutations with this gene exist") 
+
+    # keep individuals with sequencing data i.e. appear in the mutation data frame (maf)
+    expression_df = expression_df.loc[:, expression_df.columns.isin(maf_df['sample'].unique())]
+    expression_df = expression_df.sort_index()
+
+    mutated_mask = expression_df.columns.isin(maf_df.loc[maf_df['gene'] == target_gene, 'sample'].unique())
+    if mutated_mask.sum() == 0 or mutated_mask.all():
+        raise ValueError("This gene is not valid! No mutations with this gene exist") 
+
+    mutated_samples = pd.Series(expression_df.columns[mutated_mask], name='sample')
+    non_mutated_samples = pd.Series(expression_df.columns[~mutated_mask], name='sample')
+
+    stats = calculate_ranksum_stats(expression_df.to_numpy(), mutated_mask)
+
+    combined_data = pd.DataFrame({'gene': expression_df.index, **stats})
+    combined_data['adjusted_pvalue'] = calculate_adjusted_pvalue(combined_data['pvalue'].values)
+
+    os.makedirs(f'{output_folder}/{target_gene}', exist_ok=True)
+    output_filename = f'{output_folder}/{target_gene}/{mutated_samples.count()}_{non_mutated_samples.count()}_logfc_pvalue.csv'
     
-    mutated_status = [1 if item in individuals_mutated_target_gene else 0 for item in expression_df_heatmap.columns]
+    print(f"outputting data to {output_filename}")
+    combined_data.to_csv(output_filename, index=False)
+
+    return combined_data, mutated_samples, output_filename
+
+
+@instrument.stage
+def calculate_permutation_pvalues(ranks, mutated_mask, n_permutations=10000, block_size=1000, 
+                                  stop_after_hits=50, seed=None):
+    """
+    Empirical two-sided p-values of the rank-sum statistic for every gene (row) of ranks,
+    shuffling the mutation labels. Permutations are scored block_size at a time as one matrix 
+    product of the ranks with a sample x block label matrix. A gene stops being permuted once 
+    stop_after_hits permuted statistics are at least as extreme as its observed one 
+    (Besag-Clifford sequential test, p = hits / permutations done), since it is then clearly 
+    not significant. Genes that never stop get (hits + 1) / (permutations + 1).
+
+    """
+    rng = np.random.default_rng(seed)
+    mutated_mask = np.asarray(mutated_mask, dtype=bool)
+    n_samples = mutated_mask.size
+    n_mutated = mutated_mask.sum()
+
+    expected = n_mutated * (n_samples + 1) / 2.0
+    observed = np.abs(ranks[:, mutated_mask].sum(axis=1) - expected)
+    # tolerance so permutations that tie with the observed statistic count as hits
+    observed -= 1e-7 * np.maximum(observed, 1)
+
+    hits = np.zeros(ranks.shape[0], dtype=np.int64)
+    n_done = np.zeros(ranks.shape[0], dtype=np.int64)
+    active = np.arange(ranks.shape[0])
+
+    while active.size and n_done[active[0]] < n_permutations:
+        n_block = min(block_size, n_permutations - n_done[active[0]])
+
+        # n_block random relabelings with exactly n_mutated mutated samples each
+        permuted_labels = np.zeros((n_block, n_samples), dtype=ranks.dtype)
+        chosen = rng.random((n_block, n_samples)).argpartition(n_mutated - 1, axis=1)[:, :n_mutated]
+        np.put_along_axis(permuted_labels, chosen, 1, axis=1)
+
+        permuted_stats = np.abs(ranks[active] @ permuted_labels.T - expected)
+        hits[active] += (permuted_stats >= observed[active, None]).sum(axis=1)
+        n_done[active] += n_block
+
+        active = active[hits[active] < stop_after_hits]
+
+    finished = hits < stop_after_hits
+    return np.where(finished, (hits + 1) / (n_done + 1), hits / n_done)
+
+
+def select_valid_targets(mutation_matrix, genes):
+    """
+    The targets (columns) of the sample x target mutation matrix that generate_stats_per_gene_wide would accept:
+    in genes and mutated in some but not all samples. The others are skipped with a message.
+    Returns the mutation matrix of the valid targets and their (mutated, non mutated) sample counts.
+
+    """
+    n_mutated = mutation_matrix.sum(axis=0)
+    valid_targets = mutation_matrix.columns.isin(genes) & (n_mutated > 0).values & (n_mutated < len(mutation_matrix)).values
+    for target_gene in mutation_matrix.columns[~valid_targets]:
+        print(f"skipping {target_gene}: not in expression data or no mutations with this gene exist")
+    mutation_matrix = mutation_matrix.loc[:, valid_targets]
+    counts = {target_gene: (int(n_mutated[target_gene]), len(mutation_matrix) - int(n_mutated[target_gene])) for target_gene in mutation_matrix.columns}
+    return mutation_matrix, counts
+
+
+def stats_output_filename(output_folder, target_gene, n_mutated, n_non_mutated):
+    # the csv of a target's stats, named after its sample counts
+    os.makedirs(f'{output_folder}/{target_gene}', exist_ok=True)
+    return f'{output_folder}/{target_gene}/{n_mutated}_{n_non_mutated}_logfc_pvalue.csv'
+
+
+@instrument.stage
+def generate_stats_for_targets(expression_df, mutation_matrix, output_folder=None, n_permutations=0, seed=None, results_store=None, ranks=None):
+    """
+    Batch version of generate_stats_per_gene_wide: tests every target (column) of the 
+    sample x target mutation matrix against all genes in one pass. 
+    Returns a dict target -> stats df, and writes the usual csv per target when output_folder is given.
+    With n_permutations > 0 an empirical 'permutation_pvalue' column is added (see calculate_permutation_pvalues).
+    results_store (see results_store.py) stores the stats of all targets in one batch.
+    ranks of the expression rows (rank_rows of expression_df restricted to the samples of mutation_matrix and
+    sorted by gene) can be passed in when the same matrix is tested again, e.g. by the query service.
+
+    """
+    sequenced = expression_df.columns.isin(mutation_matrix.index)
+    mutation_matrix = mutation_matrix.reindex(index=expression_df.columns[sequenced], fill_value=False).astype(bool)
+
+    # skip targets generate_stats_per_gene_wide would reject, the matrix is not copied or ranked when none are left
+    mutation_matrix, counts = select_valid_targets(mutation_matrix, expression_df.index)
+    if mutation_matrix.shape[1] == 0:
+        return {}
+    expression_df = expression_df.loc[:, sequenced].sort_index()
+
+    expression_values = expression_df.to_numpy()
+    if ranks is None:
+        ranks = rank_rows(expression_values)
+    stats = calculate_ranksum_stats_batch(expression_values, mutation_matrix.to_numpy(), ranks=ranks)
+
+    stats_per_target = {}
+    for i, target_gene in enumerate(mutation_matrix.columns):
+        combined_data = pd.DataFrame({'gene': expression_df.index, **{column: values[:, i] for column, values in stats.items()}})
+        combined_data['adjusted_pvalue'] = calculate_adjusted_pvalue(combined_data['pvalue'].values)
+        if n_permutations > 0:
+            combined_data['permutation_pvalue'] = calculate_permutation_pvalues(
+                ranks, mutation_matrix[target_gene].to_numpy(), n_permutations=n_permutations, seed=seed)
+        stats_per_target[target_gene] = combined_data
+
+        if output_folder is not None:
+            output_filename = stats_output_filename(output_folder, target_gene, *counts[target_gene])
+            print(f"outputting data to {output_filename}")
+            combined_data.to_csv(output_filename, index=False)
+            combined_data.attrs['output_filename'] = output_filename
+
+    if results_store is not None:
+        results_store.append(stats_per_target, n_mutated=counts)
+
+    return stats_per_target
+
+
+def format_csv_float(value):
+    # how to_csv writes a float64, empty for nan
+    return '' if np.isnan(value) else repr(float(value))
+
+
+@instrument.stage
+def generate_stats_for_targets_blockwise(expression_df, mutation_matrix, output_folder=None, n_permutations=0, seed=None, 
+                                         results_store=None, block_size=5000):
+    """
+    Out-of-core version of generate_stats_for_targets for a (memory-mapped) expression matrix larger than memory.
+    Genes are ranked and tested block_size at a time and every block is written out before the next one is read: 
+    appended to the csv of every target in output_folder and/or to results_store. Only the pvalues (and permutation
+    pvalues, which follow them in the csv) of every target are kept until all blocks are done, for the adjusted pvalues. Returns a dict target -> csv file name (None 
+    without output_folder). Same stats as generate_stats_for_targets, and with a seed the same permutation pvalues.
+
+    """
+    sample_positions = np.flatnonzero(expression_df.columns.isin(mutation_matrix.index))
+    samples = expression_df.columns[sample_positions]
+    gene_order = np.argsort(expression_df.index.to_numpy(), kind='stable')
+    genes = expression_df.index.to_numpy()[gene_order]
+    mutation_matrix = mutation_matrix.reindex(index=samples, fill_value=False).astype(bool)
+
+    # skip targets generate_stats_per_gene_wide would reject, no block is read when none are left
+    mutation_matrix, counts = select_valid_targets(mutation_matrix, expression_df.index)
+    if mutation_matrix.shape[1] == 0:
+        return {}
+
+    output_filenames = {target_gene: stats_output_filename(output_folder, target_gene, *counts[target_gene]) if output_folder is not None else None
+                        for target_gene in mutation_matrix.columns}
+    pvalues = np.empty((len(genes), mutation_matrix.shape[1]))
+    permutation_pvalues = np.empty((len(genes), mutation_matrix.shape[1])) if n_permutations > 0 else None
+
+    expression_values = expression_df.to_numpy()
+    for start in range(0, len(genes), block_size):
+        # one block of genes in sorted order, only the samples with sequencing data
+        block = np.take(expression_values, gene_order[start:start + block_size], axis=0)
+        if len(sample_positions) < block.shape[1]:
+            # row major like the in-memory matrix, so the sums over samples come out bit for bit the same
+            block = np.ascontiguousarray(block[:, sample_positions])
+        ranks = rank_rows(block)
+        stats = calculate_ranksum_stats_batch(block, mutation_matrix.to_numpy(), ranks=ranks)
+        pvalues[start:start + len(block)] = stats['pvalue']
+
+        block_stats = {}
+        for i, target_gene in enumerate(mutation_matrix.columns):
+            block_df = pd.DataFrame({'gene': genes[start:start + len(block)], **{column: values[:, i] for column, values in stats.items()}})
+            if n_permutations > 0:
+                permutation_pvalues[start:start + len(block), i] = calculate_permutation_pvalues(
+                    ranks, mutation_matrix[target_gene].to_numpy(), n_permutations=n_permutations, seed=seed)
+                if results_store is not None:
+                    block_df['permutation_pvalue'] = permutation_pvalues[start:start + len(block), i]
+            if output_filenames[target_gene] is not None:
+                # opened per block, so thousands of targets never hold thousands of open files
+                block_df.to_csv(f'{output_filenames[target_gene]}.partial', index=False, header=start == 0, mode='w' if start == 0 else 'a')
+            block_stats[target_gene] = block_df
+
+        if results_store is not None:
+            # the first block replaces earlier rows of the targets, later blocks are added to them
+            results_store.append(block_stats, n_mutated=counts, replace=start == 0)
+
+    # adjusted pvalues need every gene of a target, they are added once all blocks are written
+    for i, target_gene in enumerate(mutation_matrix.columns):
+        adjusted_pvalues = calculate_adjusted_pvalue(pvalues[:, i])
+        if results_store is not None:
+            results_store.set_values(target_gene, 'adjusted_pvalue', genes, adjusted_pvalues)
+        if output_filenames[target_gene] is not None:
+            output_filename = output_filenames[target_gene]
+            print(f"outputting data to {output_filename}")
+            extra_columns = [adjusted_pvalues] + ([permutation_pvalues[:, i]] if n_permutations > 0 else [])
+            with open(f'{output_filename}.partial') as partial_file, open(output_filename, 'w') as file:
+                file.write(partial_file.readline().rstrip('\n') + ',adjusted_pvalue' + (',permutation_pvalue' if n_permutations > 0 else '') + '\n')
+                for line, *values in zip(partial_file, *extra_columns):
+                    file.write(line.rstrip('\n') + ''.join(',' + format_csv_float(value) for value in values) + '\n')
+            os.remove(f'{output_filename}.partial')
+
+    return output_filenames
+
+
+@instrument.stage
+def get_mutated_status(expression_df_heatmap, individuals_mutated_target_gene, output_folder, target_gene):
+    mutated_status = expression_df_heatmap.columns.isin(individuals_mutated_target_gene).astype(int)
 
     sample_categories_df = pd.DataFrame({
         'Sample': expression_df_heatmap.columns,
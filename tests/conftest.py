@@ -0,0 +1,41 @@
+import os
+import sys
+import pytest
+
+# the pipeline modules import each other by their flat names (import utils, ...), as when run from Respond/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Respond'))
+
+import benchmark
+
+
+# small deterministic inputs shaped like the real ones, from the benchmark's generators
+
+@pytest.fixture(scope='session')
+def counts():
+    return benchmark.generate_counts(120, 24, seed=7)
+
+
+@pytest.fixture(scope='session')
+def maf_df(counts):
+    return benchmark.generate_maf(counts.index, counts.columns, mutation_rate=0.2, seed=7)
+
+
+@pytest.fixture(scope='session')
+def input_files(tmp_path_factory, counts, maf_df):
+    ''' (maf file, expression file) written like the real inputs '''
+    folder = tmp_path_factory.mktemp('inputs')
+    maf_file_path, expression_file_path = str(folder / 'mutations.maf'), str(folder / 'expression.txt')
+    benchmark.write_maf_file(maf_df, maf_file_path)
+    benchmark.write_expression_file(counts, expression_file_path)
+    return maf_file_path, expression_file_path
+
+
+@pytest.fixture(scope='session')
+def expression_df(input_files):
+    import data_load
+    return data_load.load_txt_file_into_dataframe(input_files[1])
+
+
+@pytest.fixture(scope='session')
+def targets(maf_df, counts):
+    return benchmark.pick_targets(maf_df, counts.columns, 4)
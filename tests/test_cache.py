@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import pandas as pd
+import cache, data_load
+
+
+def test_cached_matrix_is_the_loaded_one(input_files, expression_df, tmp_path):
+    first_df = data_load.load_txt_file_into_dataframe(input_files[1], cache_folder=str(tmp_path))
+    cached_df = data_load.load_txt_file_into_dataframe(input_files[1], cache_folder=str(tmp_path))
+    assert np.array_equal(first_df.to_numpy(), expression_df.to_numpy())
+    assert np.array_equal(cached_df.to_numpy(), expression_df.to_numpy())
+    assert list(cached_df.index) == list(expression_df.index)
+
+
+def test_saving_again_swaps_in_a_new_version(tmp_path):
+    cache_folder = str(tmp_path)
+    first_df = pd.DataFrame(np.arange(6.0).reshape(2, 3), index=['GENE1', 'GENE2'], columns=['A', 'B', 'C'])
+    cache.save_matrix(first_df, 'entry', cache_folder)
+    entry_folder = os.path.join(cache_folder, 'entry')
+    first_version = os.path.realpath(entry_folder)
+    assert os.path.islink(entry_folder)
+    # readers of the old version keep their memory map while it is replaced
+    mapped_df = cache.load_matrix('entry', cache_folder)
+
+    cache.save_matrix(first_df * 2, 'entry', cache_folder)
+    assert os.path.realpath(entry_folder) != first_version and not os.path.exists(first_version)
+    pd.testing.assert_frame_equal(cache.load_matrix('entry', cache_folder), first_df * 2)
+    pd.testing.assert_frame_equal(mapped_df, first_df)
+    # the link and the current version, no temporary folders or links left behind
+    assert sorted(os.listdir(cache_folder)) == sorted(['entry', os.path.basename(os.path.realpath(entry_folder))])
+    assert cache.load_matrix('missing', cache_folder) is None
+
+
+def test_versions_get_the_umask_mode(tmp_path):
+    previous_umask = os.umask(0o022)
+    try:
+        tmp_folder = cache.temporary_folder(str(tmp_path / 'entry'))
+    finally:
+        os.umask(previous_umask)
+    assert os.stat(tmp_folder).st_mode & 0o777 == 0o755
+    cache.replace_folder(tmp_folder, str(tmp_path / 'entry'))
+    assert os.path.realpath(tmp_path / 'entry') == os.path.realpath(tmp_folder)
+
+
+def test_plain_folder_from_before_versioning_is_replaced(tmp_path):
+    folder = str(tmp_path / 'entry')
+    os.mkdir(folder)
+    open(os.path.join(folder, 'labels.json'), 'w').close()
+
+    tmp_folder = cache.temporary_folder(folder)
+    open(os.path.join(tmp_folder, 'values.npy'), 'w').close()
+    cache.replace_folder(tmp_folder, folder)
+    assert os.path.islink(folder) and os.listdir(folder) == ['values.npy']
+    assert sorted(os.listdir(tmp_path)) == sorted(['entry', os.path.basename(tmp_folder)])
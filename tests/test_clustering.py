@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import pdist
+from sklearn.metrics import silhouette_score, silhouette_samples
+import clustering
+
+
+@pytest.fixture
+def heatmap_df():
+    # three groups of samples, so the clusters are clear-cut and the cuts agree between implementations
+    rng = np.random.default_rng(3)
+    values = rng.normal(size=(30, 45)) + np.repeat([0.0, 3.0, -3.0], 15)
+    return pd.DataFrame(values, index=[f'GENE{i}' for i in range(30)], columns=[f'RESPOND_{j:04d}' for j in range(45)])
+
+
+def test_condensed_distances_match_pdist(heatmap_df):
+    data = heatmap_df.to_numpy()
+    assert_allclose(clustering.condensed_distances(data, dtype=np.float64, block_size=7), pdist(data), rtol=1e-10)
+    assert_allclose(clustering.condensed_distances(data), pdist(data), rtol=1e-5)
+
+
+def test_scores_from_shared_distances_match_sklearn(heatmap_df):
+    mutated_samples = heatmap_df.columns[::4]
+    _, _, row_clusters, col_clusters, row_score, col_score, mutated_col_score = clustering.cluster_labels(
+        heatmap_df, row_threshold=7, col_threshold=3, mutated_samples=mutated_samples)
+
+    assert_allclose(row_score, silhouette_score(heatmap_df, row_clusters), rtol=1e-10)
+    assert_allclose(col_score, silhouette_score(heatmap_df.T, col_clusters), rtol=1e-10)
+    mutated = heatmap_df.columns.isin(mutated_samples)
+    assert_allclose(mutated_col_score, silhouette_samples(heatmap_df.T, col_clusters)[mutated].mean(), rtol=1e-10)
+
+
+def same_partition(labels, other_labels):
+    # equal up to renaming the clusters
+    return len(set(zip(labels, other_labels))) == len(set(labels)) == len(set(other_labels))
+
+
+def test_nn_chain_ward_matches_scipy(heatmap_df):
+    data = heatmap_df.T.to_numpy()
+    linkage_matrix, distances = clustering.ward_linkage_nn_chain(data)
+    scipy_linkage = linkage(pdist(data), method='ward')
+
+    assert_allclose(distances, pdist(data), rtol=1e-5)
+    assert_allclose(linkage_matrix[:, 2], scipy_linkage[:, 2], rtol=1e-4)
+    assert np.array_equal(linkage_matrix[:, 3], scipy_linkage[:, 3])
+    for k in range(2, 6):
+        assert same_partition(fcluster(linkage_matrix, t=k, criterion='maxclust'), fcluster(scipy_linkage, t=k, criterion='maxclust'))
+
+
+def test_approximate_ward(heatmap_df):
+    from scipy.cluster.hierarchy import is_valid_linkage, is_monotonic
+    data = heatmap_df.T.to_numpy()
+    # no more points than micro clusters is the exact linkage
+    assert np.array_equal(clustering.ward_linkage_approximate(data, n_micro_clusters=len(data)), clustering.ward_linkage_nn_chain(data)[0])
+
+    approximate_linkage = clustering.ward_linkage_approximate(data, n_micro_clusters=9)
+    assert is_valid_linkage(approximate_linkage) and is_monotonic(approximate_linkage)
+    assert same_partition(fcluster(approximate_linkage, t=3, criterion='maxclust'), np.repeat([0, 1, 2], 15))
+
+
+def test_threshold_sweep_matches_cutting_each_k(heatmap_df):
+    mutated_samples = heatmap_df.columns[::4]
+    sweep_df = clustering.sweep_cluster_thresholds(heatmap_df, mutated_samples, k_values=range(1, 8))
+    assert list(sweep_df['k']) == list(range(2, 8))
+
+    data = heatmap_df.T.to_numpy()
+    scipy_linkage = linkage(pdist(data), method='ward')
+    mutated = heatmap_df.columns.isin(mutated_samples)
+    for _, row in sweep_df.iterrows():
+        labels = fcluster(scipy_linkage, t=row['k'], criterion='maxclust')
+        assert_allclose(row['silhouette_score'], silhouette_score(data, labels), rtol=1e-10)
+        assert_allclose(row['mutated_sample_silhouette_score'], silhouette_samples(data, labels)[mutated].mean(), rtol=1e-10)
+
+    # the linkage and distances of the clustering give the same table
+    linkage_matrix, distances = clustering.ward_linkage(data)
+    pd.testing.assert_frame_equal(clustering.sweep_cluster_thresholds(heatmap_df, mutated_samples, k_values=range(1, 8),
+                                                                      linkage_matrix=linkage_matrix, distances=distances), sweep_df)
+
+
+def test_silhouette_subset_matches_sklearn(heatmap_df):
+    data = heatmap_df.T.to_numpy()
+    # the last sample is alone in its cluster, sklearn scores it 0
+    labels = np.append(np.repeat([1, 2, 3], 15)[:-1], 4)
+    indices = np.array([0, 7, 16, 30, 44, 3])
+    expected = silhouette_samples(data, labels)[indices]
+
+    assert_allclose(clustering.silhouette_subset(labels, indices, data=data), expected, rtol=1e-10)
+    assert_allclose(clustering.silhouette_subset(labels, indices, distances=pdist(data)), expected, rtol=1e-10)
+    assert clustering.silhouette_subset(labels, indices, data=data)[4] == 0
+    assert len(clustering.silhouette_subset(labels, [], distances=pdist(data))) == 0
+
+
+def test_mutated_sample_score_without_precomputed_scores(heatmap_df):
+    labels = np.repeat([1, 2, 3], 15)
+    mutated_samples = heatmap_df.columns[1::5]
+    expected = silhouette_samples(heatmap_df.T, labels)[heatmap_df.columns.isin(mutated_samples)].mean()
+    assert_allclose(clustering.evaluate_cluster_sil_score_mutated_samples(heatmap_df, labels, mutated_samples), expected, rtol=1e-10)
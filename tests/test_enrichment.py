@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+import enrichment
+
+
+def running_sum_score(metric, set_genes, genes, weight=1):
+    # the enrichment score as in Subramanian et al. 2005: walk down the ranked list, step up at every
+    # hit by its share of the set's weight and down at every miss, the score is the largest deviation from 0
+    order = np.argsort(-metric, kind='stable')
+    hits = np.isin(np.asarray(genes)[order], list(set_genes))
+    weights = np.abs(metric[order]) ** weight
+    steps = np.where(hits, weights / weights[hits].sum(), -1 / (len(genes) - hits.sum()))
+    running = np.cumsum(steps)
+    return running[np.argmax(np.abs(running))]
+
+
+def make_sets(genes, rng):
+    # sets of different sizes, one concentrated at the top of the list and one at the bottom
+    gene_sets = {f'SET{i}': list(rng.choice(genes, size, replace=False)) for i, size in enumerate([15, 20, 35, 60, 90])}
+    gene_sets['TOP'] = list(genes[:25])
+    gene_sets['BOTTOM'] = list(genes[-30:])
+    return gene_sets
+
+
+def test_enrichment_scores_match_the_running_sum():
+    rng = np.random.default_rng(6)
+    genes = np.array([f'GENE{i}' for i in range(300)])
+    # sorted so TOP and BOTTOM sit at the ends of the ranked list, with a few ties
+    metric = np.round(np.sort(rng.normal(size=300))[::-1] * 3, 1)
+    gene_sets = make_sets(genes, rng)
+
+    names, sizes, members = enrichment.index_gene_sets(gene_sets, genes)
+    for weight in (0, 1, 1.5):
+        ranks, weights = enrichment.ranked_order(metric, weight=weight)
+        scores = enrichment.enrichment_scores(np.append(ranks, len(genes))[members], sizes, weights)
+        expected = [running_sum_score(metric, gene_sets[name], genes, weight=weight) for name in names]
+        assert_allclose(scores, expected, rtol=1e-12, atol=1e-15)
+    assert scores[names.index('TOP')] > 0.9 and scores[names.index('BOTTOM')] < -0.9
+
+
+def test_null_scores_match_scoring_each_permutation():
+    rng = np.random.default_rng(7)
+    genes = np.array([f'GENE{i}' for i in range(200)])
+    metric = rng.normal(size=200)
+    names, sizes, members = enrichment.index_gene_sets(make_sets(genes, rng), genes)
+    _, weights = enrichment.ranked_order(metric)
+
+    # blocks of a single permutation give the same scores as one block
+    null_scores = enrichment.null_enrichment_scores(weights, 30, 11, members, sizes)
+    assert null_scores.shape == (30, len(names))
+    assert np.array_equal(enrichment.null_enrichment_scores(weights, 30, 11, members, sizes, block_size=1), null_scores)
+
+    permutation_rng = np.random.default_rng(11)
+    for scores in null_scores[:5]:
+        ranks = np.append(permutation_rng.permutation(len(genes)), len(genes))
+        assert_allclose(scores, enrichment.enrichment_scores(ranks[members], sizes, weights), rtol=1e-12)
+
+
+def test_prerank_targets(tmp_path):
+    rng = np.random.default_rng(8)
+    genes = np.array([f'GENE{i}' for i in range(300)])
+    stats_df = pd.DataFrame({'gene': genes, 'logFC': rng.normal(size=300), 'pvalue': rng.random(300)})
+    stats_df.loc[:24, ['logFC', 'pvalue']] = [2.0, 1e-6]
+    gene_sets = make_sets(genes, rng)
+
+    results = enrichment.prerank_targets({'GENE1': stats_df, 'GENE2': stats_df.iloc[::-1]}, gene_sets, n_permutations=200,
+                                         seed=0, output_folder=str(tmp_path))
+    result_df = results['GENE1'].set_index('gene_set')
+    metric = enrichment.ranking_metric(stats_df)
+    for name, row in result_df.iterrows():
+        assert_allclose(row['es'], running_sum_score(metric, gene_sets[name], genes), rtol=1e-12)
+    assert result_df.index[0] == 'TOP' and result_df.loc['TOP', 'pvalue'] < 0.01
+    # the stats rows can come in any order
+    assert_allclose(results['GENE2'].set_index('gene_set')['es'][result_df.index], result_df['es'], rtol=1e-12)
+    assert pd.read_csv(results['GENE1'].attrs['output_filename'])['gene_set'].tolist() == results['GENE1']['gene_set'].tolist()
+
+    # a worker pool draws the same permutations
+    pool_results = enrichment.prerank_targets({'GENE1': stats_df}, gene_sets, n_permutations=200, n_workers=2, batch_size=50, seed=0)
+    serial_results = enrichment.prerank_targets({'GENE1': stats_df}, gene_sets, n_permutations=200, batch_size=50, seed=0)
+    pd.testing.assert_frame_equal(pool_results['GENE1'], serial_results['GENE1'])
@@ -0,0 +1,24 @@
+import numpy as np
+from numpy.testing import assert_allclose
+import benchmark, data_load
+
+
+def test_loader_matches_pydeseq2(input_files, expression_df):
+    legacy_df = benchmark.legacy_load(input_files[1])
+    assert list(expression_df.index) == list(legacy_df.index)
+    assert list(expression_df.columns) == list(legacy_df.columns)
+    assert_allclose(expression_df.to_numpy(), legacy_df.to_numpy(dtype=np.float64), rtol=1e-12)
+
+
+def test_chunked_and_float32_loads(input_files, expression_df):
+    chunked_df = data_load.load_txt_file_into_dataframe(input_files[1], chunksize=7)
+    assert_allclose(chunked_df.to_numpy(), expression_df.to_numpy(), rtol=1e-14)
+
+    float32_df = data_load.load_txt_file_into_dataframe(input_files[1], dtype=np.float32)
+    assert float32_df.to_numpy().dtype == np.float32
+    assert_allclose(float32_df.to_numpy(), expression_df.to_numpy(), rtol=1e-5)
+
+
+def test_blockwise_size_factors(counts):
+    values = counts.to_numpy(dtype=np.float64)
+    assert_allclose(data_load.deseq2_size_factors_blockwise(values, block_size=13), data_load.deseq2_size_factors(values), rtol=1e-14)
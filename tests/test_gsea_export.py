@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+import data_load, gsea
+
+
+def test_exported_files_read_back_as_the_inputs(input_files, targets, tmp_path):
+    expression_df, mutation_matrix = data_load.load_wide_inputs(input_files[0], input_files[1], targets)
+    gct_path, target_paths = gsea.export_gsea_inputs(expression_df, mutation_matrix, str(tmp_path), logFC=0, pvalue=0.5)
+
+    with open(gct_path) as file:
+        assert file.readline() == '#1.2\n'
+        assert file.readline() == f'{len(expression_df)}\t{len(mutation_matrix)}\n'
+    gct_df = pd.read_csv(gct_path, sep='\t', skiprows=2, index_col='NAME').drop(columns='description')
+    assert list(gct_df.columns) == list(mutation_matrix.index)
+    assert_allclose(gct_df.to_numpy(), expression_df.loc[:, mutation_matrix.index].to_numpy(), rtol=1e-15)
+
+    # streamed a few genes at a time, the file is the same
+    chunked_path = gsea.write_gct(expression_df.loc[:, mutation_matrix.index], str(tmp_path / 'chunked.gct'), chunksize=7)
+    assert open(chunked_path).read() == open(gct_path).read()
+
+    for target_gene, (cls_path, rnk_path) in target_paths.items():
+        with open(cls_path) as file:
+            lines = file.read().splitlines()
+        labels = np.array(lines[2].split('\t'), dtype=float)
+        assert np.array_equal(labels, mutation_matrix[target_gene].to_numpy(dtype=float))
+        assert lines[0] == f'{len(labels)}\t2\t1'
+
+        rnk_df = pd.read_csv(rnk_path, sep='\t', header=None, names=['gene', 'metric'])
+        assert rnk_df['gene'].isin(expression_df.index).all()
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import instrument
+
+
+@instrument.stage(name='inner')
+def inner_stage(target_gene):
+    return pd.DataFrame({'gene': ['GENE1', 'GENE2']})
+
+
+@instrument.stage(name='outer')
+def outer_stage(target_gene, megabytes):
+    # memory the outer stage takes and frees again before its inner stage starts
+    block = np.ones(megabytes * 1024 * 1024 // 8)
+    del block
+    return inner_stage(target_gene=target_gene), np.zeros(3)
+
+
+@instrument.stage(name='failing')
+def failing_stage():
+    raise ValueError('failed')
+
+
+def test_stage_records(tmp_path):
+    instrument.enable(str(tmp_path / 'trace.jsonl'))
+    try:
+        # memory taken by earlier tests does not count, where the high water mark can be reset
+        exact_peak = instrument.reset_peak_rss()
+        start_mb = instrument.peak_rss_mb()
+        outer_stage('GENE1', 200)
+        try:
+            failing_stage()
+        except ValueError:
+            pass
+    finally:
+        instrument.disable()
+
+    records = instrument.load_trace(str(tmp_path / 'trace.jsonl'))
+    inner, outer, failing = records
+    assert (inner['stage'], inner['target'], inner['depth'], inner['rows']) == ('inner', 'GENE1', 1, 2)
+    assert (outer['stage'], outer['target'], outer['depth'], outer['rows']) == ('outer', 'GENE1', 0, 2)
+    assert failing['error'] == 'ValueError'
+    # the peak of the outer stage before its inner stage reset the high water mark is kept
+    assert outer['peak_rss_mb'] >= inner['peak_rss_mb']
+    if exact_peak:
+        assert outer['peak_rss_mb'] >= start_mb + 150
+
+    stages, targets = instrument.summarize(records)
+    assert stages['outer']['calls'] == 1 and stages['inner']['rows'] == 2
+    assert targets == {'GENE1': outer['wall_seconds']}
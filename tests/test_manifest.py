@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import subprocess
+import manifest
+
+respond_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Respond')
+
+
+def test_fingerprint_follows_files_and_settings(input_files, tmp_path):
+    settings = {'pipeline_mode': 'wide'}
+    first = manifest.fingerprint(list(input_files), 'GENE1', settings, str(tmp_path))
+    assert first == manifest.fingerprint(list(input_files), 'GENE1', dict(settings), str(tmp_path))
+    assert first != manifest.fingerprint(list(input_files), 'GENE2', settings, str(tmp_path))
+    assert first != manifest.fingerprint(list(input_files), 'GENE1', {'pipeline_mode': 'long'}, str(tmp_path))
+
+    changed_file_path = str(tmp_path / 'changed.maf')
+    with open(input_files[0]) as file, open(changed_file_path, 'w') as changed_file:
+        changed_file.write(file.read() + 'GENE1\t0\tSilent\tRESPOND_0000\n')
+    assert first != manifest.fingerprint([changed_file_path, input_files[1]], 'GENE1', settings, str(tmp_path))
+
+
+def test_finished_stages_persist_until_their_output_is_removed(tmp_path):
+    output_folder, output_filename = str(tmp_path / 'out'), str(tmp_path / 'stats.csv')
+    open(output_filename, 'w').close()
+
+    run_manifest = manifest.load_manifest(output_folder)
+    assert run_manifest == {}
+    manifest.mark_done(run_manifest, output_folder, 'GENE1', 'stats', 'abc', {'output_filename': output_filename})
+    manifest.mark_done(run_manifest, output_folder, 'GENE2', 'stats', 'abc', {'skipped': True})
+
+    # a new run reads back what the interrupted one finished
+    run_manifest = manifest.load_manifest(output_folder)
+    assert manifest.is_up_to_date(run_manifest, 'GENE1', 'stats', 'abc')
+    assert not manifest.is_up_to_date(run_manifest, 'GENE1', 'stats', 'changed')
+    assert not manifest.is_up_to_date(run_manifest, 'GENE1', 'clustering', 'abc')
+    assert manifest.is_up_to_date(run_manifest, 'GENE2', 'stats', 'abc')
+    assert manifest.get_record(run_manifest, 'GENE2', 'stats') == {'skipped': True}
+
+    os.remove(output_filename)
+    assert not manifest.is_up_to_date(run_manifest, 'GENE1', 'stats', 'abc')
+
+    # stats in a results store are up to date while the store has the target
+    manifest.mark_done(run_manifest, output_folder, 'GENE3', 'stats', 'abc', {'output_filename': None})
+    assert manifest.is_up_to_date(run_manifest, 'GENE3', 'stats', 'abc', stored_targets={'GENE3'})
+    assert not manifest.is_up_to_date(run_manifest, 'GENE3', 'stats', 'abc', stored_targets=set())
+
+
+def run_pipeline(input_files, targets, output_folder):
+    # main.py runs on import with the settings in constants, so it gets its own process
+    settings = {'maf_file_path': input_files[0], 'expression_file_path': input_files[1], 'output_folder': output_folder,
+                'cache_folder': None, 'genes': targets, 'n_workers': 1, 'make_plots': False}
+    script = (f"import sys, runpy; sys.path.insert(0, {respond_folder!r}); import constants; "
+              f"constants.__dict__.update({settings!r}); runpy.run_path({os.path.join(respond_folder, 'main.py')!r}, run_name='__main__')")
+    subprocess.run([sys.executable, '-c', script], cwd=output_folder, check=True, capture_output=True)
+    return manifest.load_manifest(output_folder)
+
+
+def test_rerun_only_redoes_targets_whose_outputs_are_gone(input_files, targets, tmp_path):
+    output_folder = str(tmp_path)
+    genes = targets[:2] + ['NOT_A_GENE']
+    run_manifest = run_pipeline(input_files, genes, output_folder)
+
+    assert manifest.get_record(run_manifest, 'NOT_A_GENE', 'stats') == {'skipped': True}
+    output_filenames = {target_gene: manifest.get_record(run_manifest, target_gene, 'stats')['output_filename'] for target_gene in targets[:2]}
+    modified = {target_gene: os.stat(output_filename).st_mtime_ns for target_gene, output_filename in output_filenames.items()}
+    assert all('gene_sil_score' in manifest.get_record(run_manifest, target_gene, 'clustering') for target_gene in targets[:2])
+
+    os.remove(output_filenames[targets[0]])
+    rerun_manifest = run_pipeline(input_files, genes, output_folder)
+
+    assert os.path.exists(output_filenames[targets[0]])
+    assert os.stat(output_filenames[targets[1]]).st_mtime_ns == modified[targets[1]]
+    # nothing the first run finished changed its fingerprint
+    assert json.dumps(rerun_manifest, sort_keys=True) == json.dumps(run_manifest, sort_keys=True)
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import benchmark, data_load, mutation_index
+
+
+def test_index_matches_build_mutation_matrix(maf_df, targets, tmp_path):
+    # rows with a blank gene or sample, the sample of a blank gene is still sequenced
+    blank_rows = pd.DataFrame({'Hugo_Symbol': [None, targets[0]], 'Entrez_Gene_Id': 0, 'Variant_Classification': 'Silent',
+                               'Tumor_Sample_Barcode': ['RESPOND_BLANK_GENE', None]})
+    maf_file_path = str(tmp_path / 'blank.maf')
+    benchmark.write_maf_file(pd.concat([maf_df, blank_rows], ignore_index=True), maf_file_path)
+
+    index = mutation_index.build_mutation_index(maf_file_path, chunksize=50)
+    legacy_maf_df = data_load.load_maf_data(maf_file_path)
+    assert set(index.samples) == set(legacy_maf_df['sample'].dropna())
+
+    genes = targets + ['NOT_A_GENE']
+    legacy_matrix = data_load.build_mutation_matrix(legacy_maf_df, genes, samples=index.samples)
+    pd.testing.assert_frame_equal(index.mutation_matrix(genes), legacy_matrix, check_names=False)
+
+    # a subset of the samples in another order, with one the maf does not have
+    samples = list(index.samples[::-3]) + ['RESPOND_UNSEQUENCED']
+    pd.testing.assert_frame_equal(index.mutation_matrix(genes, samples=samples),
+                                  data_load.build_mutation_matrix(legacy_maf_df, genes, samples=samples), check_names=False)
+
+
+def test_cached_index_is_the_built_one(input_files, targets, tmp_path):
+    built = mutation_index.load_mutation_index(input_files[0], cache_folder=str(tmp_path))
+    cached = mutation_index.load_mutation_index(input_files[0], cache_folder=str(tmp_path))
+    assert list(cached.samples) == list(built.samples)
+    assert np.array_equal(cached.mutation_matrix(targets).to_numpy(), built.mutation_matrix(targets).to_numpy())
+
+
+def test_wide_inputs_match_the_legacy_maf_route(input_files, expression_df, targets):
+    wide_expression_df, mutation_matrix = data_load.load_wide_inputs(input_files[0], input_files[1], targets + ['NOT_A_GENE'])
+    assert np.array_equal(wide_expression_df.to_numpy(), expression_df.to_numpy())
+
+    # only the samples with sequencing and expression data, as preprocess_and_combine_mutation_expression keeps
+    maf_df = data_load.load_maf_data(input_files[0])
+    samples = expression_df.columns[expression_df.columns.isin(maf_df['sample'])]
+    pd.testing.assert_frame_equal(mutation_matrix, data_load.build_mutation_matrix(maf_df, targets + ['NOT_A_GENE'], samples=samples), check_names=False)
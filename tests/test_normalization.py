@@ -0,0 +1,54 @@
+import os
+import numpy as np
+from numpy.testing import assert_allclose
+from pydeseq2 import preprocessing
+import benchmark, data_load, normalization
+
+
+def test_reference_matches_pydeseq2(counts, tmp_path):
+    values = counts.to_numpy(dtype=np.float64)
+    first_samples, new_samples = list(counts.columns[:16]), list(counts.columns[16:])
+
+    reference = normalization.SizeFactorReference.fit(values[:, :16], counts.index, first_samples)
+    logmeans, filtered_genes = preprocessing.deseq2_norm_fit(values[:, :16].T)
+    assert_allclose(reference.logmeans, logmeans, rtol=1e-14)
+    _, size_factors = preprocessing.deseq2_norm_transform(values[:, :16].T, logmeans, filtered_genes)
+    assert_allclose(reference.factors(first_samples), size_factors, rtol=1e-14)
+
+    # new samples are normalized against the stored geometric means, the others keep their size factors
+    assert reference.add_samples(values, list(counts.columns), block_size=13) == new_samples
+    _, new_size_factors = preprocessing.deseq2_norm_transform(values[:, 16:].T, logmeans, filtered_genes)
+    assert_allclose(reference.factors(new_samples), new_size_factors, rtol=1e-14)
+    assert_allclose(reference.factors(first_samples), size_factors, rtol=1e-14)
+
+    reference.save(str(tmp_path / 'reference'))
+    loaded = normalization.SizeFactorReference.load(str(tmp_path / 'reference'))
+    assert loaded.digest() == reference.digest() and loaded.size_factors == reference.size_factors
+    assert normalization.SizeFactorReference.load(str(tmp_path / 'missing')) is None
+
+
+def test_loading_new_samples_keeps_the_earlier_ones(counts, tmp_path):
+    first_file_path, full_file_path = str(tmp_path / 'first.txt'), str(tmp_path / 'full.txt')
+    benchmark.write_expression_file(counts.iloc[:, :16], first_file_path)
+    benchmark.write_expression_file(counts, full_file_path)
+    reference_folder, cache_folder = str(tmp_path / 'reference'), str(tmp_path / 'cache')
+
+    first_df = data_load.load_txt_file_into_dataframe(first_file_path, cache_folder=cache_folder, reference_folder=reference_folder)
+    assert_allclose(first_df.to_numpy(), benchmark.legacy_load(first_file_path).to_numpy(dtype=np.float64), rtol=1e-12)
+
+    full_df = data_load.load_txt_file_into_dataframe(full_file_path, cache_folder=cache_folder, reference_folder=reference_folder)
+    assert np.array_equal(full_df.iloc[:, :16].to_numpy(), first_df.to_numpy())
+    _, new_size_factors = preprocessing.deseq2_norm_transform(counts.iloc[:, 16:].to_numpy(dtype=np.float64).T,
+                                                              *preprocessing.deseq2_norm_fit(counts.iloc[:, :16].to_numpy(dtype=np.float64).T))
+    assert_allclose(full_df.iloc[:, 16:].to_numpy(), np.log2(counts.iloc[:, 16:].to_numpy() / new_size_factors + 1), rtol=1e-12)
+
+    # the out of core loader normalizes against the same reference
+    out_of_core_df = data_load.load_txt_file_into_dataframe(full_file_path, cache_folder=str(tmp_path / 'other_cache'), chunksize=7,
+                                                            out_of_core=True, reference_folder=reference_folder)
+    assert_allclose(out_of_core_df.to_numpy(), full_df.to_numpy(), rtol=1e-14)
+
+    # a refresh refits on every sample, the same as no reference at all
+    refreshed_df = data_load.load_txt_file_into_dataframe(full_file_path, cache_folder=cache_folder, reference_folder=reference_folder,
+                                                          refresh_reference=True)
+    assert_allclose(refreshed_df.to_numpy(), data_load.load_txt_file_into_dataframe(full_file_path).to_numpy(), rtol=1e-14)
+    assert os.path.islink(reference_folder)
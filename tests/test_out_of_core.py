@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+import utils, data_load, parallel
+
+
+def test_out_of_core_matrix_is_the_in_memory_one(input_files, expression_df, tmp_path):
+    out_of_core_df = data_load.load_txt_file_into_dataframe(input_files[1], cache_folder=str(tmp_path), chunksize=7, out_of_core=True)
+    assert list(out_of_core_df.index) == list(expression_df.index) and list(out_of_core_df.columns) == list(expression_df.columns)
+    assert_allclose(out_of_core_df.to_numpy(), expression_df.to_numpy(), rtol=1e-14)
+    # memory-mapped, workers map the same file instead of copying it
+    assert parallel.memmap_file(out_of_core_df.to_numpy()) is not None
+
+    with pytest.raises(ValueError):
+        data_load.load_txt_file_into_dataframe(input_files[1], out_of_core=True)
+
+
+def test_blockwise_stats_are_the_in_memory_ones(input_files, expression_df, targets, tmp_path):
+    _, mutation_matrix = data_load.load_wide_inputs(input_files[0], input_files[1], targets + ['NOT_A_GENE'])
+    stats_per_target = utils.generate_stats_for_targets(expression_df, mutation_matrix, output_folder=str(tmp_path / 'memory'),
+                                                        n_permutations=200, seed=1)
+    output_filenames = utils.generate_stats_for_targets_blockwise(expression_df, mutation_matrix, output_folder=str(tmp_path / 'blocks'),
+                                                                  n_permutations=200, seed=1, block_size=13)
+    assert list(output_filenames) == targets
+
+    for target_gene, output_filename in output_filenames.items():
+        blockwise_df = pd.read_csv(output_filename, float_precision='round_trip')
+        memory_df = pd.read_csv(stats_per_target[target_gene].attrs['output_filename'], float_precision='round_trip')
+        pd.testing.assert_frame_equal(blockwise_df, memory_df, check_exact=False, rtol=1e-12, atol=1e-15)
+        # the same permutations are drawn for every block
+        assert np.array_equal(blockwise_df['permutation_pvalue'], memory_df['permutation_pvalue'])
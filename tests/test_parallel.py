@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+import utils, data_load, parallel
+
+
+@pytest.fixture(scope='module')
+def analysis_inputs(input_files, expression_df, targets):
+    _, mutation_matrix = data_load.load_wide_inputs(input_files[0], input_files[1], targets)
+    stats_per_target = utils.generate_stats_for_targets(expression_df, mutation_matrix)
+    # a target whose stats are broken fails its analysis
+    stats_per_target['BROKEN'] = stats_per_target[targets[0]].drop(columns=['pvalue'])
+    mutation_matrix['BROKEN'] = mutation_matrix[targets[0]]
+    return stats_per_target, mutation_matrix
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_failures_are_kept_apart(expression_df, targets, analysis_inputs, tmp_path, n_workers):
+    stats_per_target, mutation_matrix = analysis_inputs
+    handled = []
+
+    def on_result(target_gene, result):
+        if target_gene == targets[1]:
+            raise RuntimeError('recording failed')
+        handled.append(target_gene)
+
+    results, errors, callback_errors = parallel.run_targets(expression_df, stats_per_target, mutation_matrix, str(tmp_path),
+                                                            n_workers=n_workers, on_result=on_result, n=30)
+
+    assert list(results) == targets
+    assert list(errors) == ['BROKEN'] and 'pvalue' in errors['BROKEN']
+    # the analysis of a target whose callback failed still succeeded
+    assert list(callback_errors) == [targets[1]] and 'recording failed' in callback_errors[targets[1]]
+    assert handled == [target_gene for target_gene in targets if target_gene != targets[1]]
+
+
+def test_pool_and_serial_runs_agree(expression_df, targets, analysis_inputs, tmp_path):
+    stats_per_target, mutation_matrix = analysis_inputs
+    stats_per_target = {target_gene: stats_per_target[target_gene] for target_gene in targets}
+    serial_results, _, _ = parallel.run_targets(expression_df, stats_per_target, mutation_matrix, str(tmp_path / 'serial'), n=30)
+    pool_results, _, _ = parallel.run_targets(expression_df, stats_per_target, mutation_matrix, str(tmp_path / 'pool'), n_workers=2, n=30)
+    assert pd.DataFrame(pool_results).equals(pd.DataFrame(serial_results))
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+from scipy.stats import ranksums
+import utils, data_load
+
+
+def test_ranksum_stats_match_scipy():
+    rng = np.random.default_rng(0)
+    # rounded so genes have ties
+    values = np.round(rng.gamma(2, 2, size=(50, 30)), 1)
+    mutated_mask = np.zeros(30, dtype=bool)
+    mutated_mask[rng.choice(30, 8, replace=False)] = True
+
+    stats = utils.calculate_ranksum_stats(values, mutated_mask)
+
+    for gene, row in enumerate(values):
+        mutated, non_mutated = row[mutated_mask], row[~mutated_mask]
+        test = ranksums(mutated, non_mutated)
+        assert_allclose(stats['pvalue'][gene], test.pvalue, rtol=1e-12)
+        assert_allclose(stats['effect_size'][gene], test.statistic / (len(mutated) * len(non_mutated)), rtol=1e-12)
+        assert_allclose(stats['logFC'][gene], utils.calculate_log_fold(list(mutated), list(non_mutated)), rtol=1e-12, atol=1e-15)
+        assert_allclose(stats['expression_mutated_mean'][gene], mutated.mean(), rtol=1e-12)
+        assert_allclose(stats['expression_nonmutated_mean'][gene], non_mutated.mean(), rtol=1e-12)
+
+
+def test_batch_matches_one_target_at_a_time():
+    rng = np.random.default_rng(1)
+    values = rng.normal(size=(40, 20))
+    mutation_matrix = rng.random((20, 5)) < 0.3
+
+    batch = utils.calculate_ranksum_stats_batch(values, mutation_matrix)
+    for target in range(mutation_matrix.shape[1]):
+        single = utils.calculate_ranksum_stats(values, mutation_matrix[:, target])
+        for column, target_values in single.items():
+            assert_allclose(batch[column][:, target], target_values, rtol=1e-12, atol=1e-15)
+
+
+def test_wide_stats_match_the_long_format(input_files, expression_df, targets, tmp_path):
+    maf_df = data_load.load_maf_data(input_files[0])
+    # the long format counts a sample once per maf row of the gene, the same only with one row per mutation
+    maf_df = maf_df.drop_duplicates(subset=['gene', 'sample'])
+    melted = data_load.preprocess_and_combine_mutation_expression(maf_df=maf_df, expression_df=data_load.reformat_expression_data(expression_df))
+
+    for target_gene in targets[:2]:
+        long_df, _, _ = utils.generate_stats_per_gene(melted, target_gene, str(tmp_path))
+        wide_df, _, _ = utils.generate_stats_per_gene_wide(expression_df, maf_df, target_gene, str(tmp_path))
+        merged = pd.merge(long_df, wide_df, on='gene', suffixes=('_long', '_wide'))
+        assert len(merged) == len(long_df) == len(wide_df)
+        for column in ('logFC', 'pvalue', 'effect_size', 'adjusted_pvalue'):
+            assert_allclose(merged[f'{column}_wide'], merged[f'{column}_long'], rtol=1e-10, atol=1e-14)
+
+
+def test_all_targets_at_once_match_one_at_a_time(input_files, expression_df, targets, tmp_path):
+    import mutation_index
+    mutation_matrix = mutation_index.build_mutation_index(input_files[0]).mutation_matrix(targets + ['NOT_A_GENE'])
+    stats_per_target = utils.generate_stats_for_targets(expression_df, mutation_matrix, output_folder=str(tmp_path / 'batch'))
+    # an unknown target is skipped, the others are the same as testing each on its own
+    assert list(stats_per_target) == targets
+
+    maf_df = data_load.load_maf_data(input_files[0])
+    for target_gene, stats_df in stats_per_target.items():
+        wide_df, _, output_filename = utils.generate_stats_per_gene_wide(expression_df, maf_df, target_gene, str(tmp_path / 'single'))
+        pd.testing.assert_frame_equal(stats_df, wide_df, check_exact=False, rtol=1e-12, atol=1e-15)
+        assert os.path.basename(stats_df.attrs['output_filename']) == os.path.basename(output_filename)
+
+    assert utils.generate_stats_for_targets(expression_df, mutation_matrix[['NOT_A_GENE']]) == {}
+
+
+def test_permutation_pvalues_approach_the_exact_test():
+    from itertools import combinations
+    rng = np.random.default_rng(4)
+    # 3 of 9 samples mutated: 84 relabelings, few enough to enumerate
+    mutated_mask = np.zeros(9, dtype=bool)
+    mutated_mask[[0, 4, 5]] = True
+    values = rng.normal(size=(6, 9))
+    values[0, mutated_mask] += 5
+    ranks = utils.rank_rows(values)
+
+    expected = 3 * 10 / 2.0
+    observed = np.abs(ranks[:, mutated_mask].sum(axis=1) - expected)
+    relabelings = np.abs(np.stack([ranks[:, list(chosen)].sum(axis=1) for chosen in combinations(range(9), 3)]) - expected)
+    exact_pvalues = (relabelings >= observed - 1e-9).mean(axis=0)
+
+    pvalues = utils.calculate_permutation_pvalues(ranks, mutated_mask, n_permutations=20000, stop_after_hits=20000, seed=0)
+    assert_allclose(pvalues, exact_pvalues, atol=0.01)
+    assert np.array_equal(pvalues, utils.calculate_permutation_pvalues(ranks, mutated_mask, n_permutations=20000, stop_after_hits=20000, seed=0))
+
+    # genes that are clearly not significant stop early, at hits / permutations done
+    early_pvalues = utils.calculate_permutation_pvalues(ranks, mutated_mask, n_permutations=20000, stop_after_hits=50, block_size=100, seed=0)
+    assert_allclose(early_pvalues[1:], exact_pvalues[1:], atol=0.15)
+
+
+def test_adjusted_pvalues_are_the_statsmodels_ones():
+    from statsmodels.stats import multitest
+    rng = np.random.default_rng(5)
+    # ties, exact zeros and ones, and a strong signal
+    pvalues = np.concatenate([rng.random(500), rng.random(50) * 1e-6, [0.0, 1.0, 1.0, 0.25, 0.25]])
+    rng.shuffle(pvalues)
+    expected = multitest.multipletests(pvalues, method='fdr_bh')[1]
+    assert np.array_equal(utils.calculate_adjusted_pvalue(pvalues), expected)
+    assert np.array_equal(utils.calculate_adjusted_pvalue(pvalues[:1]), multitest.multipletests(pvalues[:1], method='fdr_bh')[1])
+    # other methods still go to statsmodels
+    assert np.array_equal(utils.calculate_adjusted_pvalue(pvalues, method='bonferroni'), multitest.multipletests(pvalues, method='bonferroni')[1])
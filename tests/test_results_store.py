@@ -0,0 +1,23 @@
+import pandas as pd
+import utils, mutation_index, results_store
+
+
+def test_stored_stats_are_the_csv_ones(input_files, expression_df, targets, tmp_path):
+    mutation_matrix = mutation_index.build_mutation_index(input_files[0]).mutation_matrix(targets)
+    with results_store.ResultsStore(str(tmp_path / 'results.sqlite')) as store:
+        stats_per_target = utils.generate_stats_for_targets(expression_df, mutation_matrix, output_folder=str(tmp_path),
+                                                            n_permutations=50, seed=0, results_store=store)
+        assert store.targets() == targets
+
+        for target_gene, stats_df in stats_per_target.items():
+            csv_df = pd.read_csv(stats_df.attrs['output_filename'], float_precision='round_trip')
+            pd.testing.assert_frame_equal(store.read_target(target_gene), csv_df)
+
+        gene = stats_per_target[targets[0]]['gene'].iloc[0]
+        expected = [target_gene for target_gene, stats_df in stats_per_target.items()
+                    if stats_df.set_index('gene').loc[gene, 'adjusted_pvalue'] < 0.5]
+        assert store.targets_where(gene, threshold=0.5)['target'].tolist() == expected
+
+        # appending a target again replaces its rows
+        store.append({targets[0]: stats_per_target[targets[0]].head(3)})
+        assert len(store.read_target(targets[0])) == 3
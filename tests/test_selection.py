@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+from scipy.stats import zscore
+import selection, data_load
+
+
+@pytest.fixture
+def stats_df():
+    rng = np.random.default_rng(9)
+    # rounded so there are many ties, and a few nans
+    pvalues = np.round(rng.random(200), 2)
+    pvalues[[3, 50, 120]] = np.nan
+    return pd.DataFrame({'gene': [f'GENE{i}' for i in range(200)], 'logFC': np.round(rng.normal(size=200), 1), 'pvalue': pvalues})
+
+
+def first_rows(series, k, largest=False):
+    # nsmallest/nlargest (keep='first') without nans. Once every row fits pandas sorts them with an unstable
+    # sort, so ties are put back in row order with a stable one
+    series = series.dropna()
+    if k < len(series):
+        return list(series.nlargest(k).index if largest else series.nsmallest(k).index)
+    return list(series.sort_values(ascending=not largest, kind='stable').index)
+
+
+@pytest.mark.parametrize('k', [1, 10, 37, 197, 250])
+def test_top_k_positions_match_nsmallest_and_nlargest(stats_df, k):
+    pvalues = stats_df['pvalue']
+    assert list(selection.top_k_positions(pvalues.to_numpy(), k)) == first_rows(pvalues, k)
+    assert list(selection.top_k_positions(pvalues.to_numpy(), k, largest=True)) == first_rows(pvalues, k, largest=True)
+
+    significant = (pvalues < 0.05).to_numpy()
+    logfc = stats_df['logFC']
+    assert list(selection.top_k_positions(logfc.to_numpy(), k, largest=True, mask=significant)) == first_rows(logfc[significant], k, largest=True)
+    assert list(selection.top_k_positions(logfc.to_numpy(), k, mask=significant)) == first_rows(logfc[significant], k)
+
+
+def test_heatmap_rows_match_sorting_the_stats(stats_df):
+    rng = np.random.default_rng(10)
+    expression_df = pd.DataFrame(rng.normal(size=(200, 12)), index=stats_df['gene'], columns=[f'RESPOND_{j:04d}' for j in range(12)])
+    expression_df.iloc[7] = 1.0
+
+    for top, reference in ((True, stats_df.nsmallest(20, 'pvalue')), (False, stats_df.nlargest(20, 'pvalue'))):
+        heatmap_df = data_load.generate_expression_heatmap(expression_df, stats_df, 20, top=top)
+        pd.testing.assert_frame_equal(heatmap_df, expression_df.loc[reference['gene']])
+
+    genes = stats_df['gene'].iloc[[7, 0, 19]]
+    zscored_df = selection.gather_rows(expression_df, genes, zscore=True)
+    assert_allclose(zscored_df.to_numpy(), zscore(expression_df.loc[genes].to_numpy(), axis=1), rtol=1e-12)
+    # a row without variance has no z-scores
+    assert zscored_df.iloc[0].isna().all()
+
+    with pytest.raises(KeyError):
+        selection.gather_rows(expression_df, ['NOT_A_GENE'])
@@ -0,0 +1,80 @@
+import json
+import asyncio
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+import utils, data_load, mutation_index, service
+
+
+@pytest.fixture
+def analysis_service(input_files, expression_df):
+    return service.AnalysisService(expression_df, mutation_index.build_mutation_index(input_files[0]), cache_mb=1)
+
+
+def get(analysis_service, path, **query):
+    status, content_type, body = asyncio.run(analysis_service.respond(path, {name: [str(value)] for name, value in query.items()}))
+    return status, json.loads(body) if content_type == 'application/json' else body.decode()
+
+
+def test_stats_and_heatmap_are_the_pipeline_ones(analysis_service, input_files, expression_df, targets):
+    # the stats as the wide pipeline computes them
+    _, mutation_matrix = data_load.load_wide_inputs(input_files[0], input_files[1], targets)
+    stats_per_target = utils.generate_stats_for_targets(expression_df, mutation_matrix)
+
+    for target_gene, stats_df in stats_per_target.items():
+        status, answer = get(analysis_service, f'/stats/{target_gene}')
+        assert status == 200 and answer['genes'] == stats_df['gene'].tolist()
+        assert answer['columns'] == list(stats_df.columns.drop('gene'))
+        assert_allclose(np.array(answer['values'], dtype=np.float64), stats_df.drop(columns='gene').to_numpy(), rtol=1e-12, atol=1e-15)
+        assert answer['n_mutated'] == mutation_matrix[target_gene].sum()
+
+        status, answer = get(analysis_service, f'/heatmap/{target_gene}', n=15)
+        heatmap_df = data_load.generate_expression_heatmap(expression_df, stats_df, 15, top=True)
+        assert answer['genes'] == heatmap_df.index.tolist() and answer['samples'] == heatmap_df.columns.tolist()
+        assert np.array_equal(np.array(answer['values']), heatmap_df.to_numpy())
+
+    status, answer = get(analysis_service, f'/stats/{targets[0]}', limit=5)
+    assert answer['genes'] == stats_per_target[targets[0]].nsmallest(5, 'pvalue')['gene'].tolist()
+
+
+def test_unknown_targets_and_endpoints_are_404(analysis_service, targets):
+    for path in ('/stats/NOT_A_GENE', '/heatmap/NOT_A_GENE', '/clusters/NOT_A_GENE', '/nothing', f'/stats/{targets[0]}/more'):
+        status, answer = get(analysis_service, path)
+        assert status == 404 and 'error' in answer
+
+
+def test_bad_parameters_are_400(analysis_service, targets):
+    for path, query in ((f'/stats/{targets[0]}', {'limit': 0}), (f'/stats/{targets[0]}', {'limit': 'ten'}),
+                        (f'/heatmap/{targets[0]}', {'n': 'all'}), (f'/clusters/{targets[0]}', {'row_threshold': -1})):
+        status, answer = get(analysis_service, path, **query)
+        assert status == 400 and 'error' in answer
+    # the parameters are checked before the target
+    assert get(analysis_service, '/stats/NOT_A_GENE', limit=0)[0] == 400
+
+
+def test_failures_of_the_service_are_500_and_not_cached(analysis_service, targets, monkeypatch):
+    def broken_stats(target_gene):
+        raise KeyError('broken')
+
+    monkeypatch.setattr(analysis_service, 'stats', broken_stats)
+    status, answer = get(analysis_service, f'/stats/{targets[0]}')
+    assert status == 500 and 'KeyError' in answer['error']
+    assert analysis_service.cache.info()['entries'] == 0
+
+    monkeypatch.undo()
+    assert get(analysis_service, f'/stats/{targets[0]}')[0] == 200
+
+
+def test_answers_are_cached(analysis_service, targets):
+    first = get(analysis_service, f'/stats/{targets[0]}', format='csv')
+    assert get(analysis_service, f'/stats/{targets[0]}', format='csv') == first
+    status, info = get(analysis_service, '/cache')
+    assert info['entries'] == 1 and info['hits'] == 1 and info['misses'] == 1
+
+    cache = service.LRUCache(10)
+    cache.put('a', ('text/plain', b'12345'))
+    cache.put('b', ('text/plain', b'12345'))
+    cache.get('a')
+    cache.put('c', ('text/plain', b'123'))
+    # b was used least recently
+    assert list(cache.entries) == ['a', 'c'] and cache.n_bytes == 8